@@ -0,0 +1,101 @@
+from firebase import db
+from datastore import get_all
+from grants import grant_ref, normalize_email, verified_email
+
+
+def shared_with_user(item, current_user):
+    """
+    Check whether an item's sharing fields name the user's verified email, ignoring case
+    """
+    email = verified_email(current_user)
+    return bool(email) and email in (normalize_email(shared) for shared in item.get("sharedWith") or [])
+
+
+def can_view_subject(subject, current_user):
+    """
+    Check the sharing fields kept on a subject document against a user
+    """
+    if subject.get("createdBy") == current_user["uid"]:
+        return True
+    if subject.get("shareType") == "public":
+        return True
+    return shared_with_user(subject, current_user)
+
+
+def can_view_note(note, subject, current_user):
+    """
+    Check a note against a user using the note's and its subject's sharing fields
+    """
+    if note.get("createdBy") == current_user["uid"]:
+        return True
+    if subject is not None and can_view_subject(subject, current_user):
+        return True
+    if note.get("shareType") == "public":
+        return True
+    return shared_with_user(note, current_user)
+
+
+def fetch_documents(collection, ids):
+    """
+    Read many documents in one round-trip, returning existing ones keyed by id
+    """
+    refs = [db.collection(collection).document(doc_id) for doc_id in ids]
+    return {doc.id: doc for doc in get_all(refs) if doc.exists}
+
+
+def granted_item_ids(item_type, item_ids, current_user):
+    """
+    Find which items carry a grant for the user, reading the grant documents directly by key
+    """
+    refs = [grant_ref(item_type, item_id, current_user["uid"]) for item_id in set(item_ids)]
+    return {doc.get("itemId") for doc in get_all(refs) if doc.exists}
+
+
+def viewable_subject_ids(subjects, current_user):
+    """
+    Work out which of a set of subject dicts the user may view, all at once
+
+    Besides each subject's own sharing fields, this reads the user's grants on the
+    subjects and on every subject they are nested in, plus those ancestors'
+    sharing fields, each as one multi-document read.
+    """
+    allowed = {subject["id"] for subject in subjects if can_view_subject(subject, current_user)}
+    pending = [subject for subject in subjects if subject["id"] not in allowed]
+    if not pending:
+        return allowed
+
+    ancestor_ids = {ancestor_id for subject in pending for ancestor_id in subject.get("ancestors") or []}
+    granted = granted_item_ids("subject", {subject["id"] for subject in pending} | ancestor_ids, current_user)
+    unresolved = ancestor_ids - granted
+    ancestors = fetch_documents("subjects", unresolved) if unresolved else {}
+    granted |= {ancestor_id for ancestor_id, doc in ancestors.items() if can_view_subject(doc.to_dict(), current_user)}
+
+    for subject in pending:
+        if subject["id"] in granted or granted.intersection(subject.get("ancestors") or []):
+            allowed.add(subject["id"])
+    return allowed
+
+
+def viewable_note_ids(notes, subjects_by_id, current_user):
+    """
+    Work out which of a set of note dicts the user may view, all at once
+    """
+    allowed = set()
+    pending_subjects = set()
+    for note in notes:
+        if can_view_note(note, subjects_by_id.get(note.get("subjectId")), current_user):
+            allowed.add(note["id"])
+        else:
+            pending_subjects.add(note.get("subjectId"))
+
+    pending = [note for note in notes if note["id"] not in allowed]
+    if not pending:
+        return allowed
+
+    # Fall back to grants on the notes, their subjects and the subjects' ancestors
+    shared_subjects = viewable_subject_ids([subjects_by_id[subject_id] for subject_id in pending_subjects if subject_id in subjects_by_id], current_user)
+    shared_notes = granted_item_ids("note", [note["id"] for note in pending], current_user)
+    for note in pending:
+        if note["id"] in shared_notes or note.get("subjectId") in shared_subjects:
+            allowed.add(note["id"])
+    return allowed
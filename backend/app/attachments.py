@@ -0,0 +1,339 @@
+import glob
+import hashlib
+import os
+import secrets
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+from firebase import db
+from utils import create_server_timestamp
+
+# Where attachment bytes live on this instance; a bucket-backed store can replace LocalBlobStore
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", os.path.join(tempfile.gettempdir(), "studyhub-attachments"))
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(100 * 1024 * 1024)))
+# Bytes of attachments each user may reference; a file shared by two notes counts once per attachment
+USER_QUOTA_BYTES = int(os.getenv("ATTACHMENT_QUOTA_BYTES", str(1024 * 1024 * 1024)))
+# Unfinished uploads are dropped after this long
+UPLOAD_TTL_SECONDS = 24 * 3600
+READ_CHUNK_BYTES = 1024 * 1024
+
+# One document per distinct content, keyed by its sha256, counting the attachments using it
+BLOBS_COLLECTION = "blobs"
+# One document per uploaded file, pointing at its blob
+ATTACHMENTS_COLLECTION = "attachments"
+# Uploads in progress
+UPLOADS_COLLECTION = "uploads"
+# Attachment bytes referenced by each user, keyed by uid
+USAGE_COLLECTION = "attachmentUsage"
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class LocalBlobStore:
+    """
+    Blobs as files named by their sha256, with uploads staged next to them until complete
+    """
+
+    def __init__(self, root=ATTACHMENT_DIR):
+        self.blob_dir = os.path.join(root, "blobs")
+        self.staging_dir = os.path.join(root, "uploads")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def staging_path(self, upload_id):
+        return os.path.join(self.staging_dir, upload_id)
+
+    def has(self, sha256):
+        return os.path.exists(self.blob_path(sha256))
+
+    def size(self, sha256):
+        return os.path.getsize(self.blob_path(sha256))
+
+    def staged_size(self, upload_id):
+        try:
+            return os.path.getsize(self.staging_path(upload_id))
+        except OSError:
+            return 0
+
+    def append(self, upload_id, data):
+        with open(self.staging_path(upload_id), "ab") as staged:
+            staged.write(data)
+
+    def hash_staged(self, upload_id):
+        digest = hashlib.sha256()
+        with open(self.staging_path(upload_id), "rb") as staged:
+            for piece in iter(lambda: staged.read(READ_CHUNK_BYTES), b""):
+                digest.update(piece)
+        return digest.hexdigest()
+
+    def keep_staged(self, upload_id, sha256):
+        """
+        Make a finished upload the blob for its hash, or drop it if that blob is already stored
+        """
+        if self.has(sha256):
+            self.discard(upload_id)
+            return
+        os.makedirs(os.path.dirname(self.blob_path(sha256)), exist_ok=True)
+        os.replace(self.staging_path(upload_id), self.blob_path(sha256))
+
+    def discard(self, upload_id):
+        remove_file(self.staging_path(upload_id))
+
+    def delete(self, sha256):
+        remove_file(self.blob_path(sha256))
+
+    def read(self, sha256, start, end):
+        """
+        Yield the bytes from start up to and including end
+        """
+        with open(self.blob_path(sha256), "rb") as blob:
+            blob.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                piece = blob.read(min(READ_CHUNK_BYTES, remaining))
+                if not piece:
+                    return
+                remaining -= len(piece)
+                yield piece
+
+    def prune_staging(self, max_age=UPLOAD_TTL_SECONDS):
+        cutoff = time.time() - max_age
+        for path in glob.glob(os.path.join(self.staging_dir, "*")):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+blob_store = LocalBlobStore()
+# Held while a blob file is placed or removed, so that placing and removing the same blob can't interleave
+files_lock = threading.Lock()
+
+
+class StreamHashes:
+    """
+    Running sha256 of each upload on this instance, fed as its chunks arrive
+
+    If a chunk lands somewhere else or the process restarts, the hash is lost
+    and the staged file is hashed again once the upload completes.
+    """
+
+    def __init__(self):
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def feed(self, upload_id, offset, data):
+        with self._lock:
+            hashed, digest = self._hashes.get(upload_id, (0, None))
+            if offset == 0:
+                hashed, digest = 0, hashlib.sha256()
+            if digest is None or hashed != offset:
+                self._hashes.pop(upload_id, None)
+                return
+            digest.update(data)
+            self._hashes[upload_id] = (hashed + len(data), digest)
+
+    def finish(self, upload_id, size):
+        with self._lock:
+            hashed, digest = self._hashes.pop(upload_id, (0, None))
+        if digest is not None and hashed == size:
+            return digest.hexdigest()
+        return blob_store.hash_staged(upload_id)
+
+    def forget(self, upload_id):
+        with self._lock:
+            self._hashes.pop(upload_id, None)
+
+
+stream_hashes = StreamHashes()
+
+
+def usage_ref(uid):
+    return db.collection(USAGE_COLLECTION).document(uid)
+
+
+def used_bytes(uid):
+    usage_doc = usage_ref(uid).get()
+    return (usage_doc.get("bytes") or 0) if usage_doc.exists else 0
+
+
+def download_path(attachment_id, token):
+    return f"/attachments/{attachment_id}/content?token={token}"
+
+
+def format_attachment(attachment_id, attachment):
+    return {
+        "id": attachment_id,
+        "name": attachment["name"],
+        "contentType": attachment["contentType"],
+        "size": attachment["size"],
+        "sha256": attachment["sha256"],
+        "downloadPath": download_path(attachment_id, attachment["token"]),
+        "createdAt": attachment.get("createdAt"),
+    }
+
+
+@firestore.transactional
+def add_reference(transaction, owner_id, name, content_type, sha256, size, existing_only=False):
+    """
+    Create an attachment for a blob, counting it against the blob and the owner's quota
+
+    With existing_only, nothing is written unless the blob is already stored and None is returned.
+    """
+    blob_ref = db.collection(BLOBS_COLLECTION).document(sha256)
+    blob_doc = blob_ref.get(transaction=transaction)
+    usage_doc = usage_ref(owner_id).get(transaction=transaction)
+    if existing_only and not blob_doc.exists:
+        return None
+
+    used = (usage_doc.get("bytes") or 0) if usage_doc.exists else 0
+    if used + size > USER_QUOTA_BYTES:
+        raise QuotaExceeded(f"Attachments would use {used + size} of {USER_QUOTA_BYTES} bytes")
+
+    if blob_doc.exists:
+        transaction.update(blob_ref, {"refCount": firestore.Increment(1)})
+    else:
+        transaction.set(blob_ref, {"size": size, "refCount": 1, "createdAt": create_server_timestamp()})
+    transaction.set(usage_ref(owner_id), {"bytes": firestore.Increment(size)}, merge=True)
+
+    attachment_ref = db.collection(ATTACHMENTS_COLLECTION).document()
+    attachment = {
+        "ownerId": owner_id,
+        "name": name,
+        "contentType": content_type,
+        "size": size,
+        "sha256": sha256,
+        # Lets the download URL work in img tags and links, like a storage download token
+        "token": secrets.token_urlsafe(24),
+        "createdAt": create_server_timestamp(),
+    }
+    transaction.set(attachment_ref, attachment)
+    return attachment_ref.id, dict(attachment, createdAt=datetime.now(timezone.utc))
+
+
+@firestore.transactional
+def drop_reference(transaction, attachment_ref):
+    """
+    Delete an attachment and release its blob, returning the blob's hash if nothing uses it any more
+    """
+    attachment_doc = attachment_ref.get(transaction=transaction)
+    if not attachment_doc.exists:
+        return None
+    attachment = attachment_doc.to_dict()
+    blob_ref = db.collection(BLOBS_COLLECTION).document(attachment["sha256"])
+    blob_doc = blob_ref.get(transaction=transaction)
+
+    transaction.delete(attachment_ref)
+    transaction.set(usage_ref(attachment["ownerId"]), {"bytes": firestore.Increment(-attachment["size"])}, merge=True)
+    if blob_doc.exists and (blob_doc.get("refCount") or 0) > 1:
+        transaction.update(blob_ref, {"refCount": firestore.Increment(-1)})
+        return None
+    transaction.delete(blob_ref)
+    return attachment["sha256"]
+
+
+def reuse_blob(owner_id, name, content_type, sha256, size):
+    """
+    Attach content the user already has stored straight away, or return None
+
+    Only the user's own attachments are considered. Knowing a hash proves nothing
+    about having the content, so anyone else has to send the bytes, which are
+    then hashed and deduplicated once they arrive.
+    """
+    query = (
+        db.collection(ATTACHMENTS_COLLECTION)
+        .where("ownerId", "==", owner_id)
+        .where("sha256", "==", sha256)
+        .limit(1)
+    )
+    owned = [attachment_doc.to_dict() for attachment_doc in query.stream()]
+    if not owned or owned[0]["size"] != size or not blob_store.has(sha256):
+        return None
+    created = add_reference(db.transaction(), owner_id, name, content_type, sha256, size, existing_only=True)
+    if created is None:
+        return None
+    return format_attachment(*created)
+
+
+def create_upload(owner_id, name, content_type, size, sha256=None):
+    """
+    Start an upload, returning its id and attachment, the latter set when the user already stored the content
+    """
+    blob_store.prune_staging()
+    if sha256:
+        attachment = reuse_blob(owner_id, name, content_type, sha256, size)
+        if attachment is not None:
+            return None, attachment
+
+    if used_bytes(owner_id) + size > USER_QUOTA_BYTES:
+        raise QuotaExceeded(f"Attachments would use more than {USER_QUOTA_BYTES} bytes")
+
+    upload_ref = db.collection(UPLOADS_COLLECTION).document()
+    upload_ref.set({
+        "ownerId": owner_id,
+        "name": name,
+        "contentType": content_type,
+        "size": size,
+        "sha256": sha256,
+        "createdAt": create_server_timestamp(),
+        "expiresAt": datetime.now(timezone.utc) + timedelta(seconds=UPLOAD_TTL_SECONDS),
+    })
+    blob_store.append(upload_ref.id, b"")
+    return upload_ref.id, None
+
+
+def cancel_upload(upload_id):
+    stream_hashes.forget(upload_id)
+    blob_store.discard(upload_id)
+    db.collection(UPLOADS_COLLECTION).document(upload_id).delete()
+
+
+def finish_upload(upload_id, upload):
+    """
+    Turn a fully received upload into an attachment, storing its content only if it is new
+
+    Raises ValueError when the content doesn't match the hash given at the start.
+    """
+    sha256 = stream_hashes.finish(upload_id, upload["size"])
+    if upload.get("sha256") and upload["sha256"] != sha256:
+        cancel_upload(upload_id)
+        raise ValueError("The uploaded content does not match its sha256")
+
+    try:
+        attachment_id, attachment = add_reference(
+            db.transaction(), upload["ownerId"], upload["name"], upload["contentType"], sha256, upload["size"]
+        )
+    except QuotaExceeded:
+        cancel_upload(upload_id)
+        raise
+    # The reference is counted before the file is placed, so a concurrent delete of the
+    # last other reference sees it and leaves the file alone
+    with files_lock:
+        blob_store.keep_staged(upload_id, sha256)
+    db.collection(UPLOADS_COLLECTION).document(upload_id).delete()
+    return format_attachment(attachment_id, attachment)
+
+
+def delete_attachment(attachment_id):
+    sha256 = drop_reference(db.transaction(), db.collection(ATTACHMENTS_COLLECTION).document(attachment_id))
+    if sha256 is None:
+        return
+    with files_lock:
+        # An upload of the same content may have claimed the blob again since
+        if not db.collection(BLOBS_COLLECTION).document(sha256).get().exists:
+            blob_store.delete(sha256)
@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Small thread-safe LRU cache whose entries expire after a fixed number of seconds
+    """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Per-user dashboard payloads, keyed by uid
+dashboard_cache = TTLCache(maxsize=2048, ttl=30)
+
+
+def invalidate_user_views(uid):
+    """
+    Drop any cached per-user views after the user changes their library
+    """
+    dashboard_cache.invalidate(uid)
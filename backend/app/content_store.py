@@ -0,0 +1,206 @@
+import uuid
+import zlib
+from collections import defaultdict
+from firebase import db
+from datastore import get_all
+from note_text import derive_fields
+from minhash import minhash_fields
+
+# Characters of note content per chunk document. Even all 4-byte UTF-8 this
+# stays well under Firestore's 1 MiB document limit before compression.
+CHUNK_CHARS = 64 * 1024
+# Characters of content kept on the note document for list views
+PREVIEW_CHARS = 600
+COMPRESSION_LEVEL = 6
+
+# Note fields used internally and never sent to clients
+INTERNAL_NOTE_FIELDS = ["minhash", "lshBuckets"]
+
+# Note fields read by summary list views; nothing here depends on the content size
+NOTE_SUMMARY_FIELDS = [
+    "title", "subjectId", "tags", "mediaItems", "createdBy", "createdAt", "updatedAt",
+    "isShared", "shareType", "sharedWith", "contentInfo",
+    "excerpt", "wordCount", "readingTimeMinutes", "outline",
+]
+
+
+def chunk_ref(note_id, generation, index):
+    return db.collection("notes").document(note_id).collection("content").document(f"{generation}-{index:05d}")
+
+
+def chunk_refs(note_id, info):
+    """
+    References to every chunk described by a note's contentInfo
+    """
+    if not info:
+        return []
+    return [chunk_ref(note_id, info["generation"], index) for index in range(info["chunks"])]
+
+
+def add_content_writes(batch, note_id, content):
+    """
+    Add the chunk writes for a note body to a batch and return its contentInfo
+
+    Every write uses a fresh generation, so the note document keeps pointing at
+    a complete set of chunks until it is switched over to the new one.
+    """
+    generation = uuid.uuid4().hex[:8]
+    pieces = [content[start:start + CHUNK_CHARS] for start in range(0, len(content), CHUNK_CHARS)] or [""]
+
+    stored = 0
+    for index, piece in enumerate(pieces):
+        data = zlib.compress(piece.encode("utf-8"), COMPRESSION_LEVEL)
+        stored += len(data)
+        batch.set(chunk_ref(note_id, generation, index), {"data": data, "start": index * CHUNK_CHARS, "length": len(piece)})
+
+    return {
+        "generation": generation,
+        "chunks": len(pieces),
+        "chunkChars": CHUNK_CHARS,
+        "length": len(content),
+        "bytes": len(content.encode("utf-8")),
+        "storedBytes": stored,
+        "encoding": "zlib",
+    }
+
+
+def add_content_deletes(batch, note_id, info):
+    for ref in chunk_refs(note_id, info):
+        batch.delete(ref)
+
+
+def content_fields(content, info):
+    """
+    Fields stored on the note document in place of the full body, including
+    the plain-text excerpt, stats and near-duplicate signature derived from it
+    once at write time
+    """
+    fields = {
+        "contentInfo": info,
+        "contentPreview": content[:PREVIEW_CHARS],
+    }
+    fields.update(derive_fields(content))
+    fields.update(minhash_fields(content))
+    return fields
+
+
+def drop_internal_fields(note):
+    for field in INTERNAL_NOTE_FIELDS:
+        note.pop(field, None)
+    return note
+
+
+def load_content(note_id, note, offset=0, length=None):
+    """
+    Load a note's content, or just a character range of it
+
+    Only the chunks overlapping the range are read. Notes written before the
+    content moved out of the note document still carry it inline.
+    """
+    info = note.get("contentInfo")
+    if not info:
+        content = note.get("content") or ""
+        return content[offset:None if length is None else offset + length]
+
+    end = info["length"] if length is None else min(info["length"], offset + length)
+    if offset >= end:
+        return ""
+
+    first = offset // info["chunkChars"]
+    last = (end - 1) // info["chunkChars"]
+    refs = [chunk_ref(note_id, info["generation"], index) for index in range(first, last + 1)]
+
+    pieces = {}
+    for chunk_doc in get_all(refs):
+        if chunk_doc.exists:
+            chunk = chunk_doc.to_dict()
+            pieces[chunk["start"]] = zlib.decompress(chunk["data"]).decode("utf-8")
+
+    text = "".join(pieces[start] for start in sorted(pieces))
+    base = first * info["chunkChars"]
+    return text[offset - base:end - base]
+
+
+def load_contents(notes):
+    """
+    Load the full content of many notes with a single multi-document read
+    """
+    refs = []
+    for note in notes:
+        refs.extend(chunk_refs(note["id"], note.get("contentInfo")))
+
+    pieces = defaultdict(dict)
+    if refs:
+        for chunk_doc in get_all(refs):
+            if chunk_doc.exists:
+                chunk = chunk_doc.to_dict()
+                note_id = chunk_doc.reference.parent.parent.id
+                pieces[note_id][chunk["start"]] = zlib.decompress(chunk["data"]).decode("utf-8")
+
+    contents = {}
+    for note in notes:
+        if note.get("contentInfo"):
+            note_pieces = pieces[note["id"]]
+            contents[note["id"]] = "".join(note_pieces[start] for start in sorted(note_pieces))
+        else:
+            contents[note["id"]] = note.get("content") or ""
+    return contents
+
+
+def list_item(note):
+    """
+    Shape a note document for list responses, which carry a preview instead of the body
+    """
+    drop_internal_fields(note)
+    if note.get("contentInfo"):
+        length = note["contentInfo"]["length"]
+        note["content"] = note.pop("contentPreview", "")
+    else:
+        content = note.get("content") or ""
+        length = len(content)
+        note["content"] = content[:PREVIEW_CHARS]
+        # Notes written before the derived fields existed get them on the fly
+        if "excerpt" not in note:
+            note.update(derive_fields(content))
+
+    note["contentLength"] = length
+    note["contentTruncated"] = length > PREVIEW_CHARS
+    return note
+
+
+def summary_item(note):
+    """
+    Shape a note read with NOTE_SUMMARY_FIELDS for summary list responses
+    """
+    info = note.pop("contentInfo", None)
+    note["content"] = None
+    note["contentLength"] = info["length"] if info else None
+    note["contentTruncated"] = True
+    return note
+
+
+def full_item(note, content):
+    """
+    Shape a note document for single-note responses, which carry the whole body
+    """
+    drop_internal_fields(note)
+    note.pop("contentPreview", None)
+    note["content"] = content
+    note["contentLength"] = len(content)
+    note["contentTruncated"] = False
+    return note
+
+
+def select_for_view(query, view):
+    """
+    Limit a notes query to the summary fields when the summary view is requested
+    """
+    if view == "summary":
+        return query.select(NOTE_SUMMARY_FIELDS)
+    return query
+
+
+def shape_for_view(note, view):
+    if view == "summary":
+        return summary_item(note)
+    return list_item(note)
@@ -0,0 +1,102 @@
+from firebase_admin import firestore
+from firebase import db
+from datastore import read_document
+from utils import create_server_timestamp
+
+# Summary fields maintained on each subject document
+SUBJECT_STAT_FIELDS = ["noteCount", "contentSize", "lastNoteAt", "tagCounts"]
+
+
+def content_size(note):
+    """
+    Size in bytes of a note's content
+    """
+    if note.get("contentInfo"):
+        return note["contentInfo"]["bytes"]
+    return len((note.get("content") or "").encode("utf-8"))
+
+
+def tag_deltas(old_tags=None, new_tags=None):
+    """
+    Work out how each tag's usage count changes between two tag lists
+    """
+    deltas = {}
+    for tag in set(old_tags or []):
+        deltas[tag] = deltas.get(tag, 0) - 1
+    for tag in set(new_tags or []):
+        deltas[tag] = deltas.get(tag, 0) + 1
+    return {tag: delta for tag, delta in deltas.items() if delta != 0}
+
+
+def add_subject_stats(batch, subject_id, notes=0, size=0, tags=None):
+    """
+    Add counter increments for a subject to a write batch
+
+    The increments are applied atomically with the rest of the batch, so the
+    counters move together with the note writes that change them.
+    """
+    update = {"lastNoteAt": create_server_timestamp()}
+    if notes:
+        update["noteCount"] = firestore.Increment(notes)
+    if size:
+        update["contentSize"] = firestore.Increment(size)
+    for tag, delta in (tags or {}).items():
+        # Quote the tag so dots and other special characters stay in one segment
+        update[firestore.FieldPath("tagCounts", tag).to_api_repr()] = firestore.Increment(delta)
+
+    batch.update(db.collection("subjects").document(subject_id), update)
+
+
+def add_note_created(batch, note):
+    add_subject_stats(batch, note["subjectId"], notes=1, size=content_size(note), tags=tag_deltas(new_tags=note.get("tags")))
+
+
+def add_note_deleted(batch, note):
+    add_subject_stats(batch, note["subjectId"], notes=-1, size=-content_size(note), tags=tag_deltas(old_tags=note.get("tags")))
+
+
+def add_note_updated(batch, old_note, new_note, old_subject_exists=True):
+    """
+    Add counter changes for an edited note, including moves between subjects
+    """
+    if old_note.get("subjectId") == new_note["subjectId"]:
+        add_subject_stats(
+            batch,
+            new_note["subjectId"],
+            size=content_size(new_note) - content_size(old_note),
+            tags=tag_deltas(old_note.get("tags"), new_note.get("tags")),
+        )
+        return
+
+    if old_subject_exists:
+        add_note_deleted(batch, old_note)
+    add_note_created(batch, new_note)
+
+
+def subject_exists(subject_id):
+    """
+    Check whether a subject document is still present
+    """
+    if not subject_id:
+        return False
+    return read_document(db.collection("subjects").document(subject_id), field_paths=["createdBy"]).exists
+
+
+def recount_subject(subject_id):
+    """
+    Rebuild a subject's counters from its notes
+
+    Used to backfill subjects created before the counters were maintained.
+    """
+    query = db.collection("notes").where("subjectId", "==", subject_id).select(["content", "contentInfo", "tags"])
+
+    stats = {"noteCount": 0, "contentSize": 0, "tagCounts": {}}
+    for note_doc in query.stream():
+        note = note_doc.to_dict()
+        stats["noteCount"] += 1
+        stats["contentSize"] += content_size(note)
+        for tag in set(note.get("tags") or []):
+            stats["tagCounts"][tag] = stats["tagCounts"].get(tag, 0) + 1
+
+    db.collection("subjects").document(subject_id).update(stats)
+    return stats
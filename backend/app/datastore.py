@@ -0,0 +1,365 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from firebase_admin import firestore
+from google.api_core import exceptions as google_exceptions
+from firebase import db
+from cache import TTLCache
+from metrics import metrics
+
+# Total time a call may take, across all of its attempts
+CALL_DEADLINE_SECONDS = float(os.getenv("FIRESTORE_DEADLINE_SECONDS", "10"))
+MAX_ATTEMPTS = 4
+BACKOFF_BASE_SECONDS = 0.1
+BACKOFF_MAX_SECONDS = 2.0
+# A point read still running after the observed p95 latency, within these bounds, gets a second copy
+HEDGE_MIN_SECONDS = 0.05
+HEDGE_MAX_SECONDS = 1.0
+HEDGE_MIN_SAMPLES = 50
+# Consecutive failed calls that open the breaker, and how long it stays open before a trial call
+BREAKER_FAILURES = 5
+BREAKER_OPEN_SECONDS = 30
+# Last good results served while Firestore is unavailable
+STALE_TTL_SECONDS = 300
+# Share of calls allowed to fail, and the p95 latency calls should stay under
+ERROR_BUDGET = 0.01
+LATENCY_BUDGET_MS = 500
+
+# Errors that may clear up on their own; a write may or may not have been applied
+TRANSIENT_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+)
+# Errors that guarantee a write was not applied, so even non-idempotent writes can be retried
+NOT_APPLIED_ERRORS = (google_exceptions.Aborted,)
+
+
+class SingleFlight:
+    """
+    Share one in-flight call between concurrent callers asking for the same key
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, fn, *args):
+        future = self._calls.get(key)
+        if future is not None:
+            metrics.increment(f"{self.name}.coalesced")
+            return await asyncio.shield(future)
+
+        metrics.increment(f"{self.name}.calls")
+        pending = fn(*args) if asyncio.iscoroutinefunction(fn) else run_in_threadpool(fn, *args)
+        future = asyncio.ensure_future(pending)
+        self._calls[key] = future
+        future.add_done_callback(lambda done: self._release(key, done))
+        # Shield so one caller disconnecting doesn't cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def _release(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def forget(self, key):
+        """
+        Stop handing out an in-flight result, e.g. after the data was just written
+        """
+        self._calls.pop(key, None)
+
+
+class DatastoreUnavailable(HTTPException):
+    """
+    Firestore could not be reached in time; handlers pass it on as a 503
+    """
+
+    def __init__(self, detail="The database is temporarily unavailable, please try again shortly"):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail,
+            headers={"Retry-After": str(BREAKER_OPEN_SECONDS)},
+        )
+
+    def __str__(self):
+        return self.detail
+
+
+class CircuitBreaker:
+    """
+    Stop calling Firestore for a while after repeated failures, then let one trial call through
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, open_seconds=BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.failures = failures
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = "half-open"
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive = 0
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self.state == "half-open" or self.consecutive >= self.failures:
+                if self.state != "open":
+                    metrics.increment(f"{self.name}.breaker_opened")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker("firestore")
+
+
+def on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def call(name, fn, *args, idempotent=True, deadline=CALL_DEADLINE_SECONDS, **kwargs):
+    """
+    Run one Firestore call under a deadline, retrying transient errors with jittered backoff
+
+    fn must accept the client's retry and timeout arguments. Writes that are not
+    idempotent, e.g. ones with increments, are only retried when Firestore
+    reports they were not applied. Calls block, so async code runs them in the
+    threadpool; one made on the event loop itself gets a single attempt, since
+    sleeping between retries there would stall every other request.
+    """
+    if not breaker.allow():
+        metrics.increment(f"{name}.rejected")
+        raise DatastoreUnavailable()
+
+    retryable = TRANSIENT_ERRORS if idempotent else NOT_APPLIED_ERRORS
+    max_attempts = MAX_ATTEMPTS
+    if on_event_loop():
+        metrics.increment(f"{name}.on_event_loop")
+        max_attempts = 1
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = deadline - (time.monotonic() - started)
+        try:
+            # The client's own retries would run past our deadline, so they are turned off
+            result = fn(*args, retry=None, timeout=max(remaining, 0.001), **kwargs)
+        except TRANSIENT_ERRORS as error:
+            metrics.increment(f"{name}.errors")
+            # Full jitter keeps callers that failed together from retrying together
+            backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+            exhausted = attempt >= max_attempts or time.monotonic() - started + backoff >= deadline
+            if exhausted or not isinstance(error, retryable):
+                breaker.failure()
+                metrics.observe(name, time.monotonic() - started)
+                raise DatastoreUnavailable() from error
+            metrics.increment(f"{name}.retries")
+            time.sleep(backoff)
+            continue
+        except Exception:
+            # Firestore answered, e.g. with a failed precondition, so it is reachable
+            breaker.success()
+            raise
+        breaker.success()
+        metrics.observe(name, time.monotonic() - started)
+        return result
+
+
+def hedge_delay(name):
+    timing = metrics.timing(name)
+    if timing is None or timing["count"] < HEDGE_MIN_SAMPLES:
+        return HEDGE_MAX_SECONDS
+    return min(HEDGE_MAX_SECONDS, max(HEDGE_MIN_SECONDS, timing["p95Ms"] / 1000))
+
+
+def ignore_result(future):
+    if not future.cancelled():
+        future.exception()
+
+
+async def hedged_call(name, fn, *args):
+    """
+    Run a read, starting an identical second one if the first is slower than usual
+
+    Whichever answers first wins. Only used for point reads, which are cheap to
+    duplicate and where one slow replica is the usual cause of a slow call.
+    """
+    first = asyncio.ensure_future(run_in_threadpool(call, name, fn, *args))
+    done, _ = await asyncio.wait({first}, timeout=hedge_delay(name))
+    if done:
+        return first.result()
+
+    metrics.increment(f"{name}.hedged")
+    second = asyncio.ensure_future(run_in_threadpool(call, name, fn, *args))
+    done, pending = await asyncio.wait({first, second}, return_when=asyncio.FIRST_COMPLETED)
+    winner = done.pop()
+    if winner.exception() is not None and pending:
+        winner = pending.pop()
+        await asyncio.wait({winner})
+    else:
+        for loser in pending:
+            loser.add_done_callback(ignore_result)
+    return winner.result()
+
+
+document_reads = SingleFlight("firestore.document")
+query_reads = SingleFlight("firestore.query")
+stale_documents = TTLCache(maxsize=2000, ttl=STALE_TTL_SECONDS)
+stale_queries = TTLCache(maxsize=500, ttl=STALE_TTL_SECONDS)
+
+
+async def get_document(collection, doc_id):
+    """
+    Read one document, coalescing concurrent reads of the same document
+
+    Slow reads are hedged, and while Firestore is unavailable the last good copy
+    of the document is served for a few minutes.
+    """
+    key = (collection, doc_id)
+    doc_ref = db.collection(collection).document(doc_id)
+    try:
+        doc = await document_reads.do(key, hedged_call, "firestore.get", doc_ref.get)
+    except DatastoreUnavailable:
+        doc = stale_documents.get(key)
+        if doc is None:
+            raise
+        metrics.increment("firestore.get.degraded")
+        return doc
+    stale_documents.set(key, doc)
+    return doc
+
+
+async def run_query(key, query):
+    """
+    Run a query, coalescing concurrent runs that share the same key
+
+    The key must identify the query completely, e.g. its collection, filters and order.
+    While Firestore is unavailable the last good result is served for a few minutes.
+    """
+    try:
+        docs = await query_reads.do(key, call, "firestore.query", query.get)
+    except DatastoreUnavailable:
+        docs = stale_queries.get(key)
+        if docs is None:
+            raise
+        metrics.increment("firestore.query.degraded")
+        return docs
+    stale_queries.set(key, docs)
+    return docs
+
+
+def read_document(ref, field_paths=None):
+    """
+    Read one document directly, without coalescing or stale copies, e.g. right after writing it
+    """
+    return call("firestore.get", ref.get, field_paths=field_paths)
+
+
+def get_all(refs, field_paths=None):
+    """
+    Read many documents in one call, with the same deadline and retries as single reads
+    """
+    if not refs:
+        return []
+    return call("firestore.get_all", lambda **options: list(db.get_all(refs, field_paths=field_paths, **options)))
+
+
+def commit(batch, idempotent=False):
+    """
+    Commit a write batch with a deadline, retrying only when that cannot apply it twice
+    """
+    return call("firestore.commit", batch.commit, idempotent=idempotent)
+
+
+def firestore_health():
+    """
+    Breaker state and how each kind of call is doing against the error and latency budgets
+    """
+    snapshot = metrics.snapshot()
+    calls = {}
+    for name, timing in snapshot["timings"].items():
+        if not name.startswith("firestore."):
+            continue
+        errors = snapshot["counters"].get(f"{name}.errors", 0)
+        error_rate = errors / (timing["count"] + errors) if timing["count"] + errors else 0.0
+        calls[name] = {
+            "errorRate": round(error_rate, 4),
+            "errorBudgetUsed": round(error_rate / ERROR_BUDGET, 2),
+            "p95Ms": timing["p95Ms"],
+            "withinLatencyBudget": timing["p95Ms"] <= LATENCY_BUDGET_MS,
+        }
+    return {"breaker": breaker.state, "calls": calls}
+
+
+def forget_document(collection, doc_id):
+    """
+    Make the next read of a document start fresh after it has been written
+    """
+    document_reads.forget((collection, doc_id))
+    stale_documents.invalidate((collection, doc_id))
+
+
+def forget_query(key):
+    """
+    Make the next run of a query start fresh after its results were changed
+    """
+    query_reads.forget(key)
+    stale_queries.invalidate(key)
+
+
+def forget_subject_notes(subject_id):
+    """
+    Make the next listing of a subject's notes start fresh, in every view
+    """
+    for view in ("preview", "summary"):
+        forget_query(("notes", "subjectId", subject_id, view))
+
+
+def iter_query_pages(query, page_size=500):
+    """
+    Iterate over every result of a query, one bounded page at a time
+
+    Each page is a separate request resuming after the last document, so long
+    exports don't depend on a single stream staying open.
+    """
+    query = query.order_by(firestore.FieldPath.document_id())
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        docs = call("firestore.query", lambda **options: list(page.limit(page_size).stream(**options)))
+        if docs:
+            yield docs
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def iter_query(query, page_size=500):
+    """
+    Iterate over every result of a query, reading it page by page
+    """
+    for docs in iter_query_pages(query, page_size):
+        yield from docs
@@ -0,0 +1,140 @@
+from firebase import db
+from datastore import get_all
+from utils import create_server_timestamp, BatchWriter
+
+# Lower-cased email -> uid of the account that verified it
+RECIPIENTS_COLLECTION = "recipients"
+# One document per user an item is shared with, keyed by item and uid
+GRANTS_COLLECTION = "grants"
+# Shares addressed to emails that have no account yet, turned into grants at sign-up
+INVITES_COLLECTION = "invites"
+
+
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+
+def verified_email(current_user):
+    """
+    The user's normalized email if the sign-in provider verified it, else an empty string
+
+    An unverified email may belong to someone else, so it never grants access to what is shared with it.
+    """
+    if not current_user.get("emailVerified"):
+        return ""
+    return normalize_email(current_user.get("email"))
+
+
+def normalize_emails(emails):
+    return list(dict.fromkeys(email for email in map(normalize_email, emails or []) if email))
+
+
+def grant_id(item_type, item_id, uid):
+    return f"{item_type}:{item_id}:{uid}"
+
+
+def grant_ref(item_type, item_id, uid):
+    return db.collection(GRANTS_COLLECTION).document(grant_id(item_type, item_id, uid))
+
+
+def invite_ref(item_type, item_id, email):
+    return db.collection(INVITES_COLLECTION).document(f"{item_type}:{item_id}:{email}")
+
+
+def resolve_recipients(emails):
+    """
+    Look up the accounts behind a list of normalized emails, with one multi-document read
+    """
+    refs = [db.collection(RECIPIENTS_COLLECTION).document(email) for email in emails]
+    return {doc.id: doc.get("uid") for doc in get_all(refs) if doc.exists}
+
+
+def item_grant_docs(item_type, item_id):
+    """
+    Existing grant and invite documents of an item
+    """
+    docs = []
+    for collection in (GRANTS_COLLECTION, INVITES_COLLECTION):
+        query = db.collection(collection).where("itemId", "==", item_id)
+        docs.extend(doc for doc in query.stream() if doc.get("itemType") == item_type)
+    return docs
+
+
+def add_grant_sync(batch, item_type, item_id, owner_id, emails, permissions=None):
+    """
+    Bring an item's grants and invites in line with the emails it is shared with
+
+    Only the differences are written, so running it again changes nothing.
+    Returns the uids of the accounts that had or now have a grant.
+    """
+    emails = normalize_emails(emails)
+    uids = resolve_recipients(emails)
+    recipients = set(uids.values())
+    wanted = {}
+    for email in emails:
+        if email in uids:
+            ref = grant_ref(item_type, item_id, uids[email])
+            wanted[ref.path] = (ref, {"uid": uids[email], "email": email})
+        else:
+            ref = invite_ref(item_type, item_id, email)
+            wanted[ref.path] = (ref, {"email": email})
+
+    for doc in item_grant_docs(item_type, item_id):
+        if doc.reference.path not in wanted:
+            batch.delete(doc.reference)
+            # Invites have no uid yet
+            if doc.to_dict().get("uid"):
+                recipients.add(doc.to_dict()["uid"])
+        elif doc.get("permissions") == permissions:
+            del wanted[doc.reference.path]
+
+    for ref, fields in wanted.values():
+        fields.update({
+            "itemType": item_type,
+            "itemId": item_id,
+            "ownerId": owner_id,
+            "permissions": permissions,
+            "grantedAt": create_server_timestamp(),
+        })
+        batch.set(ref, fields)
+    return recipients
+
+
+def add_grant_deletes(batch, item_type, item_id):
+    """
+    Remove every grant and invite of a deleted item
+    """
+    for doc in item_grant_docs(item_type, item_id):
+        batch.delete(doc.reference)
+
+
+def claim_recipient(uid, email):
+    """
+    Point a verified email at its account and turn the invites waiting for it into grants
+
+    Returns how many invites were resolved.
+    """
+    email = normalize_email(email)
+    writer = BatchWriter(db)
+    writer.set(db.collection(RECIPIENTS_COLLECTION).document(email), {
+        "uid": uid,
+        "email": email,
+        "updatedAt": create_server_timestamp(),
+    })
+
+    resolved = 0
+    for invite_doc in db.collection(INVITES_COLLECTION).where("email", "==", email).stream():
+        invite = invite_doc.to_dict()
+        writer.set(grant_ref(invite["itemType"], invite["itemId"], uid), {
+            "uid": uid,
+            "email": email,
+            "itemType": invite["itemType"],
+            "itemId": invite["itemId"],
+            "ownerId": invite.get("ownerId"),
+            "permissions": invite.get("permissions"),
+            "grantedAt": create_server_timestamp(),
+        })
+        writer.delete(invite_doc.reference)
+        resolved += 1
+    writer.commit()
+    return resolved
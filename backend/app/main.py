@@ -1,14 +1,33 @@
+import asyncio
 import uvicorn
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import os
 from dotenv import load_dotenv
+from metrics import metrics
+from datastore import firestore_health
+from outbox import worker_pool
+from rate_limit import rate_limit, public_rate_limit
+from middleware import require_admin
+from profiler import ProfilerMiddleware, RequestThreadPool
+import outbox_handlers  # registers the outbox event handlers
 
 # Import routers
 from routers.subjects import router as subjects_router
 from routers.notes import router as notes_router
 from routers.shares import router as shares_router
 from routers.tags import router as tags_router
+from routers.dashboard import router as dashboard_router
+from routers.events import router as events_router
+from routers.sync import router as sync_router
+from routers.revisions import router as revisions_router
+from routers.library import router as library_router
+from routers.related import router as related_router
+from routers.duplicates import router as duplicates_router
+from routers.public import router as public_router
+from routers.recipients import router as recipients_router
+from routers.profiler import router as profiler_router
+from routers.attachments import router as attachments_router, download_router as attachment_downloads_router
 
 # Load environment variables
 load_dotenv()
@@ -27,17 +46,53 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Times requests for the sampling profiler; a no-op while it is switched off
+app.add_middleware(ProfilerMiddleware)
 
-# Include routers
-app.include_router(subjects_router, prefix="/api/subjects", tags=["subjects"])
-app.include_router(notes_router, prefix="/api/notes", tags=["notes"])
-app.include_router(shares_router, prefix="/api/shares", tags=["shares"])
-app.include_router(tags_router, prefix="/api/tags", tags=["tags"])
+# Include routers; every authenticated route is rate limited per user
+limited = [Depends(rate_limit)]
+# Routes open to anyone are limited per client address instead
+public_limited = [Depends(public_rate_limit)]
+app.include_router(subjects_router, prefix="/api/subjects", tags=["subjects"], dependencies=limited)
+app.include_router(notes_router, prefix="/api/notes", tags=["notes"], dependencies=limited)
+app.include_router(revisions_router, prefix="/api/notes", tags=["revisions"], dependencies=limited)
+app.include_router(related_router, prefix="/api/notes", tags=["related"], dependencies=limited)
+app.include_router(shares_router, prefix="/api/shares", tags=["shares"], dependencies=limited)
+app.include_router(tags_router, prefix="/api/tags", tags=["tags"], dependencies=limited)
+app.include_router(dashboard_router, prefix="/api/dashboard", tags=["dashboard"], dependencies=limited)
+app.include_router(events_router, prefix="/api/events", tags=["events"], dependencies=limited)
+app.include_router(sync_router, prefix="/api/sync", tags=["sync"], dependencies=limited)
+app.include_router(library_router, prefix="/api", tags=["library"], dependencies=limited)
+app.include_router(duplicates_router, prefix="/api", tags=["duplicates"], dependencies=limited)
+app.include_router(public_router, prefix="/api/public", tags=["public"], dependencies=public_limited)
+app.include_router(recipients_router, prefix="/api/recipients", tags=["recipients"], dependencies=limited)
+app.include_router(profiler_router, prefix="/api/admin/profiler", tags=["admin"], dependencies=limited)
+app.include_router(attachments_router, prefix="/api/attachments", tags=["attachments"], dependencies=limited)
+app.include_router(attachment_downloads_router, prefix="/api/attachments", tags=["attachments"])
+
+@app.on_event("startup")
+async def start_outbox_workers():
+    worker_pool.start()
+
+@app.on_event("startup")
+async def use_request_thread_pool():
+    # Lets the profiler tell which request each threadpool thread is working for
+    asyncio.get_event_loop().set_default_executor(RequestThreadPool())
+
+@app.on_event("shutdown")
+async def stop_outbox_workers():
+    await worker_pool.stop()
 
 @app.get("/api/health")
 async def health_check():
     return {"status": "ok"}
 
+@app.get("/api/metrics", dependencies=[Depends(require_admin)])
+async def get_metrics():
+    snapshot = metrics.snapshot()
+    snapshot["firestore"] = firestore_health()
+    return snapshot
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
     uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True) 
\ No newline at end of file
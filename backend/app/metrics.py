@@ -0,0 +1,82 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# Upper bounds, in milliseconds, of the latency histogram buckets
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class Timing:
+    """
+    Count, total, max and a bucketed histogram for one latency series
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def percentile(self, fraction):
+        """
+        Approximate a percentile as the upper bound of the bucket it falls in
+        """
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return float(LATENCY_BUCKETS_MS[index]) if index < len(LATENCY_BUCKETS_MS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "avgMs": round(self.total / self.count, 2) if self.count else 0.0,
+            "maxMs": round(self.max, 2),
+            "p50Ms": self.percentile(0.5),
+            "p95Ms": self.percentile(0.95),
+            "p99Ms": self.percentile(0.99),
+        }
+
+
+class Metrics:
+    """
+    In-process counters and latency timings, readable through /api/metrics
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(Timing)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.timings[name].observe(seconds)
+
+    def timing(self, name):
+        with self._lock:
+            return self.timings[name].to_dict() if name in self.timings else None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "timings": {name: timing.to_dict() for name, timing in self.timings.items()},
+            }
+
+
+metrics = Metrics()
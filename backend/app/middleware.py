@@ -1,9 +1,13 @@
+import os
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from firebase import verify_id_token
 
 security = HTTPBearer()
 
+# Users allowed into the admin endpoints besides those with an admin custom claim
+ADMIN_UIDS = {uid.strip() for uid in os.getenv("ADMIN_UIDS", "").split(",") if uid.strip()}
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
     Dependency to get the current user from the Firebase ID token
@@ -21,5 +25,19 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     return {
         "uid": decoded_token["uid"],
         "email": decoded_token.get("email", ""),
-        "name": decoded_token.get("name", "")
-    } 
\ No newline at end of file
+        "emailVerified": decoded_token.get("email_verified", False),
+        "name": decoded_token.get("name", ""),
+        "admin": decoded_token.get("admin", False) or decoded_token["uid"] in ADMIN_UIDS
+    }
+
+
+async def require_admin(current_user=Depends(get_current_user)):
+    """
+    Dependency that only lets administrators through
+    """
+    if not current_user["admin"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Administrator access required"
+        )
+    return current_user
@@ -0,0 +1,215 @@
+import hashlib
+import zlib
+import numpy as np
+from firebase_admin import firestore
+from firebase import db
+from datastore import get_all
+from note_text import plain_text
+
+# Signature length; split into BANDS bands of ROWS values for locality-sensitive hashing.
+# Two notes share at least one band with probability 1 - (1 - s^ROWS)^BANDS for
+# Jaccard similarity s, which crosses 50% at about s = 0.7.
+NUM_PERM = 128
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# Estimated Jaccard similarity from which two notes count as near-duplicates
+DUPLICATE_THRESHOLD = 0.8
+SHINGLE_WORDS = 5
+
+MERSENNE_PRIME = (1 << 31) - 1
+# Fixed seed: stored signatures are only comparable under the same permutations
+_random = np.random.RandomState(20240901)
+PERM_A = _random.randint(1, MERSENNE_PRIME, size=NUM_PERM, dtype=np.uint64)
+PERM_B = _random.randint(0, MERSENNE_PRIME, size=NUM_PERM, dtype=np.uint64)
+
+BUCKETS_COLLECTION = "lsh_buckets"
+PUBLIC_SCOPE = "public"
+
+
+def shingles(text):
+    words = text.lower().split()
+    if len(words) <= SHINGLE_WORDS:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[start:start + SHINGLE_WORDS]) for start in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def signature(text):
+    """
+    MinHash signature of a text's word shingles, or None for empty text
+    """
+    shingle_set = shingles(text)
+    if not shingle_set:
+        return None
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingle_set), dtype=np.uint64, count=len(shingle_set))
+    hashes %= MERSENNE_PRIME
+    # (a * h + b) mod p for every permutation and shingle; products stay below 2^62
+    permuted = (np.outer(PERM_A, hashes) + PERM_B[:, None]) % MERSENNE_PRIME
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def band_keys(sig):
+    return [
+        f"{band:02d}-{hashlib.blake2b(sig[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).hexdigest()}"
+        for band in range(BANDS)
+    ]
+
+
+def minhash_fields(content):
+    """
+    Signature and LSH bucket keys stored on a note when its content is written
+    """
+    sig = signature(plain_text(content))
+    if sig is None:
+        return {"minhash": None, "lshBuckets": []}
+    return {"minhash": sig.astype("<u4").tobytes(), "lshBuckets": band_keys(sig)}
+
+
+def similarity(minhash_a, minhash_b):
+    """
+    Estimated Jaccard similarity of two stored signatures
+    """
+    if not minhash_a or not minhash_b:
+        return 0.0
+    return float(np.mean(np.frombuffer(minhash_a, dtype="<u4") == np.frombuffer(minhash_b, dtype="<u4")))
+
+
+def note_scopes(note):
+    """
+    Indexes a note belongs to: its owner's, and the public one while it is shared publicly
+    """
+    scopes = [note["createdBy"]]
+    if note.get("shareType") == "public":
+        scopes.append(PUBLIC_SCOPE)
+    return scopes
+
+
+def bucket_ref(scope, key):
+    return db.collection(BUCKETS_COLLECTION).document(f"{scope}:{key}")
+
+
+def add_bucket_writes(batch, scopes, note_id, old_keys=None, new_keys=None):
+    """
+    Move a note between LSH buckets in the same batch as the write that changed its keys
+    """
+    old_keys, new_keys = set(old_keys or []), set(new_keys or [])
+    for scope in scopes:
+        for key in new_keys - old_keys:
+            batch.set(bucket_ref(scope, key), {
+                "scope": scope,
+                "noteIds": firestore.ArrayUnion([note_id]),
+                "size": firestore.Increment(1),
+            }, merge=True)
+        for key in old_keys - new_keys:
+            batch.set(bucket_ref(scope, key), {
+                "scope": scope,
+                "noteIds": firestore.ArrayRemove([note_id]),
+                "size": firestore.Increment(-1),
+            }, merge=True)
+
+
+def add_bucket_removals(batch, scopes, note_id, keys):
+    """
+    Take a deleted note out of the buckets that still list it
+
+    Checking membership first keeps the size counters right when a cleanup is retried.
+    """
+    refs = [bucket_ref(scope, key) for scope in scopes for key in set(keys or [])]
+    for bucket_doc in get_all(refs):
+        if bucket_doc.exists and note_id in (bucket_doc.get("noteIds") or []):
+            batch.set(bucket_doc.reference, {
+                "noteIds": firestore.ArrayRemove([note_id]),
+                "size": firestore.Increment(-1),
+            }, merge=True)
+
+
+def verified_pairs(candidate_groups, signatures):
+    """
+    Pairs of notes sharing a bucket whose signatures are similar enough, with their similarity
+    """
+    pairs = {}
+    for note_ids in candidate_groups:
+        ids = sorted(note_id for note_id in set(note_ids) if note_id in signatures)
+        for i, first in enumerate(ids):
+            for second in ids[i + 1:]:
+                if (first, second) not in pairs:
+                    pairs[(first, second)] = similarity(signatures[first], signatures[second])
+    return {pair: score for pair, score in pairs.items() if score >= DUPLICATE_THRESHOLD}
+
+
+def fetch_signatures(note_ids):
+    refs = [db.collection("notes").document(note_id) for note_id in note_ids]
+    notes = {}
+    for note_doc in get_all(refs, field_paths=["minhash", "title", "subjectId", "createdBy", "shareType"]):
+        if note_doc.exists:
+            notes[note_doc.id] = note_doc.to_dict()
+    return notes
+
+
+def find_clusters(uid):
+    """
+    Groups of a user's notes that are near-duplicates of each other
+
+    Only buckets holding two or more notes are read, so the cost depends on how
+    many collisions there are rather than on the size of the library.
+    """
+    query = db.collection(BUCKETS_COLLECTION).where("scope", "==", uid).where("size", ">=", 2)
+    groups = [bucket_doc.get("noteIds") or [] for bucket_doc in query.stream()]
+    notes = fetch_signatures({note_id for group in groups for note_id in group})
+    pairs = verified_pairs(groups, {note_id: note.get("minhash") for note_id, note in notes.items()})
+
+    parent = {}
+
+    def root(note_id):
+        while parent.setdefault(note_id, note_id) != note_id:
+            parent[note_id] = parent[parent[note_id]]
+            note_id = parent[note_id]
+        return note_id
+
+    for first, second in pairs:
+        parent[root(first)] = root(second)
+
+    clusters = {}
+    for note_id in parent:
+        clusters.setdefault(root(note_id), []).append(note_id)
+
+    result = []
+    for members in clusters.values():
+        member_pairs = [score for (first, second), score in pairs.items() if first in members and second in members]
+        result.append({
+            "notes": [{"id": note_id, "title": notes[note_id].get("title"), "subjectId": notes[note_id].get("subjectId")} for note_id in sorted(members)],
+            "similarity": round(min(member_pairs), 4),
+        })
+    result.sort(key=lambda cluster: -len(cluster["notes"]))
+    return result
+
+
+def find_duplicates(note_id, note, scope):
+    """
+    Near-duplicates of one note in a user's or the public index, most similar first
+    """
+    keys = note.get("lshBuckets") or []
+    if not keys:
+        return []
+
+    candidates = set()
+    for bucket_doc in get_all([bucket_ref(scope, key) for key in keys]):
+        if bucket_doc.exists:
+            candidates.update(bucket_doc.get("noteIds") or [])
+    candidates.discard(note_id)
+
+    matches = []
+    for candidate_id, candidate in fetch_signatures(candidates).items():
+        # Bucket membership trails sharing changes slightly, so check the note is still public
+        if scope == PUBLIC_SCOPE and candidate.get("shareType") != "public":
+            continue
+        score = similarity(note.get("minhash"), candidate.get("minhash"))
+        if score >= DUPLICATE_THRESHOLD:
+            matches.append({
+                "id": candidate_id,
+                "title": candidate.get("title"),
+                "subjectId": candidate.get("subjectId"),
+                "createdBy": candidate.get("createdBy"),
+                "similarity": round(score, 4),
+            })
+    matches.sort(key=lambda match: -match["similarity"])
+    return matches
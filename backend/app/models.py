@@ -7,6 +7,8 @@ class User(BaseModel):
     uid: str
     email: str
     name: Optional[str] = None
+    emailVerified: Optional[bool] = False
+    admin: Optional[bool] = False
 
 
 class SubjectBase(BaseModel):
@@ -15,7 +17,7 @@ class SubjectBase(BaseModel):
 
 
 class SubjectCreate(SubjectBase):
-    pass
+    parentId: Optional[str] = None
 
 
 class Subject(SubjectBase):
@@ -23,16 +25,37 @@ class Subject(SubjectBase):
     createdBy: str
     createdAt: Any  # Firestore timestamp
     updatedAt: Optional[Any] = None
+    noteCount: Optional[int] = None
+    contentSize: Optional[int] = None
+    lastNoteAt: Optional[Any] = None
+    tagCounts: Optional[Dict[str, int]] = None
+    parentId: Optional[str] = None
+    ancestors: List[str] = []
+    depth: int = 0
 
     class Config:
         orm_mode = True
 
 
+class SubjectMove(BaseModel):
+    parentId: Optional[str] = None  # None moves the subject to the top level
+
+
+class SubjectTree(BaseModel):
+    subject: Subject
+    descendants: List[Subject] = []
+    noteCount: int = 0
+    contentSize: int = 0
+
+
 class MediaItem(BaseModel):
     type: str  # 'image', 'video', 'file', 'link'
     url: str
     title: Optional[str] = None
     createdAt: Optional[Any] = None
+    # Set for files uploaded through /api/attachments
+    attachmentId: Optional[str] = None
+    sha256: Optional[str] = None
 
 
 class NoteBase(BaseModel):
@@ -49,6 +72,13 @@ class NoteCreate(NoteBase):
 
 class Note(NoteBase):
     id: str
+    content: Optional[str] = None  # Only a preview in list responses
+    contentLength: Optional[int] = None
+    contentTruncated: Optional[bool] = False
+    excerpt: Optional[str] = None
+    wordCount: Optional[int] = None
+    readingTimeMinutes: Optional[int] = None
+    outline: Optional[List[Dict[str, Any]]] = None
     createdBy: str
     createdAt: Any  # Firestore timestamp
     updatedAt: Optional[Any] = None
@@ -60,6 +90,10 @@ class Note(NoteBase):
         orm_mode = True
 
 
+class RelatedNote(Note):
+    score: float
+
+
 class ShareBase(BaseModel):
     itemId: str
     itemType: str  # 'subject' or 'note'
@@ -86,4 +120,125 @@ class Share(ShareBase):
     updatedAt: Optional[Any] = None
 
     class Config:
-        orm_mode = True 
\ No newline at end of file
+        orm_mode = True 
+
+class Dashboard(BaseModel):
+    subjects: List[Subject]
+    recentNotes: List[Note]
+    tags: List[str]
+    sharedWithMe: List[Share]
+
+
+class Tombstone(BaseModel):
+    itemId: str
+    itemType: str
+    updatedAt: Any  # Firestore timestamp
+
+
+class SyncPage(BaseModel):
+    subjects: List[Subject] = []
+    notes: List[Note] = []
+    deleted: List[Tombstone] = []
+    nextToken: Optional[str] = None
+    hasMore: bool = False
+    resetRequired: bool = False
+
+
+class BatchGetRequest(BaseModel):
+    ids: List[str]
+
+
+class SubjectBatchResult(BaseModel):
+    found: List[Subject] = []
+    forbidden: List[str] = []
+    missing: List[str] = []
+
+
+class NoteBatchResult(BaseModel):
+    found: List[Note] = []
+    forbidden: List[str] = []
+    missing: List[str] = []
+
+
+class Revision(BaseModel):
+    number: int
+    kind: str  # 'snapshot' or 'delta'
+    length: int
+    savedAt: Optional[Any] = None
+    replacedAt: Optional[Any] = None
+    createdBy: Optional[str] = None
+
+
+class RevisionContent(Revision):
+    content: str
+
+
+class TagRename(BaseModel):
+    tag: str
+    newTag: str
+
+
+class TagMerge(BaseModel):
+    tags: List[str]
+    into: str
+
+
+class TagSuggestion(BaseModel):
+    tag: str
+    count: int
+
+
+class TagOperationResult(BaseModel):
+    matched: int = 0
+    updated: int = 0
+    batches: int = 0
+    done: bool = False
+
+
+class DuplicateNote(BaseModel):
+    id: str
+    title: Optional[str] = None
+    subjectId: Optional[str] = None
+    createdBy: Optional[str] = None
+    similarity: Optional[float] = None
+
+
+class DuplicateCluster(BaseModel):
+    notes: List[DuplicateNote]
+    similarity: float
+
+
+class RecipientClaim(BaseModel):
+    email: str
+    resolved: int = 0
+
+
+class ProfilerSettings(BaseModel):
+    enabled: bool
+    intervalMs: Optional[float] = Field(None, ge=1, le=1000)
+    slowMs: Optional[float] = Field(None, ge=0)
+
+
+class UploadCreate(BaseModel):
+    name: str
+    contentType: str = "application/octet-stream"
+    size: int = Field(..., ge=0)
+    # When given and the user already stored this content, the upload finishes without sending it
+    sha256: Optional[str] = Field(None, regex="^[0-9a-f]{64}$")
+
+
+class Attachment(BaseModel):
+    id: str
+    name: str
+    contentType: str
+    size: int
+    sha256: str
+    downloadPath: str
+    createdAt: Optional[Any] = None
+
+
+class UploadStatus(BaseModel):
+    id: Optional[str] = None
+    size: int
+    received: int
+    attachment: Optional[Attachment] = None
@@ -0,0 +1,94 @@
+import math
+import re
+from html.parser import HTMLParser
+
+EXCERPT_CHARS = 280
+WORDS_PER_MINUTE = 200
+MAX_OUTLINE_ENTRIES = 50
+
+HEADING_TAGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+SKIPPED_TAGS = {"script", "style", "template", "noscript"}
+# Tags that break words apart when the markup is flattened to text
+BLOCK_TAGS = {
+    "p", "div", "br", "li", "ul", "ol", "tr", "td", "th", "table", "blockquote",
+    "pre", "section", "article", "header", "footer", "hr",
+} | set(HEADING_TAGS)
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class TextExtractor(HTMLParser):
+    """
+    Single pass over note HTML that collects visible text and headings
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.outline = []
+        self.skipping = 0
+        self.heading_level = None
+        self.heading_parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skipping += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append(" ")
+        if tag in HEADING_TAGS:
+            self.heading_level = HEADING_TAGS[tag]
+            self.heading_parts = []
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS and self.skipping:
+            self.skipping -= 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append(" ")
+        if tag in HEADING_TAGS and self.heading_level is not None:
+            text = WHITESPACE.sub(" ", "".join(self.heading_parts)).strip()
+            if text and len(self.outline) < MAX_OUTLINE_ENTRIES:
+                self.outline.append({"level": self.heading_level, "text": text})
+            self.heading_level = None
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        self.parts.append(data)
+        if self.heading_level is not None:
+            self.heading_parts.append(data)
+
+
+def extract(html):
+    """
+    Flatten note HTML to whitespace-normalized plain text plus its heading outline
+    """
+    extractor = TextExtractor()
+    extractor.feed(html or "")
+    extractor.close()
+    return WHITESPACE.sub(" ", "".join(extractor.parts)).strip(), extractor.outline
+
+
+def plain_text(html):
+    return extract(html)[0]
+
+
+def make_excerpt(text, limit=EXCERPT_CHARS):
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(" ", 0, limit)
+    return text[:cut if cut > 0 else limit].rstrip() + "…"
+
+
+def derive_fields(html):
+    """
+    Compute the list-view fields stored on a note when its content is written
+    """
+    text, outline = extract(html)
+    word_count = len(text.split())
+
+    return {
+        "excerpt": make_excerpt(text),
+        "wordCount": word_count,
+        "readingTimeMinutes": math.ceil(word_count / WORDS_PER_MINUTE) if word_count else 0,
+        "outline": outline,
+    }
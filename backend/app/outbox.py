@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from fastapi.concurrency import run_in_threadpool
+from firebase_admin import firestore
+from firebase import db
+from utils import create_server_timestamp
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_COLLECTION = "outbox"
+DEAD_LETTER_COLLECTION = "outbox_dead"
+
+WORKER_COUNT = int(os.getenv("OUTBOX_WORKERS", "4"))
+# Events fetched per poll
+POLL_LIMIT = 20
+# How long the poller sleeps when nothing wakes it up
+POLL_INTERVAL_SECONDS = 5
+# A claimed event becomes visible to other workers again after this long
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 2
+RETRY_MAX_SECONDS = 300
+
+# Event kind -> function(payload) run in a worker thread
+HANDLERS = {}
+
+
+def handler(kind):
+    """
+    Register the function that applies events of a given kind
+
+    Handlers may run more than once for the same event, so they must be
+    idempotent: recompute from the source of truth or only delete things.
+    """
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def add_event(batch, kind, payload, key):
+    """
+    Queue a change event in the same batch as the write that caused it
+
+    The idempotency key is the event's document id. Events for the same key
+    collapse into one, and a pending event that is re-added is processed again
+    even if a worker is already busy with the older copy.
+    """
+    batch.set(db.collection(OUTBOX_COLLECTION).document(key), {
+        "kind": kind,
+        "payload": payload,
+        "token": uuid.uuid4().hex,
+        "attempts": 0,
+        "availableAt": utcnow(),
+        "createdAt": create_server_timestamp(),
+    })
+    return key
+
+
+def retry_delay(attempts):
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+@firestore.transactional
+def claim_event(transaction, event_ref):
+    """
+    Lease an event to this worker, or return None if it is gone or already leased
+    """
+    snapshot = event_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    event = snapshot.to_dict()
+    now = utcnow()
+    if event["availableAt"] > now:
+        return None
+
+    token = uuid.uuid4().hex
+    event["token"] = token
+    event["attempts"] = event.get("attempts", 0) + 1
+    transaction.update(event_ref, {
+        "token": token,
+        "attempts": event["attempts"],
+        "availableAt": now + timedelta(seconds=LEASE_SECONDS),
+    })
+    return event
+
+
+@firestore.transactional
+def complete_event(transaction, event_ref, token):
+    # Only remove the copy that was processed; a re-added event keeps its new token
+    snapshot = event_ref.get(transaction=transaction)
+    if snapshot.exists and snapshot.get("token") == token:
+        transaction.delete(event_ref)
+
+
+@firestore.transactional
+def fail_event(transaction, event_ref, event, error):
+    snapshot = event_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.get("token") != event["token"]:
+        return False
+
+    if event["attempts"] >= MAX_ATTEMPTS:
+        dead = dict(snapshot.to_dict(), lastError=error, failedAt=create_server_timestamp())
+        transaction.set(db.collection(DEAD_LETTER_COLLECTION).document(event_ref.id), dead)
+        transaction.delete(event_ref)
+        return True
+
+    transaction.update(event_ref, {
+        "lastError": error,
+        "availableAt": utcnow() + timedelta(seconds=retry_delay(event["attempts"])),
+    })
+    return False
+
+
+def due_event_refs(limit=POLL_LIMIT):
+    query = db.collection(OUTBOX_COLLECTION).where("availableAt", "<=", utcnow()).order_by("availableAt").limit(limit)
+    return [event_doc.reference for event_doc in query.select([]).get()]
+
+
+def process_event(event_ref):
+    """
+    Claim and apply one event; runs in a worker thread
+    """
+    event = claim_event(db.transaction(), event_ref)
+    if event is None:
+        return
+
+    fn = HANDLERS.get(event["kind"])
+    try:
+        if fn is None:
+            raise LookupError(f"No handler for outbox event {event['kind']}")
+        fn(event["payload"])
+    except Exception as e:
+        logger.warning("Outbox event %s failed (attempt %s): %s", event_ref.id, event["attempts"], e)
+        metrics.increment("outbox.failed")
+        if fail_event(db.transaction(), event_ref, event, str(e)):
+            metrics.increment("outbox.dead")
+        return
+
+    complete_event(db.transaction(), event_ref, event["token"])
+    metrics.increment("outbox.processed")
+    if event.get("createdAt"):
+        metrics.observe("outbox.lag", (utcnow() - event["createdAt"]).total_seconds())
+
+
+class OutboxWorkerPool:
+    """
+    Drains the outbox in the background with a poller feeding a few workers
+    """
+
+    def __init__(self, workers=WORKER_COUNT):
+        self.workers = workers
+        self.loop = None
+        self.queue = None
+        self.wakeup = None
+        self.queued = set()
+        self.tasks = []
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        self.wakeup = asyncio.Event()
+        self.tasks = [self.loop.create_task(self.poll())]
+        self.tasks += [self.loop.create_task(self.work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def wake(self):
+        """
+        Poll right away instead of waiting for the next interval, e.g. after a request queued events
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def poll(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                for event_ref in await run_in_threadpool(due_event_refs):
+                    if event_ref.id not in self.queued:
+                        self.queued.add(event_ref.id)
+                        self.queue.put_nowait(event_ref)
+            except Exception as e:
+                logger.warning("Outbox poll failed: %s", e)
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def work(self):
+        while True:
+            event_ref = await self.queue.get()
+            try:
+                await run_in_threadpool(process_event, event_ref)
+            except Exception as e:
+                logger.warning("Outbox event %s could not be processed: %s", event_ref.id, e)
+            finally:
+                self.queued.discard(event_ref.id)
+                if self.queue.empty():
+                    # Events retried soon or added meanwhile are picked up without waiting
+                    self.wake()
+
+
+worker_pool = OutboxWorkerPool()
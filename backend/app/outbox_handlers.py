@@ -0,0 +1,161 @@
+from datetime import datetime, timezone
+from firebase import db
+from utils import format_doc, create_server_timestamp, BatchWriter
+from cache import invalidate_user_views
+from tag_index import tag_indexes
+from related import related_indexes
+from public_snapshots import snapshots, remove_snapshot_files
+from tombstones import add_tombstone
+from datastore import iter_query, forget_document, forget_subject_notes
+from content_store import add_content_deletes
+from revisions import add_revision_deletes
+from minhash import PUBLIC_SCOPE, add_bucket_writes, add_bucket_removals, note_scopes
+from grants import add_grant_sync, add_grant_deletes
+from outbox import add_event, handler
+
+# Sharing fields of an item that no longer has any shares
+UNSHARED_FIELDS = {
+    "isShared": False,
+    "shareType": None,
+    "sharedWith": [],
+    "sharedBy": "Unknown",
+}
+
+EPOCH = datetime.fromtimestamp(0, timezone.utc)
+
+
+def item_collection(item_type):
+    return "subjects" if item_type == "subject" else "notes"
+
+
+def shares_for_item(item_type, item_id):
+    return db.collection("shares").where("itemId", "==", item_id).where("itemType", "==", item_type)
+
+
+def add_share_changed(batch, item_type, item_id, owner_id):
+    """
+    Queue copying an item's sharing settings onto the item after its shares changed
+    """
+    payload = {"itemType": item_type, "itemId": item_id, "ownerId": owner_id}
+    return add_event(batch, "share.changed", payload, f"share-{item_type}-{item_id}")
+
+
+def add_note_cleanup(batch, note_id, note):
+    """
+    Queue removing a deleted note's shares, content chunks, revisions and LSH bucket entries
+    """
+    payload = {
+        "noteId": note_id,
+        "contentInfo": note.get("contentInfo"),
+        "revisionInfo": note.get("revisionInfo"),
+        "lshBuckets": note.get("lshBuckets") or [],
+        "lshScopes": note_scopes(note),
+    }
+    return add_event(batch, "note.deleted", payload, f"note-deleted-{note_id}")
+
+
+def add_subject_cleanup(batch, subject_id, owner_id):
+    """
+    Queue removing a deleted subject's notes and shares
+    """
+    payload = {"subjectId": subject_id, "ownerId": owner_id}
+    return add_event(batch, "subject.deleted", payload, f"subject-deleted-{subject_id}")
+
+
+def invalidate_recipient_views(uids):
+    # Their dashboards list what is shared with them
+    for uid in uids:
+        invalidate_user_views(uid)
+
+
+@handler("share.changed")
+def apply_share_changed(payload):
+    collection = item_collection(payload["itemType"])
+    item_ref = db.collection(collection).document(payload["itemId"])
+    item_doc = item_ref.get()
+    if not item_doc.exists:
+        return
+
+    shares = [format_doc(share_doc) for share_doc in shares_for_item(payload["itemType"], payload["itemId"]).get()]
+    if shares:
+        share = max(shares, key=lambda share: share.get("updatedAt") or share.get("sharedAt") or EPOCH)
+        fields = {
+            "isShared": True,
+            "shareType": share.get("shareType"),
+            "sharedWith": share.get("sharedWith") or [],
+            "sharedBy": share.get("sharedBy"),
+            "permissions": share.get("permissions"),
+        }
+    else:
+        fields = dict(UNSHARED_FIELDS)
+
+    # Per-user grants follow the same share; emails without an account become invites
+    batch = BatchWriter(db)
+    emails = fields["sharedWith"] if fields["shareType"] == "specific" else []
+    recipients = add_grant_sync(batch, payload["itemType"], payload["itemId"], payload["ownerId"], emails, fields.get("permissions"))
+
+    # Re-running an event that was already applied changes nothing
+    item = item_doc.to_dict()
+    if all(item.get(field) == value for field, value in fields.items()):
+        batch.commit()
+        invalidate_recipient_views(recipients)
+        return
+
+    fields["updatedAt"] = create_server_timestamp()
+    batch.update(item_ref, fields)
+    # Publicly shared notes are also listed in the public near-duplicate index
+    was_public, is_public = item.get("shareType") == "public", fields["shareType"] == "public"
+    if collection == "notes" and was_public != is_public:
+        keys = item.get("lshBuckets") or []
+        add_bucket_writes(batch, [PUBLIC_SCOPE], payload["itemId"], None if is_public else keys, keys if is_public else None)
+    batch.commit()
+    forget_document(collection, payload["itemId"])
+    if collection == "notes":
+        forget_subject_notes(item.get("subjectId"))
+        snapshots.forget(payload["itemId"])
+    invalidate_user_views(payload["ownerId"])
+    invalidate_recipient_views(recipients)
+
+
+@handler("note.deleted")
+def apply_note_deleted(payload):
+    note_id = payload["noteId"]
+    writer = BatchWriter(db)
+    for share_doc in shares_for_item("note", note_id).get():
+        writer.delete(share_doc.reference)
+    add_content_deletes(writer, note_id, payload.get("contentInfo"))
+    add_revision_deletes(writer, note_id, payload.get("revisionInfo"))
+    add_bucket_removals(writer, payload.get("lshScopes") or [], note_id, payload.get("lshBuckets"))
+    add_grant_deletes(writer, "note", note_id)
+    writer.commit()
+    remove_snapshot_files(note_id)
+
+
+@handler("subject.deleted")
+def apply_subject_deleted(payload):
+    subject_id = payload["subjectId"]
+    writer = BatchWriter(db)
+
+    # Batches are committed as they fill up, so a retry resumes with the notes still left
+    for note_doc in iter_query(db.collection("notes").where("subjectId", "==", subject_id)):
+        note = note_doc.to_dict()
+        # The note goes last, so a note cut off by a failed commit is found again
+        add_content_deletes(writer, note_doc.id, note.get("contentInfo"))
+        add_revision_deletes(writer, note_doc.id, note.get("revisionInfo"))
+        add_bucket_removals(writer, note_scopes(note), note_doc.id, note.get("lshBuckets"))
+        add_grant_deletes(writer, "note", note_doc.id)
+        for share_doc in shares_for_item("note", note_doc.id).get():
+            writer.delete(share_doc.reference)
+        add_tombstone(writer, note.get("createdBy"), "note", note_doc.id)
+        writer.delete(note_doc.reference)
+        # A snapshot lost to a failed commit is rendered again on its next request
+        remove_snapshot_files(note_doc.id)
+
+    for share_doc in shares_for_item("subject", subject_id).get():
+        writer.delete(share_doc.reference)
+    add_grant_deletes(writer, "subject", subject_id)
+    writer.commit()
+    forget_subject_notes(subject_id)
+    invalidate_user_views(payload["ownerId"])
+    tag_indexes.invalidate(payload["ownerId"])
+    related_indexes.forget(payload["ownerId"])
@@ -0,0 +1,245 @@
+import asyncio
+import contextvars
+import itertools
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from collections import Counter, defaultdict, deque
+from metrics import metrics
+
+# How often every thread's stack is sampled while profiling is on
+SAMPLE_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+# Requests slower than this have the samples taken while they ran kept for their route
+SLOW_REQUEST_MS = float(os.getenv("PROFILER_SLOW_MS", "500"))
+# Recent samples kept to be matched against requests as they finish
+MAX_RECENT_SAMPLES = 20000
+# Distinct stacks kept per route; the rarest ones past this are folded into one entry
+MAX_STACKS_PER_ROUTE = 2000
+MAX_STACK_DEPTH = 64
+# How often the event loop is checked for lag while profiling is on
+LOOP_CHECK_SECONDS = 0.1
+# Innermost frames of a thread that is waiting rather than working, as (module, function)
+IDLE_FRAMES = {
+    ("selectors", "select"),
+    ("threading", "wait"),
+    ("queue", "get"),
+    ("concurrent.futures.thread", "_worker"),
+}
+
+# The request being served, set by ProfilerMiddleware and carried into the threadpool
+current_request = contextvars.ContextVar("current_request", default=None)
+request_ids = itertools.count(1)
+
+
+def is_idle(frame):
+    return (frame.f_globals.get("__name__"), frame.f_code.co_name) in IDLE_FRAMES
+
+
+def collapse(frame):
+    """
+    Turn a frame into one line of the collapsed format flame graph tools read, root first
+    """
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", "?")
+        names.append(f"{module}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    """
+    Sampling profiler that can be switched on and off while the app runs
+
+    A background thread records stacks at a fixed interval. When a request
+    finishes over the slow threshold, the samples taken while it was in flight
+    are added to its route's totals. Threadpool samples are kept only for the
+    request whose work the thread was running, as recorded by RequestThreadPool.
+    Event loop samples are shared by every request in flight, since coroutines of
+    all of them run there. Threads that are waiting, and threads serving no
+    request such as Firestore listeners and outbox workers, are left out.
+    """
+
+    def __init__(self, interval_ms=SAMPLE_INTERVAL_MS, slow_ms=SLOW_REQUEST_MS):
+        self.interval_ms = interval_ms
+        self.slow_ms = slow_ms
+        self.enabled = False
+        self.started_at = None
+        self.recent = deque(maxlen=MAX_RECENT_SAMPLES)
+        self.routes = defaultdict(Counter)
+        self.slow_requests = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._loop_task = None
+        self.loop_thread = None
+        # Threadpool threads running a request's work, mapped to that request's id
+        self.working = {}
+
+    def start(self, interval_ms=None, slow_ms=None):
+        if interval_ms is not None:
+            self.interval_ms = interval_ms
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+        if self.enabled:
+            return
+        self.enabled = True
+        self.loop_thread = threading.get_ident()
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        # A fresh event per run, so a sampler still winding down from a stop can't carry on
+        self._stop = threading.Event()
+        threading.Thread(target=self._sample, args=(self._stop,), name="profiler", daemon=True).start()
+        self._loop_task = asyncio.ensure_future(self._watch_loop())
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._stop.set()
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
+        with self._lock:
+            self.recent.clear()
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self.routes.clear()
+            self.slow_requests.clear()
+
+    def _sample(self, stop):
+        while not stop.wait(self.interval_ms / 1000):
+            now = time.monotonic()
+            working = dict(self.working)
+            samples = []
+            for thread_id, frame in sys._current_frames().items():
+                if is_idle(frame):
+                    continue
+                if thread_id == self.loop_thread:
+                    samples.append((now, None, collapse(frame)))
+                elif thread_id in working:
+                    samples.append((now, working[thread_id], collapse(frame)))
+            with self._lock:
+                self.recent.extend(samples)
+            metrics.observe("profiler.sample", time.monotonic() - now)
+
+    def enter(self, request_id):
+        self.working[threading.get_ident()] = request_id
+
+    def leave(self):
+        self.working.pop(threading.get_ident(), None)
+
+    async def _watch_loop(self):
+        # A sleep that wakes up late means something held the event loop for that long
+        while True:
+            expected = time.monotonic() + LOOP_CHECK_SECONDS
+            await asyncio.sleep(LOOP_CHECK_SECONDS)
+            metrics.observe("eventloop.lag", max(0.0, time.monotonic() - expected))
+
+    def record(self, route, request_id, started, finished):
+        """
+        Keep the samples of a finished request for its route if it was slow
+        """
+        if (finished - started) * 1000 < self.slow_ms:
+            return
+        with self._lock:
+            stacks = self.routes[route]
+            # Samples are in time order, so only the tail needs scanning
+            for taken, owner, stack in reversed(self.recent):
+                if taken < started:
+                    break
+                if taken <= finished and owner in (None, request_id):
+                    stacks[stack] += 1
+            self.slow_requests[route] += 1
+            if len(stacks) > MAX_STACKS_PER_ROUTE:
+                kept = Counter(dict(stacks.most_common(MAX_STACKS_PER_ROUTE)))
+                kept["[other]"] += sum(stacks.values()) - sum(kept.values())
+                self.routes[route] = kept
+
+    def collapsed(self, route=None):
+        """
+        Captured stacks as "frame;frame;frame count" lines, with the route as the root frame
+        """
+        with self._lock:
+            routes = {route: self.routes.get(route, Counter())} if route else dict(self.routes)
+            lines = [
+                f"{name};{stack} {count}"
+                for name, stacks in routes.items()
+                for stack, count in stacks.items()
+            ]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def status(self):
+        with self._lock:
+            routes = [
+                {"route": route, "slowRequests": self.slow_requests[route], "samples": sum(stacks.values())}
+                for route, stacks in self.routes.items()
+            ]
+            recent = len(self.recent)
+        return {
+            "enabled": self.enabled,
+            "startedAt": self.started_at,
+            "intervalMs": self.interval_ms,
+            "slowMs": self.slow_ms,
+            "recentSamples": recent,
+            "routes": sorted(routes, key=lambda route: route["samples"], reverse=True),
+            "eventLoopLag": metrics.timing("eventloop.lag"),
+            "sampleCost": metrics.timing("profiler.sample"),
+        }
+
+
+profiler = Profiler()
+
+
+class RequestThreadPool(ThreadPoolExecutor):
+    """
+    Default executor that tells the profiler which request each job belongs to
+
+    run_in_threadpool submits from the request's task, so the request id is
+    read there and marked on the worker thread for as long as the job runs.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        request_id = current_request.get()
+        if request_id is None or not profiler.enabled:
+            return super().submit(fn, *args, **kwargs)
+
+        def run():
+            profiler.enter(request_id)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.leave()
+
+        return super().submit(run)
+
+
+class ProfilerMiddleware:
+    """
+    Time each request and hand slow ones to the profiler while it is on
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiler.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        request_id = next(request_ids)
+        token = current_request.set(request_id)
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_request.reset(token)
+            # Routing fills in the endpoint, so it is only known once the request ran
+            endpoint = scope.get("endpoint")
+            if endpoint is not None and profiler.enabled:
+                route = f"{scope['method']} {endpoint.__module__}.{endpoint.__name__}"
+                profiler.record(route, request_id, started, time.monotonic())
@@ -0,0 +1,213 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from fastapi.concurrency import run_in_threadpool
+from firebase import db
+from utils import format_doc
+from cache import TTLCache
+from metrics import metrics
+from datastore import SingleFlight
+from content_store import load_content
+
+SNAPSHOT_DIR = os.getenv("PUBLIC_SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "studyhub-public"))
+# Rendered snapshots kept in memory, and on local disk, before the least recently used go
+MEMORY_BUDGET_BYTES = 64 * 1024 * 1024
+DISK_BUDGET_BYTES = 256 * 1024 * 1024
+# How long an instance trusts its idea of a note's current version; this bounds
+# how long an edit or an unshare takes to show up on the public endpoint
+VERSION_TTL_SECONDS = 30
+
+PUBLIC_NOTE_FIELDS = ["id", "title", "subjectId", "mediaItems", "tags", "createdBy", "sharedBy", "createdAt", "updatedAt"]
+
+
+def note_version(note_doc):
+    """
+    Published version of a note document, or None if the note is not shared publicly
+
+    Every write to a note sets updatedAt, so the version moves with each change
+    and a snapshot rendered for one version never needs to be updated.
+    """
+    if not note_doc.exists:
+        return None
+    note = note_doc.to_dict()
+    if note.get("shareType") != "public":
+        return None
+    updated_at = note.get("updatedAt") or note.get("createdAt")
+    return str(int(updated_at.timestamp() * 1_000_000)) if updated_at else "0"
+
+
+def render_snapshot(note_id):
+    """
+    Read a public note and render its snapshot, returning (version, body) or None
+    """
+    note_doc = db.collection("notes").document(note_id).get()
+    version = note_version(note_doc)
+    if version is None:
+        return None
+
+    note = format_doc(note_doc)
+    snapshot = {field: note.get(field) for field in PUBLIC_NOTE_FIELDS}
+    snapshot["content"] = load_content(note_id, note)
+    snapshot["version"] = version
+    body = json.dumps(snapshot, separators=(",", ":"), default=str).encode("utf-8")
+    return version, body
+
+
+def snapshot_prefix(note_id):
+    return os.path.join(SNAPSHOT_DIR, hashlib.sha256(note_id.encode("utf-8")).hexdigest()[:32])
+
+
+def read_snapshot_file(note_id, version):
+    try:
+        with open(f"{snapshot_prefix(note_id)}-{version}.json", "rb") as snapshot_file:
+            return snapshot_file.read()
+    except OSError:
+        return None
+
+
+def write_snapshot_file(note_id, version, body):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = f"{snapshot_prefix(note_id)}-{version}.json"
+    # Write next to the target and swap it in, so a crash never leaves half a file
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(body)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # Only the newest version of a note is worth keeping
+    for old_path in glob.glob(f"{snapshot_prefix(note_id)}-*.json"):
+        if old_path != path:
+            remove_file(old_path)
+    prune_snapshot_files()
+
+
+def remove_snapshot_files(note_id):
+    for path in glob.glob(f"{snapshot_prefix(note_id)}-*.json"):
+        remove_file(path)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def prune_snapshot_files():
+    """
+    Delete the least recently written snapshots once the directory is over budget
+    """
+    entries = []
+    with os.scandir(SNAPSHOT_DIR) as scan:
+        for entry in scan:
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= DISK_BUDGET_BYTES:
+            break
+        remove_file(path)
+        total -= size
+
+
+class SnapshotStore:
+    """
+    Rendered public snapshots, looked up in memory, then on local disk, then rendered from Firestore
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET_BYTES):
+        self.budget = budget
+        self.size = 0
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+        self._versions = TTLCache(maxsize=10000, ttl=VERSION_TTL_SECONDS)
+        self._version_reads = SingleFlight("public.version")
+        self._renders = SingleFlight("public.render")
+
+    def _remember(self, key, body):
+        with self._lock:
+            if key in self._bodies:
+                return
+            self._bodies[key] = body
+            self.size += len(body)
+            while self.size > self.budget and self._bodies:
+                _, dropped = self._bodies.popitem(last=False)
+                self.size -= len(dropped)
+
+    def _cached(self, key):
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+            return body
+
+    async def current_version(self, note_id):
+        """
+        Version currently published for a note, or None if it is not public
+        """
+        cached = self._versions.get(note_id)
+        if cached is not None:
+            return cached or None
+
+        note_doc = await self._version_reads.do(
+            note_id, db.collection("notes").document(note_id).get, ["shareType", "updatedAt", "createdAt"]
+        )
+        version = note_version(note_doc)
+        # Notes that are not public are remembered too, so missing links stay cheap
+        self._versions.set(note_id, version or "")
+        return version
+
+    async def get(self, note_id, version):
+        """
+        Body of one version of a public note's snapshot, or None if it is not available
+        """
+        key = (note_id, version)
+        body = self._cached(key)
+        if body is not None:
+            metrics.increment("public.snapshot.memory")
+            return body
+
+        body = await run_in_threadpool(read_snapshot_file, note_id, version)
+        if body is not None:
+            metrics.increment("public.snapshot.disk")
+            self._remember(key, body)
+            return body
+
+        # Only the current version is ever rendered; older ones are served while cached or not at all,
+        # so made-up version numbers can't make anyone trigger renders
+        if version != await self.current_version(note_id):
+            metrics.increment("public.snapshot.unknown_version")
+            return None
+
+        # Concurrent first requests for a new version share one render
+        rendered = await self._renders.do(note_id, render_snapshot, note_id)
+        if rendered is None:
+            self._versions.set(note_id, "")
+            return None
+        metrics.increment("public.snapshot.rendered")
+        rendered_version, body = rendered
+        self._versions.set(note_id, rendered_version)
+        self._remember((note_id, rendered_version), body)
+        await run_in_threadpool(write_snapshot_file, note_id, rendered_version, body)
+        return body if rendered_version == version else None
+
+    def forget(self, note_id):
+        """
+        Drop this instance's cached version of a note after it changed or stopped being public
+        """
+        self._versions.invalidate(note_id)
+        self._renders.forget(note_id)
+
+
+snapshots = SnapshotStore()
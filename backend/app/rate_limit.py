@@ -0,0 +1,228 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from middleware import get_current_user
+from metrics import metrics
+
+# Each user's bucket refills at this many tokens per second, up to the burst size.
+# A request costs roughly one token per Firestore read it is expected to make.
+RATE_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "20"))
+BURST = float(os.getenv("RATE_LIMIT_BURST", "300"))
+# Requests to heavy routes running at once in this process, and how many more
+# a single user may have waiting for a slot before being turned away
+HEAVY_SLOTS = int(os.getenv("HEAVY_ROUTE_SLOTS", "4"))
+MAX_WAITING_PER_USER = int(os.getenv("HEAVY_ROUTE_QUEUE_PER_USER", "4"))
+# Set to share buckets between worker processes, e.g. redis://localhost:6379/0
+REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+# Proxies in front of the app that append to X-Forwarded-For, e.g. 1 behind App Engine's
+# front end; with none the peer address is used to tell anonymous clients apart
+TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+# Buckets of users idle for this long are dropped from memory; a full bucket looks the same
+IDLE_BUCKET_SECONDS = BURST / RATE_PER_SECOND + 60
+
+
+def route_cost(cost, heavy=False):
+    """
+    Set how many tokens a route costs and whether it runs in the fair-queued heavy slots
+    """
+    def decorate(endpoint):
+        endpoint.rate_cost = cost
+        endpoint.rate_heavy = heavy
+        return endpoint
+    return decorate
+
+
+class MemoryBuckets:
+    """
+    Token buckets kept in this process
+    """
+
+    def __init__(self, rate=RATE_PER_SECOND, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def take(self, key, cost):
+        """
+        Take tokens from a bucket, returning 0 or the seconds to wait until they are available
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+
+            # Buckets are kept in last-used order, so idle ones sit at the front
+            while self._buckets:
+                _, (_, oldest) = next(iter(self._buckets.items()))
+                if now - oldest < IDLE_BUCKET_SECONDS:
+                    break
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# Refill, take and store in one round-trip, atomically across workers
+TAKE_SCRIPT = """
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+  tokens = tokens - cost
+else
+  wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """
+    Token buckets in Redis, or anything speaking its protocol, shared by every worker
+    """
+
+    def __init__(self, url, rate=RATE_PER_SECOND, burst=BURST):
+        # Only needed when several workers share limits, so it isn't a hard requirement
+        import redis
+
+        self.rate = rate
+        self.burst = burst
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TAKE_SCRIPT)
+
+    async def take(self, key, cost):
+        wait = await run_in_threadpool(
+            self.script, keys=[f"ratelimit:{key}"], args=[self.rate, self.burst, cost, time.time()]
+        )
+        return float(wait)
+
+
+class FairLimiter:
+    """
+    Bounded slots for heavy requests, handed out round-robin between users
+
+    Each user waits in their own queue and a freed slot goes to the next user in
+    turn, so one user firing many heavy requests only delays their own.
+    """
+
+    def __init__(self, slots=HEAVY_SLOTS, max_waiting=MAX_WAITING_PER_USER):
+        self.free = slots
+        self.max_waiting = max_waiting
+        self.queues = OrderedDict()
+
+    async def acquire(self, key):
+        """
+        Wait for a slot; returns False straight away if the user already has too many waiting
+        """
+        if self.free > 0 and not self.queues:
+            self.free -= 1
+            return True
+
+        if len(self.queues.get(key, ())) >= self.max_waiting:
+            return False
+
+        queue = self.queues.setdefault(key, deque())
+        waiter = asyncio.get_event_loop().create_future()
+        queue.append(waiter)
+        started = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the request went away
+                self.release()
+            elif waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    self.queues.pop(key, None)
+            raise
+        metrics.observe("ratelimit.heavy_wait", time.monotonic() - started)
+        return True
+
+    def release(self):
+        while self.queues:
+            key, queue = next(iter(self.queues.items()))
+            waiter = queue.popleft()
+            # This user goes to the back of the line for the next free slot
+            if queue:
+                self.queues.move_to_end(key)
+            else:
+                del self.queues[key]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.free += 1
+
+
+buckets = RedisBuckets(REDIS_URL) if REDIS_URL else MemoryBuckets()
+heavy_limiter = FairLimiter()
+
+
+def too_many_requests(detail, retry_after):
+    metrics.increment("ratelimit.rejected")
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def client_address(request):
+    forwarded = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    if TRUSTED_PROXIES and len(forwarded) >= TRUSTED_PROXIES:
+        # Entries before the ones our proxies added are whatever the client chose to send
+        return forwarded[-TRUSTED_PROXIES]
+    return request.client.host if request.client else "unknown"
+
+
+async def charge(request, key):
+    """
+    Take a request's cost from a bucket, returning whether the route is heavy
+    """
+    endpoint = request.scope.get("endpoint")
+    cost = min(getattr(endpoint, "rate_cost", 1), buckets.burst)
+    wait = await buckets.take(key, cost)
+    if wait > 0:
+        raise too_many_requests("Too many requests, please slow down", wait)
+    return getattr(endpoint, "rate_heavy", False)
+
+
+async def public_rate_limit(request: Request):
+    """
+    Charge an anonymous request to the address it came from
+    """
+    await charge(request, f"ip:{client_address(request)}")
+
+
+async def rate_limit(request: Request, current_user=Depends(get_current_user)):
+    """
+    Charge the current user for a request and hold a heavy slot while it runs
+
+    Routes set their cost with route_cost; anything else costs one token.
+    """
+    heavy = await charge(request, current_user["uid"])
+    if not heavy:
+        yield
+        return
+
+    if not await heavy_limiter.acquire(current_user["uid"]):
+        raise too_many_requests("Too many expensive requests in progress, please wait for them to finish", 1)
+    try:
+        yield
+    finally:
+        heavy_limiter.release()
@@ -0,0 +1,250 @@
+import asyncio
+import itertools
+import uuid
+from collections import deque
+from fastapi.concurrency import run_in_threadpool
+from firebase import db
+from utils import format_doc
+from acl import can_view_subject, viewable_subject_ids
+from content_store import list_item
+
+# Events kept per channel so reconnecting clients can resume
+CHANNEL_BUFFER_SIZE = 500
+# Events a slow client may fall behind before it is told to resync
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+CHANGE_TYPES = {"ADDED": "added", "MODIFIED": "modified", "REMOVED": "removed"}
+# Subject fields that decide who may view it, directly or through the subjects it is nested in
+ACCESS_FIELDS = ("createdBy", "shareType", "sharedWith", "ancestors")
+
+
+class Subscriber:
+    """
+    One connected client and the channels it listens to
+    """
+
+    def __init__(self, current_user, viewable=()):
+        self.user = current_user
+        # Subjects the user was found to have access to, e.g. through a grant or an ancestor
+        self.viewable = set(viewable)
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.channels = set()
+        self.overflowed = False
+
+    def push(self, event):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The client can't keep up; tell it to refetch and stop queueing
+            self.overflowed = True
+            self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync", "data": {"reason": "overflow"}})
+
+
+class Channel:
+    """
+    A resource backed by Firestore listeners that is shared by every subscriber
+    """
+
+    def __init__(self, hub, key, created_seq):
+        self.hub = hub
+        self.key = key
+        self.subscribers = set()
+        self.buffer = deque(maxlen=CHANNEL_BUFFER_SIZE)
+        self.evicted_seq = created_seq
+        self.watches = []
+        self.subject = None
+
+    def listen(self, kind, target, document=False):
+        """
+        Attach a snapshot listener; the first snapshot only primes the channel
+        """
+        primed = {"done": False}
+
+        def on_snapshot(snapshots, changes, read_time):
+            if not primed["done"]:
+                primed["done"] = True
+                # Remember the subject itself so events can be checked against its sharing
+                if document and snapshots and snapshots[0].exists:
+                    self.hub.call_soon(self.set_subject, format_doc(snapshots[0]))
+                return
+
+            events = []
+            if document:
+                for snapshot in snapshots:
+                    change = "modified" if snapshot.exists else "removed"
+                    data = format_doc(snapshot) if snapshot.exists else {"id": snapshot.id}
+                    events.append({"type": f"subject.{change}", "data": data})
+            else:
+                for change in changes:
+                    data = format_doc(change.document)
+                    if kind.endswith("note"):
+                        data = list_item(data)
+                    events.append({
+                        "type": f"{kind}.{CHANGE_TYPES.get(change.type.name, 'modified')}",
+                        "data": data,
+                    })
+
+            if events:
+                self.hub.call_soon(self.publish, events)
+
+        self.watches.append(target.on_snapshot(on_snapshot))
+
+    def set_subject(self, subject):
+        self.subject = subject
+
+    def publish(self, events):
+        for event in events:
+            if event["type"] == "subject.modified":
+                previous, self.subject = self.subject, event["data"]
+                if previous is not None and any(previous.get(field) != self.subject.get(field) for field in ACCESS_FIELDS):
+                    asyncio.ensure_future(self.recheck(self.subject))
+
+            event = dict(event, id=self.hub.next_seq(), channel=self.key)
+            if len(self.buffer) == self.buffer.maxlen:
+                self.evicted_seq = self.buffer[0]["id"]
+            self.buffer.append(event)
+
+            for subscriber in list(self.subscribers):
+                if self.allows(subscriber):
+                    subscriber.push(event)
+                else:
+                    # Sharing was revoked since the client subscribed
+                    subscriber.push({"type": "access.revoked", "channel": self.key, "data": {}})
+                    self.hub.leave(subscriber, self)
+
+    def allows(self, subscriber):
+        if self.subject is None:
+            return True
+        if can_view_subject(self.subject, subscriber.user):
+            return True
+        # Access through grants and ancestors was settled when subscribing or at the last recheck
+        return self.subject["id"] in subscriber.viewable
+
+    async def recheck(self, subject):
+        """
+        Decide again, with grants and ancestors, who may still follow a subject whose sharing changed
+        """
+        for subscriber in list(self.subscribers):
+            if can_view_subject(subject, subscriber.user):
+                continue
+            allowed = await run_in_threadpool(viewable_subject_ids, [subject], subscriber.user)
+            if subject["id"] in allowed:
+                subscriber.viewable.add(subject["id"])
+            elif subscriber in self.subscribers:
+                subscriber.viewable.discard(subject["id"])
+                subscriber.push({"type": "access.revoked", "channel": self.key, "data": {}})
+                self.hub.leave(subscriber, self)
+
+    def close(self):
+        for watch in self.watches:
+            watch.unsubscribe()
+        self.watches = []
+
+
+class ChangeHub:
+    """
+    Fans Firestore changes out to connected clients with one listener per resource
+    """
+
+    def __init__(self):
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.channels = {}
+        self.loop = None
+        self._seq = itertools.count(1)
+        self.last_seq = 0
+
+    def next_seq(self):
+        self.last_seq = next(self._seq)
+        return self.last_seq
+
+    def token(self, seq):
+        return f"{self.boot_id}:{seq}"
+
+    def parse_token(self, token):
+        """
+        Return the sequence number of a resume token issued by this process
+        """
+        if not token or ":" not in token:
+            return None
+        boot_id, _, seq = token.partition(":")
+        if boot_id != self.boot_id or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def call_soon(self, callback, *args):
+        # Listener callbacks run on Firestore's threads; hop back onto the loop
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def open_channel(self, key):
+        channel = Channel(self, key, self.last_seq)
+        kind, _, value = key.partition(":")
+
+        if kind == "subject":
+            channel.listen("subject", db.collection("subjects").document(value), document=True)
+            channel.listen("note", db.collection("notes").where("subjectId", "==", value))
+        elif kind == "owner":
+            channel.listen("subject", db.collection("subjects").where("createdBy", "==", value))
+        elif kind == "shared":
+            channel.listen("share.subject", db.collection("subjects").where("sharedWith", "array_contains", value))
+            channel.listen("share.note", db.collection("notes").where("sharedWith", "array_contains", value))
+        else:
+            raise ValueError(f"Unknown channel: {key}")
+
+        self.channels[key] = channel
+        return channel
+
+    def join(self, subscriber, key):
+        self.loop = asyncio.get_event_loop()
+        channel = self.channels.get(key) or self.open_channel(key)
+        channel.subscribers.add(subscriber)
+        subscriber.channels.add(channel)
+        return channel
+
+    def leave(self, subscriber, channel):
+        channel.subscribers.discard(subscriber)
+        subscriber.channels.discard(channel)
+        if not channel.subscribers and self.channels.get(channel.key) is channel:
+            del self.channels[channel.key]
+            self.loop.run_in_executor(None, channel.close)
+
+    def subscribe(self, current_user, keys, since=None, viewable=()):
+        """
+        Register a client on a set of channels and queue any events it missed
+
+        viewable lists the subjects whose access was already checked, with grants and ancestors.
+        """
+        subscriber = Subscriber(current_user, viewable)
+        since_seq = self.parse_token(since)
+        needs_resync = since is not None and since_seq is None
+
+        for key in keys:
+            channel = self.join(subscriber, key)
+            # Events older than the buffer, or from before the channel was opened, are gone
+            if since_seq is not None and channel.evicted_seq > since_seq:
+                needs_resync = True
+
+        if needs_resync:
+            subscriber.push({"type": "resync", "data": {"reason": "stale-token"}})
+        elif since_seq is not None:
+            missed = [
+                (event, channel)
+                for channel in subscriber.channels
+                if channel.allows(subscriber)
+                for event in channel.buffer
+                if event["id"] > since_seq
+            ]
+            for event, channel in sorted(missed, key=lambda item: item[0]["id"]):
+                subscriber.push(event)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        for channel in list(subscriber.channels):
+            self.leave(subscriber, channel)
+
+
+hub = ChangeHub()
@@ -0,0 +1,413 @@
+import hashlib
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+import numpy as np
+from scipy import sparse
+from firebase import db
+from datastore import SingleFlight, iter_query_pages
+from content_store import load_contents
+from note_text import plain_text
+from tombstones import TOMBSTONE_RETENTION_DAYS
+
+INDEX_VERSION = 1
+# Per-user matrices are saved here so a restart doesn't have to re-read every note
+INDEX_DIR = os.getenv("RELATED_INDEX_DIR", os.path.join(tempfile.gettempdir(), "studyhub-related"))
+# Users whose matrix is kept in memory; the least recently used are dropped first
+MAX_INDEXED_USERS = int(os.getenv("RELATED_INDEX_USERS", "20"))
+# A loaded matrix is brought up to date with writes from other instances this often
+RESYNC_SECONDS = 300
+# Notes changed since the matrix was last rebuilt are kept as extra rows until there are this many
+MAX_PENDING_ROWS = 256
+# Notes whose content is read together while building
+BUILD_PAGE_SIZE = 100
+# Writes still committing may carry a slightly older server timestamp
+SETTLE_SECONDS = 2
+
+MAX_TERMS_PER_NOTE = 300
+TITLE_WEIGHT = 3
+TAG_WEIGHT = 3
+
+WORD = re.compile(r"[^\W_]{2,}")
+STOP_WORDS = frozenset("""
+    about after also and any are because been but can could did does for from had has have her his how
+    into its just more not now one only other our out over she some such than that the their them then
+    there these they this those was were what when where which who will with would you your
+""".split())
+
+
+def note_terms(title, content, tags):
+    """
+    Log-scaled term frequencies of a note, with title words and tags weighted up
+    """
+    counts = Counter(word for word in WORD.findall(plain_text(content).lower()) if word not in STOP_WORDS)
+    for word in WORD.findall((title or "").lower()):
+        if word not in STOP_WORDS:
+            counts[word] += TITLE_WEIGHT
+    for tag in tags or []:
+        counts["#" + tag.lower()] += TAG_WEIGHT
+
+    return {term: 1 + math.log(count) for term, count in counts.most_common(MAX_TERMS_PER_NOTE)}
+
+
+class RelatedIndex:
+    """
+    One user's notes as a sparse term-frequency matrix for cosine similarity
+
+    Rows hold log-scaled term frequencies; IDF weights are applied at query
+    time, so cos(a, b) = a·(idf² ∘ b) / (|a|·|b|) with the row norms taken
+    under the IDF of the last rebuild. Changed notes are appended as pending
+    rows and their old rows masked out until the next rebuild compacts them.
+    """
+
+    def __init__(self):
+        self.terms = []
+        self.vocab = {}
+        self.df = np.zeros(0, dtype=np.int32)
+        self.note_ids = []
+        self.rows = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.base = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self.pending = []
+        self._pending_matrix = None
+        self._idf = None
+        self.synced_at = 0.0
+        self.checked_at = time.monotonic()
+
+    def column(self, term):
+        col = self.vocab.get(term)
+        if col is None:
+            col = self.vocab[term] = len(self.terms)
+            self.terms.append(term)
+        return col
+
+    def idf(self):
+        if self._idf is None or len(self._idf) != len(self.terms):
+            df = np.zeros(len(self.terms), dtype=np.float32)
+            df[:len(self.df)] = self.df
+            self._idf = (np.log((1 + len(self.note_ids)) / (1 + df)) + 1).astype(np.float32)
+        return self._idf
+
+    def weights_to_arrays(self, weights, grow=True):
+        if grow:
+            cols = np.fromiter((self.column(term) for term in weights), dtype=np.int32, count=len(weights))
+            vals = np.fromiter(weights.values(), dtype=np.float32, count=len(weights))
+            return cols, vals
+        known = [(self.vocab[term], value) for term, value in weights.items() if term in self.vocab]
+        cols = np.array([col for col, _ in known], dtype=np.int32)
+        vals = np.array([value for _, value in known], dtype=np.float32)
+        return cols, vals
+
+    def set_note(self, note_id, weights, compact=True):
+        """
+        Add or replace a note's row
+        """
+        self.remove_note(note_id)
+        cols, vals = self.weights_to_arrays(weights)
+        if len(self.df) < len(self.terms):
+            self.df = np.concatenate([self.df, np.zeros(len(self.terms) - len(self.df), dtype=np.int32)])
+        # Document frequencies still count masked rows until the next rebuild
+        self.df[cols] += 1
+        self._idf = None
+
+        self.rows[note_id] = len(self.note_ids)
+        self.note_ids.append(note_id)
+        self.pending.append((cols, vals))
+        self._pending_matrix = None
+        norm = np.sqrt(np.sum((vals * self.idf()[cols]) ** 2))
+        self.alive = np.append(self.alive, True)
+        self.norms = np.append(self.norms, np.float32(norm))
+
+        if compact and len(self.pending) > MAX_PENDING_ROWS:
+            self.compact()
+
+    def remove_note(self, note_id):
+        row = self.rows.pop(note_id, None)
+        if row is not None:
+            self.alive[row] = False
+
+    def pending_matrix(self):
+        if self._pending_matrix is None or self._pending_matrix.shape[1] != len(self.terms):
+            indptr = np.zeros(len(self.pending) + 1, dtype=np.int32)
+            np.cumsum([len(cols) for cols, _ in self.pending], out=indptr[1:])
+            indices = np.concatenate([cols for cols, _ in self.pending]) if self.pending else np.zeros(0, dtype=np.int32)
+            data = np.concatenate([vals for _, vals in self.pending]) if self.pending else np.zeros(0, dtype=np.float32)
+            self._pending_matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(self.pending), len(self.terms)))
+        return self._pending_matrix
+
+    def row_arrays(self, row):
+        base_rows = self.base.shape[0]
+        if row >= base_rows:
+            return self.pending[row - base_rows]
+        start, end = self.base.indptr[row], self.base.indptr[row + 1]
+        return self.base.indices[start:end], self.base.data[start:end]
+
+    def compact(self):
+        """
+        Fold pending rows into the matrix, drop masked rows and unused terms, and refresh IDF and norms
+        """
+        base = self.base.copy()
+        base.resize((base.shape[0], len(self.terms)))
+        matrix = sparse.vstack([base, self.pending_matrix()], format="csr", dtype=np.float32)
+        keep = np.flatnonzero(self.alive)
+        matrix = matrix[keep]
+
+        df = np.bincount(matrix.indices, minlength=len(self.terms))
+        used = np.flatnonzero(df)
+        remap = np.full(len(self.terms), -1, dtype=np.int32)
+        remap[used] = np.arange(len(used), dtype=np.int32)
+        matrix = sparse.csr_matrix(
+            (matrix.data, remap[matrix.indices], matrix.indptr),
+            shape=(matrix.shape[0], len(used)),
+        )
+
+        self.terms = [self.terms[col] for col in used]
+        self.vocab = {term: col for col, term in enumerate(self.terms)}
+        self.df = df[used].astype(np.int32)
+        self.note_ids = [self.note_ids[row] for row in keep]
+        self.rows = {note_id: row for row, note_id in enumerate(self.note_ids)}
+        self.alive = np.ones(len(self.note_ids), dtype=bool)
+        self.base = matrix
+        self.pending = []
+        self._pending_matrix = None
+        self._idf = None
+
+        idf = self.idf()
+        self.norms = np.sqrt(matrix.multiply(matrix) @ (idf * idf)).astype(np.float32)
+
+    def similar(self, cols, vals, limit, exclude=None):
+        """
+        Top notes by cosine similarity to a term vector, best first
+        """
+        if not len(self.note_ids) or not len(cols):
+            return []
+
+        idf = self.idf()
+        query = np.zeros(len(self.terms), dtype=np.float32)
+        query[cols] = vals * idf[cols] * idf[cols]
+        query_norm = np.sqrt(np.sum((vals * idf[cols]) ** 2))
+
+        base_rows = self.base.shape[0]
+        scores = np.empty(len(self.note_ids), dtype=np.float32)
+        scores[:base_rows] = self.base @ query[:self.base.shape[1]]
+        if self.pending:
+            scores[base_rows:] = self.pending_matrix() @ query
+
+        denominators = self.norms * query_norm
+        np.divide(scores, denominators, out=scores, where=denominators > 0)
+        scores[denominators <= 0] = 0
+        scores[~self.alive] = -1
+        if exclude is not None and exclude in self.rows:
+            scores[self.rows[exclude]] = -1
+
+        limit = min(limit, len(scores))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(self.note_ids[row], float(scores[row])) for row in top if scores[row] > 0]
+
+    def related(self, note_id, limit):
+        """
+        Notes most similar to one already in the index, or None if it isn't
+        """
+        row = self.rows.get(note_id)
+        if row is None:
+            return None
+        cols, vals = self.row_arrays(row)
+        return self.similar(cols, vals, limit, exclude=note_id)
+
+    def related_to_terms(self, weights, limit, exclude=None):
+        cols, vals = self.weights_to_arrays(weights, grow=False)
+        return self.similar(cols, vals, limit, exclude)
+
+    def apply(self, changes):
+        updated, removed, synced_at = changes
+        for note_id, weights in updated:
+            self.set_note(note_id, weights, compact=False)
+        for note_id in removed:
+            self.remove_note(note_id)
+        if len(self.pending) > MAX_PENDING_ROWS:
+            self.compact()
+        self.synced_at = synced_at
+        self.checked_at = time.monotonic()
+        return bool(updated or removed)
+
+    def arrays(self):
+        """
+        Everything needed to restore the index, for saving after a compact()
+        """
+        return {
+            "version": np.array(INDEX_VERSION),
+            "synced_at": np.array(self.synced_at),
+            "terms": np.array(self.terms, dtype=str),
+            "note_ids": np.array(self.note_ids, dtype=str),
+            "df": self.df,
+            "norms": self.norms,
+            "data": self.base.data,
+            "indices": self.base.indices,
+            "indptr": self.base.indptr,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls()
+        index.terms = [str(term) for term in arrays["terms"]]
+        index.vocab = {term: col for col, term in enumerate(index.terms)}
+        index.note_ids = [str(note_id) for note_id in arrays["note_ids"]]
+        index.rows = {note_id: row for row, note_id in enumerate(index.note_ids)}
+        index.df = arrays["df"]
+        index.norms = arrays["norms"]
+        index.alive = np.ones(len(index.note_ids), dtype=bool)
+        index.base = sparse.csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]),
+            shape=(len(index.note_ids), len(index.terms)),
+        )
+        index.synced_at = float(arrays["synced_at"])
+        return index
+
+
+def index_path(uid):
+    return os.path.join(INDEX_DIR, hashlib.sha256(uid.encode("utf-8")).hexdigest()[:32] + ".npz")
+
+
+def save_arrays(uid, arrays):
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    path = index_path(uid)
+    # Write next to the target and swap it in, so a crash never leaves half a file
+    fd, tmp_path = tempfile.mkstemp(dir=INDEX_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            np.savez(tmp, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_saved(uid):
+    try:
+        with np.load(index_path(uid), allow_pickle=False) as arrays:
+            if int(arrays["version"]) != INDEX_VERSION:
+                return None
+            return RelatedIndex.from_arrays({key: arrays[key] for key in arrays.files})
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def note_weights(notes):
+    contents = load_contents(notes)
+    return [(note["id"], note_terms(note.get("title"), contents[note["id"]], note.get("tags"))) for note in notes]
+
+
+def fetch_changes(uid, since):
+    """
+    Read the notes written and deleted since a sync time; everything when since is 0
+    """
+    started = time.time() - SETTLE_SECONDS
+    notes_query = db.collection("notes").where("createdBy", "==", uid)
+    updated, removed = [], []
+
+    if not since:
+        for page in iter_query_pages(notes_query, BUILD_PAGE_SIZE):
+            updated.extend(note_weights([dict(doc.to_dict(), id=doc.id) for doc in page]))
+        return updated, removed, started
+
+    since_time = datetime.fromtimestamp(since, timezone.utc)
+    page = []
+    for doc in notes_query.where("updatedAt", ">", since_time).order_by("updatedAt").stream():
+        page.append(dict(doc.to_dict(), id=doc.id))
+        if len(page) == BUILD_PAGE_SIZE:
+            updated.extend(note_weights(page))
+            page = []
+    updated.extend(note_weights(page))
+
+    tombstones_query = db.collection("tombstones").where("ownerId", "==", uid).where("updatedAt", ">", since_time)
+    for tombstone_doc in tombstones_query.stream():
+        tombstone = tombstone_doc.to_dict()
+        if tombstone.get("itemType") == "note":
+            removed.append(tombstone["itemId"])
+    return updated, removed, started
+
+
+def load_index(uid):
+    """
+    Restore a user's saved matrix and catch it up, or build it from scratch
+    """
+    index = load_saved(uid)
+    # Deletions older than the tombstone retention can't be caught up on
+    if index is not None and time.time() - index.synced_at > TOMBSTONE_RETENTION_DAYS * 86400:
+        index = None
+    if index is None:
+        index = RelatedIndex()
+
+    changed = index.apply(fetch_changes(uid, index.synced_at))
+    if changed or index.pending or not os.path.exists(index_path(uid)):
+        index.compact()
+        save_arrays(uid, index.arrays())
+    return index
+
+
+class RelatedIndexCache:
+    """
+    Per-user similarity matrices kept in memory with LRU eviction
+
+    Indexes are only changed on the event loop; reads from Firestore and disk
+    happen in worker threads and hand back changes to apply.
+    """
+
+    def __init__(self, maxsize=MAX_INDEXED_USERS):
+        self.maxsize = maxsize
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self._loads = SingleFlight("related.load")
+        self._syncs = SingleFlight("related.sync")
+
+    async def get(self, uid):
+        with self._lock:
+            index = self._indexes.get(uid)
+            if index is not None:
+                self._indexes.move_to_end(uid)
+
+        if index is None:
+            index = await self._loads.do(uid, load_index, uid)
+            with self._lock:
+                self._indexes[uid] = index
+                self._indexes.move_to_end(uid)
+                while len(self._indexes) > self.maxsize:
+                    self._indexes.popitem(last=False)
+        elif time.monotonic() - index.checked_at > RESYNC_SECONDS:
+            index.apply(await self._syncs.do(uid, fetch_changes, uid, index.synced_at))
+        return index
+
+    def _loaded(self, uid):
+        with self._lock:
+            return self._indexes.get(uid)
+
+    def note_changed(self, uid, note_id, title, content, tags):
+        """
+        Update a user's matrix, if it is loaded, after a note was written
+        """
+        index = self._loaded(uid)
+        if index is not None:
+            index.set_note(note_id, note_terms(title, content, tags))
+
+    def note_removed(self, uid, note_id):
+        index = self._loaded(uid)
+        if index is not None:
+            index.remove_note(note_id)
+
+    def forget(self, uid):
+        """
+        Drop a user's matrix from memory; the next use reloads it and catches up from Firestore
+        """
+        with self._lock:
+            self._indexes.pop(uid, None)
+
+
+related_indexes = RelatedIndexCache()
@@ -0,0 +1,180 @@
+import json
+import re
+import time
+import zlib
+from difflib import SequenceMatcher
+from firebase import db
+from utils import create_server_timestamp
+
+# Every Nth revision is stored whole, bounding how many deltas a read applies
+SNAPSHOT_INTERVAL = 20
+# Saves closer together than this fold into the previous revision
+COALESCE_SECONDS = 120
+# Above this many lines diffing gets slow, so the revision is stored whole
+MAX_DIFF_LINES = 3000
+COMPRESSION_LEVEL = 6
+
+# Lines, ending at a newline, a <br> or the close of a block tag, so that notes
+# saved as one line of HTML still split into paragraphs; joined back together
+# they give the original text
+LINE_PATTERN = re.compile(r".*?(?:\n|<br\s*/?>|</(?:p|div|li|h[1-6]|pre|blockquote|tr|ul|ol|table)>)|.+", re.S | re.I)
+# Tags, words and whitespace runs; deltas stored before diffing went by line address these
+TOKEN_PATTERN = re.compile(r"<[^>]*>|[^<\s]+|\s+|<")
+
+
+def split_lines(text):
+    return LINE_PATTERN.findall(text)
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text)
+
+
+def make_delta(newer, older):
+    """
+    Encode how to rebuild the older text from the newer one
+
+    Ops are either [start, end] line ranges copied from the newer text or
+    literal strings. Returns None when the texts are too large to diff.
+
+    Lines rather than words keep the diff cheap enough to run on every save:
+    matching is roughly quadratic in the number of units, and it runs on the
+    request's worker. Lines that repeat a lot, such as empty paragraphs, are
+    left out as anchors by autojunk, which keeps repetitive notes fast too.
+    """
+    newer_lines = split_lines(newer)
+    older_lines = split_lines(older)
+    if len(newer_lines) > MAX_DIFF_LINES or len(older_lines) > MAX_DIFF_LINES:
+        return None
+
+    ops = []
+    matcher = SequenceMatcher(None, newer_lines, older_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif tag in ("replace", "insert"):
+            ops.append("".join(older_lines[j1:j2]))
+    return ops
+
+
+def apply_delta(newer, ops, split=split_lines):
+    newer_units = split(newer)
+    parts = []
+    for op in ops:
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.append("".join(newer_units[op[0]:op[1]]))
+    return "".join(parts)
+
+
+def revision_ref(note_id, number):
+    return db.collection("notes").document(note_id).collection("revisions").document(f"{number:08d}")
+
+
+def encode_revision(number, newer, older):
+    """
+    Build the stored form of a revision: a snapshot on interval boundaries, a delta otherwise
+    """
+    ops = None if number % SNAPSHOT_INTERVAL == 0 else make_delta(newer, older)
+    if ops is None:
+        return {"kind": "snapshot", "data": zlib.compress(older.encode("utf-8"), COMPRESSION_LEVEL)}
+
+    data = zlib.compress(json.dumps(ops, separators=(",", ":")).encode("utf-8"), COMPRESSION_LEVEL)
+    # A delta that isn't smaller than the text itself isn't worth keeping
+    if len(data) >= len(older.encode("utf-8")):
+        return {"kind": "snapshot", "data": zlib.compress(older.encode("utf-8"), COMPRESSION_LEVEL)}
+    return {"kind": "delta", "unit": "line", "data": data}
+
+
+def decode_revision(revision, newer):
+    raw = zlib.decompress(revision["data"]).decode("utf-8")
+    if revision["kind"] == "snapshot":
+        return raw
+    split = split_lines if revision.get("unit") == "line" else tokenize
+    return apply_delta(newer, json.loads(raw), split)
+
+
+def add_revision(batch, note_id, note, old_content, new_content, uid):
+    """
+    Record the content being replaced by an update and return the new revisionInfo
+
+    The note itself always holds the newest text, and each stored revision is
+    kept relative to the one after it. Saving again within the coalescing
+    window drops the in-between autosave: the latest revision is re-encoded
+    against the new text instead of adding another one.
+    """
+    info = dict(note.get("revisionInfo") or {"count": 0})
+    now = time.time()
+
+    coalesce = (
+        info["count"] > 0
+        and info.get("lastBy") == uid
+        and now - info.get("lastAt", 0) < COALESCE_SECONDS
+    )
+
+    if coalesce:
+        number = info["count"]
+        latest_doc = revision_ref(note_id, number).get()
+        if latest_doc.exists:
+            latest = latest_doc.to_dict()
+            if latest["kind"] == "delta":
+                text = decode_revision(latest, old_content)
+                batch.update(latest_doc.reference, encode_revision(number, new_content, text))
+            info["lastAt"] = now
+            return info
+
+    number = info["count"] + 1
+    revision = encode_revision(number, new_content, old_content)
+    revision.update({
+        "number": number,
+        "length": len(old_content),
+        "savedAt": note.get("updatedAt"),
+        "replacedAt": create_server_timestamp(),
+        "createdBy": uid,
+    })
+    batch.set(revision_ref(note_id, number), revision)
+
+    info.update({"count": number, "lastAt": now, "lastBy": uid})
+    return info
+
+
+def list_revisions(note_id):
+    query = db.collection("notes").document(note_id).collection("revisions").order_by("number")
+    revisions = []
+    for revision_doc in query.select(["number", "kind", "length", "savedAt", "replacedAt", "createdBy"]).stream():
+        revisions.append(revision_doc.to_dict())
+    return revisions
+
+
+def load_revision(note_id, number, current_content):
+    """
+    Rebuild the text of a revision from the nearest newer snapshot, or from the current content
+
+    Reads at most SNAPSHOT_INTERVAL revision documents in one range query.
+    """
+    revisions_ref = db.collection("notes").document(note_id).collection("revisions")
+    upper = ((number // SNAPSHOT_INTERVAL) + 1) * SNAPSHOT_INTERVAL
+    query = revisions_ref.where("number", ">=", number).where("number", "<=", upper).order_by("number")
+    revisions = [revision_doc.to_dict() for revision_doc in query.stream()]
+
+    if not revisions or revisions[0]["number"] != number:
+        return None
+
+    # Rebuild from the nearest newer snapshot, or from the note itself when none is in range
+    end = next((index for index, revision in enumerate(revisions) if revision["kind"] == "snapshot"), None)
+    if end is None:
+        text = current_content
+        end = len(revisions)
+    else:
+        text = decode_revision(revisions[end], None)
+
+    for index in range(end - 1, -1, -1):
+        text = decode_revision(revisions[index], text)
+
+    return {key: revisions[0].get(key) for key in ("number", "kind", "length", "savedAt", "replacedAt", "createdBy")}, text
+
+
+def add_revision_deletes(batch, note_id, info):
+    for number in range(1, (info or {}).get("count", 0) + 1):
+        batch.delete(revision_ref(note_id, number))
@@ -0,0 +1,325 @@
+import hmac
+import re
+from datetime import datetime, timezone
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from urllib.parse import quote
+from firebase import db
+from middleware import get_current_user
+from rate_limit import route_cost
+from models import Attachment, UploadCreate, UploadStatus, User
+from datastore import get_document, forget_document
+from attachments import (
+    ATTACHMENTS_COLLECTION, MAX_ATTACHMENT_BYTES, UPLOADS_COLLECTION, QuotaExceeded,
+    blob_store, cancel_upload, create_upload, delete_attachment, finish_upload, format_attachment, stream_hashes,
+)
+
+router = APIRouter()
+# Downloads are authorized by the token in their URL, so they work from img tags and plain links
+download_router = APIRouter()
+
+# Request body bytes gathered before each write to the staged file
+WRITE_BUFFER_BYTES = 1024 * 1024
+# Types shown in the browser; anything else is always downloaded, so it can't run as a page of this site
+INLINE_TYPES = re.compile(r"^(image/(png|jpeg|gif|webp)|application/pdf|audio/[\w.+-]+|video/[\w.+-]+|text/plain)$")
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Uploads receiving a chunk right now on this instance
+receiving = set()
+
+
+def quota_exceeded(error):
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(error))
+
+
+async def owned_upload(upload_id, current_user):
+    upload_doc = await run_in_threadpool(db.collection(UPLOADS_COLLECTION).document(upload_id).get)
+    if not upload_doc.exists or upload_doc.get("ownerId") != current_user["uid"]:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Upload with ID {upload_id} not found"
+        )
+    upload = upload_doc.to_dict()
+    if upload["expiresAt"] < datetime.now(timezone.utc):
+        await run_in_threadpool(cancel_upload, upload_id)
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail=f"Upload with ID {upload_id} expired, please start again"
+        )
+    return upload
+
+
+async def owned_attachment(attachment_id, current_user):
+    attachment_doc = await get_document(ATTACHMENTS_COLLECTION, attachment_id)
+    if not attachment_doc.exists or attachment_doc.get("ownerId") != current_user["uid"]:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Attachment with ID {attachment_id} not found"
+        )
+    return attachment_doc.to_dict()
+
+
+def parse_range(header, size):
+    """
+    Turn a single-range Range header into inclusive byte offsets, None for the whole file
+    """
+    if not header:
+        return None
+    match = RANGE_PATTERN.match(header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        # A suffix range, the last N bytes
+        length = int(match.group(2))
+        if length == 0 or size == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(match.group(1))
+    if match.group(2) and int(match.group(2)) < start:
+        # Not a valid range at all, so it is ignored
+        return None
+    if start >= size:
+        raise ValueError(header)
+    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    return start, end
+
+
+@router.post("/uploads", response_model=UploadStatus)
+@route_cost(5)
+async def start_upload(upload: UploadCreate, current_user: User = Depends(get_current_user)):
+    """
+    Start a resumable upload
+
+    When a sha256 is given and the user already has an attachment with that
+    content, the new attachment is created right away and no bytes need to be sent.
+    """
+    if upload.size > MAX_ATTACHMENT_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Attachments can be at most {MAX_ATTACHMENT_BYTES} bytes"
+        )
+
+    try:
+        upload_id, attachment = await run_in_threadpool(
+            create_upload, current_user["uid"], upload.name, upload.contentType, upload.size, upload.sha256
+        )
+        if attachment is not None:
+            return {"id": None, "size": upload.size, "received": upload.size, "attachment": attachment}
+        if upload.size == 0:
+            attachment = await run_in_threadpool(finish_upload, upload_id, dict(upload.dict(), ownerId=current_user["uid"]))
+            return {"id": upload_id, "size": 0, "received": 0, "attachment": attachment}
+        return {"id": upload_id, "size": upload.size, "received": 0}
+    except QuotaExceeded as e:
+        raise quota_exceeded(e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to start upload: {str(e)}"
+        )
+
+
+@router.get("/uploads/{upload_id}", response_model=UploadStatus)
+async def get_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Get how many bytes of an upload were received, to resume it from there
+    """
+    try:
+        upload = await owned_upload(upload_id, current_user)
+        return {"id": upload_id, "size": upload["size"], "received": blob_store.staged_size(upload_id)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch upload: {str(e)}"
+        )
+
+
+@router.put("/uploads/{upload_id}", response_model=UploadStatus)
+@route_cost(5)
+async def upload_chunk(upload_id: str, offset: int, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Append the request body to an upload at the given offset
+
+    The offset must equal the bytes received so far; otherwise nothing is written
+    and a 409 reports where to resume. The upload completes with the chunk that
+    brings it to its full size, which returns the attachment.
+    """
+    upload = await owned_upload(upload_id, current_user)
+    if upload_id in receiving:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Another chunk of this upload is still being received"
+        )
+
+    receiving.add(upload_id)
+    try:
+        received = blob_store.staged_size(upload_id)
+        if offset != received:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Upload is at offset {received}, not {offset}",
+                headers={"Upload-Offset": str(received)},
+            )
+
+        buffer = bytearray()
+        async for piece in request.stream():
+            if received + len(buffer) + len(piece) > upload["size"]:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"Upload is only {upload['size']} bytes"
+                )
+            buffer.extend(piece)
+            if len(buffer) >= WRITE_BUFFER_BYTES:
+                received = await write_chunk(upload_id, received, bytes(buffer))
+                buffer.clear()
+        if buffer:
+            received = await write_chunk(upload_id, received, bytes(buffer))
+
+        if received < upload["size"]:
+            return {"id": upload_id, "size": upload["size"], "received": received}
+        attachment = await run_in_threadpool(finish_upload, upload_id, upload)
+        return {"id": upload_id, "size": upload["size"], "received": received, "attachment": attachment}
+    except QuotaExceeded as e:
+        raise quota_exceeded(e)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to upload chunk: {str(e)}"
+        )
+    finally:
+        receiving.discard(upload_id)
+
+
+async def write_chunk(upload_id, offset, data):
+    # Hashed as it arrives, so completing the upload doesn't read the whole file again
+    stream_hashes.feed(upload_id, offset, data)
+    await run_in_threadpool(blob_store.append, upload_id, data)
+    return offset + len(data)
+
+
+@router.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Abandon an upload and drop the bytes received so far
+    """
+    try:
+        await owned_upload(upload_id, current_user)
+        await run_in_threadpool(cancel_upload, upload_id)
+        return {"message": "Upload cancelled"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to cancel upload: {str(e)}"
+        )
+
+
+@router.get("/{attachment_id}", response_model=Attachment)
+async def get_attachment(attachment_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Get one of the current user's attachments
+    """
+    try:
+        return format_attachment(attachment_id, await owned_attachment(attachment_id, current_user))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch attachment: {str(e)}"
+        )
+
+
+@router.delete("/{attachment_id}")
+async def remove_attachment(attachment_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Delete an attachment; its content is removed once no other attachment uses it
+    """
+    try:
+        await owned_attachment(attachment_id, current_user)
+        await run_in_threadpool(delete_attachment, attachment_id)
+        forget_document(ATTACHMENTS_COLLECTION, attachment_id)
+        return {"message": "Attachment deleted successfully"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to delete attachment: {str(e)}"
+        )
+
+
+@download_router.get("/{attachment_id}/content")
+async def download_attachment(attachment_id: str, token: str, request: Request):
+    """
+    Download an attachment, or the byte range asked for with a Range header
+    """
+    try:
+        attachment_doc = await get_document(ATTACHMENTS_COLLECTION, attachment_id)
+        if not attachment_doc.exists or not hmac.compare_digest(attachment_doc.get("token").encode(), token.encode()):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Attachment with ID {attachment_id} not found"
+            )
+        attachment = attachment_doc.to_dict()
+        size = attachment["size"]
+        inline = INLINE_TYPES.match(attachment["contentType"])
+        headers = {
+            "ETag": f'"{attachment["sha256"]}"',
+            "Accept-Ranges": "bytes",
+            # The content behind an attachment never changes
+            "Cache-Control": "private, max-age=31536000, immutable",
+            "Content-Disposition": f"{'inline' if inline else 'attachment'}; filename*=UTF-8''{quote(attachment['name'])}",
+            "X-Content-Type-Options": "nosniff",
+            "Content-Security-Policy": "default-src 'none'; sandbox",
+        }
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        if not blob_store.has(attachment["sha256"]):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Content of attachment {attachment_id} is not stored on this server"
+            )
+
+        # A Range only applies while the client's copy is still the current one
+        if_range = request.headers.get("if-range")
+        byte_range = None
+        if not if_range or if_range == headers["ETag"]:
+            try:
+                byte_range = parse_range(request.headers.get("range"), size)
+            except ValueError:
+                return Response(
+                    status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                    headers={"Content-Range": f"bytes */{size}"},
+                )
+
+        media_type = attachment["contentType"] if inline else "application/octet-stream"
+        if byte_range is None:
+            headers["Content-Length"] = str(size)
+            return StreamingResponse(blob_store.read(attachment["sha256"], 0, size - 1), media_type=media_type, headers=headers)
+
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            blob_store.read(attachment["sha256"], start, end),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type=media_type,
+            headers=headers,
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to download attachment: {str(e)}"
+        )
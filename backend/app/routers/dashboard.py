@@ -0,0 +1,102 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+import asyncio
+import hashlib
+import json
+from firebase_admin import firestore
+from firebase import db
+from middleware import get_current_user
+from rate_limit import route_cost
+from models import Dashboard, User
+from utils import format_doc
+from cache import dashboard_cache
+from counters import recount_subject
+from content_store import list_item
+from routers.shares import collect_shared_with_me
+
+router = APIRouter()
+
+RECENT_NOTES_LIMIT = 10
+DASHBOARD_MAX_AGE = 30
+
+
+def fetch_subjects(uid):
+    """
+    Fetch the subjects owned by a user, newest first
+    """
+    query = db.collection("subjects").where("createdBy", "==", uid).order_by("createdAt", direction=firestore.Query.DESCENDING)
+    return [format_doc(doc) for doc in query.get()]
+
+
+def fetch_recent_notes(uid, limit=RECENT_NOTES_LIMIT):
+    """
+    Fetch the most recently updated notes owned by a user
+    """
+    query = db.collection("notes").where("createdBy", "==", uid).order_by("updatedAt", direction=firestore.Query.DESCENDING).limit(limit)
+    return [list_item(format_doc(doc)) for doc in query.get()]
+
+
+def build_dashboard(subjects, recent_notes, shared_with_me):
+    """
+    Assemble the dashboard payload from the fetched pieces
+    """
+    # Note and tag counts come from the counters maintained on each subject;
+    # subjects written before the counters existed are backfilled once
+    for subject in subjects:
+        if subject.get("noteCount") is None or subject.get("tagCounts") is None:
+            subject.update(recount_subject(subject["id"]))
+
+    tags = {tag for subject in subjects for tag, count in (subject.get("tagCounts") or {}).items() if count > 0}
+    return {
+        "subjects": subjects,
+        "recentNotes": recent_notes,
+        "tags": sorted(tags),
+        "sharedWithMe": shared_with_me,
+    }
+
+
+@router.get("/", response_model=Dashboard)
+@route_cost(20)
+async def get_dashboard(request: Request, response: Response, current_user: User = Depends(get_current_user)):
+    """
+    Get everything the dashboard needs for its first paint in a single request
+    """
+    try:
+        uid = current_user["uid"]
+        cached = dashboard_cache.get(uid)
+
+        if cached is None:
+            # Run the independent Firestore reads concurrently
+            subjects, recent_notes, shared_with_me = await asyncio.gather(
+                run_in_threadpool(fetch_subjects, uid),
+                run_in_threadpool(fetch_recent_notes, uid),
+                run_in_threadpool(collect_shared_with_me, current_user),
+            )
+
+            dashboard = await run_in_threadpool(build_dashboard, subjects, recent_notes, shared_with_me)
+            payload = jsonable_encoder(dashboard)
+            etag = '"%s"' % hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+            cached = (etag, payload)
+            dashboard_cache.set(uid, cached)
+
+        etag, payload = cached
+        headers = {
+            "ETag": etag,
+            "Cache-Control": f"private, max-age={DASHBOARD_MAX_AGE}",
+            "Vary": "Authorization",
+        }
+
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        for key, value in headers.items():
+            response.headers[key] = value
+        return payload
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch dashboard: {str(e)}"
+        )
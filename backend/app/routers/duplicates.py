@@ -0,0 +1,55 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from typing import List
+from firebase import db
+from middleware import get_current_user
+from rate_limit import route_cost
+from models import DuplicateCluster, DuplicateNote, User
+from minhash import PUBLIC_SCOPE, find_clusters, find_duplicates
+from routers.notes import check_note_access
+
+router = APIRouter()
+
+
+@router.get("/duplicates", response_model=List[DuplicateCluster])
+@route_cost(30, heavy=True)
+async def get_duplicate_clusters(current_user: User = Depends(get_current_user)):
+    """
+    Get groups of the current user's notes that are near-duplicates of each other, largest first
+    """
+    try:
+        return await run_in_threadpool(find_clusters, current_user["uid"])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to find duplicate notes: {str(e)}"
+        )
+
+
+@router.get("/notes/{note_id}/duplicates", response_model=List[DuplicateNote])
+@route_cost(10)
+async def get_note_duplicates(
+    note_id: str,
+    scope: str = Query("own", regex="^(own|public)$"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Get near-duplicates of a note among the current user's notes or among publicly shared notes
+    """
+    await check_note_access(note_id, current_user)
+    try:
+        note_doc = await run_in_threadpool(
+            db.collection("notes").document(note_id).get,
+            ["minhash", "lshBuckets"]
+        )
+        index_scope = PUBLIC_SCOPE if scope == "public" else current_user["uid"]
+        return await run_in_threadpool(find_duplicates, note_id, note_doc.to_dict() or {}, index_scope)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to find duplicate notes: {str(e)}"
+        )
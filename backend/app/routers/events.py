@@ -0,0 +1,93 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from typing import Optional
+import asyncio
+import json
+from middleware import get_current_user
+from models import User
+from realtime import hub
+from grants import verified_email
+from routers.subjects import get_subject_by_id
+
+router = APIRouter()
+
+HEARTBEAT_SECONDS = 15
+MAX_SUBJECT_SUBSCRIPTIONS = 20
+
+
+def format_event(event):
+    """
+    Serialize an event in the Server-Sent Events wire format
+    """
+    lines = []
+    if "id" in event:
+        lines.append(f"id: {hub.token(event['id'])}")
+    lines.append(f"event: {event['type']}")
+    payload = {"channel": event.get("channel"), "data": event.get("data")}
+    lines.append(f"data: {json.dumps(jsonable_encoder(payload))}")
+    return "\n".join(lines) + "\n\n"
+
+
+@router.get("/")
+async def stream_changes(
+    request: Request,
+    subjects: Optional[str] = None,
+    since: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Stream note, subject and share changes for the current user as Server-Sent Events
+    """
+    subject_ids = [subject_id for subject_id in (subjects or "").split(",") if subject_id]
+    if len(subject_ids) > MAX_SUBJECT_SUBSCRIPTIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cannot subscribe to more than {MAX_SUBJECT_SUBSCRIPTIONS} subjects"
+        )
+
+    # Check access once up front, grants and ancestors included; later changes are filtered per event
+    for subject_id in subject_ids:
+        await get_subject_by_id(subject_id, current_user)
+
+    keys = [f"owner:{current_user['uid']}"]
+    # sharedWith holds normalized emails, and only verified ones may follow what is shared with them
+    email = verified_email(current_user)
+    if email:
+        keys.append(f"shared:{email}")
+    keys.extend(f"subject:{subject_id}" for subject_id in subject_ids)
+
+    try:
+        subscriber = hub.subscribe(current_user, keys, since=last_event_id or since, viewable=subject_ids)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to subscribe to changes: {str(e)}"
+        )
+
+    async def event_stream():
+        try:
+            # Give the client a resume point even before the first change, unless replayed events follow
+            ready = {"type": "ready", "data": {}}
+            if subscriber.queue.empty():
+                ready["id"] = hub.last_seq
+            yield "retry: 5000\n" + format_event(ready)
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+
+                yield format_event(event)
+                if event["type"] == "resync" and subscriber.overflowed:
+                    break
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,469 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+import asyncio
+import functools
+import json
+import tempfile
+import zipfile
+from datetime import datetime, timezone
+from firebase import db
+from middleware import get_current_user
+from rate_limit import route_cost
+from models import NoteCreate, ShareCreate, SubjectCreate, User
+from utils import format_doc, create_server_timestamp, estimate_size, BatchWriter, MAX_BATCH_BYTES
+from cache import invalidate_user_views
+from tag_index import tag_indexes
+from related import related_indexes
+from datastore import iter_query
+from content_store import add_content_writes, content_fields, load_contents
+from minhash import add_bucket_writes
+from outbox import worker_pool
+from outbox_handlers import add_share_changed
+from subject_tree import MAX_SUBJECT_DEPTH, path_fields
+
+router = APIRouter()
+
+EXPORT_VERSION = 1
+EXPORT_ENTRY_NAME = "library.ndjson"
+SUBJECT_EXPORT_FIELDS = ["id", "title", "description", "parentId", "createdAt", "updatedAt"]
+NOTE_EXPORT_FIELDS = ["id", "title", "subjectId", "mediaItems", "tags", "createdAt", "updatedAt"]
+SHARE_EXPORT_FIELDS = ["itemId", "itemType", "shareType", "sharedWith", "message", "permissions"]
+
+# Notes whose content is loaded with one multi-document read during export
+EXPORT_NOTE_PAGE_SIZE = 100
+# Compressed bytes buffered before a ZIP export yields them to the client
+ZIP_FLUSH_BYTES = 64 * 1024
+
+IMPORT_BATCH_OPS = 400
+IMPORT_BATCH_BYTES = MAX_BATCH_BYTES
+IMPORT_PARALLEL_BATCHES = 4
+IMPORT_READ_BYTES = 64 * 1024
+MAX_IMPORT_ERRORS = 100
+
+
+def pick(data, fields):
+    return {field: data.get(field) for field in fields if field in data}
+
+
+def export_notes(notes, tag_counts):
+    contents = load_contents(notes)
+    for note in notes:
+        for tag in note.get("tags") or []:
+            tag_counts[tag] = tag_counts.get(tag, 0) + 1
+        record = pick(note, NOTE_EXPORT_FIELDS)
+        record["content"] = contents[note["id"]]
+        yield {"type": "note", "data": record}
+
+
+def export_records(current_user):
+    """
+    Yield the user's library record by record, paging through Firestore as it goes
+    """
+    uid = current_user["uid"]
+    yield {"type": "header", "data": {"version": EXPORT_VERSION, "exportedAt": datetime.now(timezone.utc).isoformat()}}
+
+    # Parents are written before the subjects nested in them, so imports can resolve them in one pass
+    subjects = [format_doc(subject_doc) for subject_doc in iter_query(db.collection("subjects").where("createdBy", "==", uid))]
+    for subject in sorted(subjects, key=lambda subject: subject.get("depth") or 0):
+        yield {"type": "subject", "data": pick(subject, SUBJECT_EXPORT_FIELDS)}
+
+    tag_counts = {}
+    page = []
+    for note_doc in iter_query(db.collection("notes").where("createdBy", "==", uid)):
+        page.append(format_doc(note_doc))
+        if len(page) == EXPORT_NOTE_PAGE_SIZE:
+            yield from export_notes(page, tag_counts)
+            page = []
+    yield from export_notes(page, tag_counts)
+
+    for share_doc in iter_query(db.collection("shares").where("sharedBy", "==", uid)):
+        yield {"type": "share", "data": pick(format_doc(share_doc), SHARE_EXPORT_FIELDS)}
+
+    for tag, count in sorted(tag_counts.items()):
+        yield {"type": "tag", "data": {"name": tag, "count": count}}
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield (json.dumps(jsonable_encoder(record), ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class ZipStream:
+    """
+    Write-only file object that hands what ZipFile writes back to a generator
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def zip_chunks(records):
+    """
+    Produce a ZIP archive incrementally; ZipFile falls back to data descriptors on unseekable output
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(EXPORT_ENTRY_NAME, "w", force_zip64=True) as entry:
+            for line in ndjson_lines(records):
+                entry.write(line)
+                if stream.size >= ZIP_FLUSH_BYTES:
+                    yield stream.drain()
+    yield stream.drain()
+
+
+@router.get("/export")
+@route_cost(200, heavy=True)
+async def export_library(
+    format: str = Query("ndjson", regex="^(ndjson|zip)$"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Stream the current user's subjects, notes, share settings and tags as NDJSON or a ZIP of NDJSON
+    """
+    records = export_records(current_user)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d")
+
+    if format == "zip":
+        return StreamingResponse(
+            zip_chunks(records),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="studyhub-export-{stamp}.zip"'},
+        )
+
+    return StreamingResponse(
+        ndjson_lines(records),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="studyhub-export-{stamp}.ndjson"'},
+    )
+
+
+class PendingWrites:
+    """
+    Collects the writes for one imported record so they land in the same batch
+    """
+
+    def __init__(self, kind, item_id):
+        self.kind = kind
+        self.item_id = item_id
+        self.ops = []
+        self.bytes = 0
+        # Counter changes a note applies to its subject once it is committed
+        self.subject_id = None
+        self.stats = None
+
+    def set(self, ref, data, merge=False):
+        self.ops.append((ref, data, merge))
+        self.bytes += estimate_size(ref.path) + estimate_size(data)
+
+
+def parse_time(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def empty_stats():
+    return {"noteCount": 0, "contentSize": 0, "tagCounts": {}}
+
+
+class LibraryImporter:
+    """
+    Validates imported records and writes them in bounded, parallel batches
+    """
+
+    def __init__(self, current_user, include_shares):
+        self.user = current_user
+        self.include_shares = include_shares
+        self.subject_ids = {}
+        self.subject_paths = {}
+        self.note_ids = {}
+        self.subject_stats = {}
+        self.shares = []
+        self.batch = db.batch()
+        self.batch_ops = 0
+        self.batch_bytes = 0
+        self.batch_records = []
+        # New ids whose batch committed or failed; counters and shares only refer to committed ones
+        self.committed_ids = set()
+        self.failed_ids = set()
+        self.slots = asyncio.Semaphore(IMPORT_PARALLEL_BATCHES)
+        self.pending = set()
+        self.summary = {"subjects": 0, "notes": 0, "shares": 0, "skipped": 0, "errors": []}
+
+    def error(self, line_number, message, skipped=1):
+        self.summary["skipped"] += skipped
+        if len(self.summary["errors"]) < MAX_IMPORT_ERRORS:
+            self.summary["errors"].append({"line": line_number, "error": message})
+
+    async def add(self, writes):
+        # Notes with large content fill a batch's commit size long before its op count
+        if self.batch_ops + len(writes.ops) > IMPORT_BATCH_OPS or self.batch_bytes + writes.bytes > IMPORT_BATCH_BYTES:
+            await self.flush()
+        for ref, data, merge in writes.ops:
+            self.batch.set(ref, data, merge=merge)
+        self.batch_ops += len(writes.ops)
+        self.batch_bytes += writes.bytes
+        self.batch_records.append(writes)
+
+    async def flush(self):
+        if not self.batch_ops:
+            return
+        batch, records = self.batch, self.batch_records
+        self.batch = db.batch()
+        self.batch_ops = 0
+        self.batch_bytes = 0
+        self.batch_records = []
+
+        # Waiting for a free slot here is what keeps memory bounded on huge imports
+        await self.slots.acquire()
+        task = asyncio.ensure_future(run_in_threadpool(batch.commit))
+        self.pending.add(task)
+        task.add_done_callback(functools.partial(self.committed, records))
+
+    def committed(self, records, task):
+        self.pending.discard(task)
+        self.slots.release()
+        if task.exception() is not None:
+            self.failed_ids.update(writes.item_id for writes in records)
+            self.error(None, f"Batch write of {len(records)} records failed: {task.exception()}", skipped=len(records))
+            return
+
+        # Only what actually landed is counted, in the summary and in the subject counters
+        for writes in records:
+            self.committed_ids.add(writes.item_id)
+            self.summary[f"{writes.kind}s"] += 1
+            if writes.kind == "subject":
+                self.subject_stats.setdefault(writes.item_id, empty_stats())
+            elif writes.stats is not None:
+                stats = self.subject_stats.setdefault(writes.subject_id, empty_stats())
+                stats["noteCount"] += 1
+                stats["contentSize"] += writes.stats["contentSize"]
+                for tag in writes.stats["tags"]:
+                    stats["tagCounts"][tag] = stats["tagCounts"].get(tag, 0) + 1
+
+    def prepare_subject(self, record):
+        parent = None
+        if record.get("parentId"):
+            parent = self.subject_paths.get(record["parentId"])
+            if parent is None:
+                raise ValueError(f"Unknown parent subject {record['parentId']}")
+
+        subject = SubjectCreate(**dict(record, parentId=None))
+        subject_ref = db.collection("subjects").document()
+        subject_data = subject.dict()
+        subject_data.update(path_fields(parent))
+        if subject_data["depth"] > MAX_SUBJECT_DEPTH:
+            raise ValueError(f"Subject nested more than {MAX_SUBJECT_DEPTH + 1} levels deep")
+        subject_data["createdBy"] = self.user["uid"]
+        subject_data["createdAt"] = parse_time(record.get("createdAt")) or create_server_timestamp()
+        subject_data["updatedAt"] = create_server_timestamp()
+
+        writes = PendingWrites("subject", subject_ref.id)
+        writes.set(subject_ref, subject_data)
+        self.subject_ids[record.get("id")] = subject_ref.id
+        self.subject_paths[record.get("id")] = {"id": subject_ref.id, "ancestors": subject_data["ancestors"]}
+        return writes
+
+    def prepare_note(self, record):
+        subject_id = self.subject_ids.get(record.get("subjectId"))
+        if subject_id is None:
+            raise ValueError(f"Unknown subject {record.get('subjectId')}")
+        if subject_id in self.failed_ids:
+            raise ValueError(f"Subject {record.get('subjectId')} was not imported")
+
+        note = NoteCreate(**dict(record, subjectId=subject_id))
+        note_ref = db.collection("notes").document()
+        note_data = note.dict()
+        content = note_data.pop("content")
+        note_data["createdBy"] = self.user["uid"]
+        note_data["createdAt"] = parse_time(record.get("createdAt")) or create_server_timestamp()
+        # A fresh updatedAt makes imported notes visible to other devices' delta sync
+        note_data["updatedAt"] = create_server_timestamp()
+        note_data["isShared"] = False
+
+        writes = PendingWrites("note", note_ref.id)
+        info = add_content_writes(writes, note_ref.id, content)
+        note_data.update(content_fields(content, info))
+        add_bucket_writes(writes, [self.user["uid"]], note_ref.id, new_keys=note_data["lshBuckets"])
+        writes.set(note_ref, note_data)
+
+        writes.subject_id = subject_id
+        writes.stats = {"contentSize": info["bytes"], "tags": set(note_data.get("tags") or [])}
+
+        if self.include_shares:
+            self.note_ids[record.get("id")] = note_ref.id
+        return writes
+
+    async def handle(self, line_number, record):
+        kind = record.get("type")
+        data = record.get("data") or {}
+
+        if kind == "header":
+            if data.get("version") != EXPORT_VERSION:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Unsupported export version: {data.get('version')}"
+                )
+        elif kind == "subject":
+            await self.add(self.prepare_subject(data))
+        elif kind == "note":
+            # Content parsing and compression are CPU work; keep them off the event loop
+            await self.add(await run_in_threadpool(self.prepare_note, data))
+        elif kind == "share":
+            if self.include_shares:
+                self.shares.append((line_number, ShareCreate(**data)))
+        elif kind != "tag":
+            raise ValueError(f"Unknown record type: {kind}")
+
+    def write_subject_stats(self):
+        writer = BatchWriter(db)
+        # Subjects whose batch failed were never written, so there is nothing to update
+        for subject_id, stats in self.subject_stats.items():
+            if subject_id not in self.committed_ids:
+                continue
+            writer.update(db.collection("subjects").document(subject_id), stats)
+        writer.commit()
+
+    def write_shares(self):
+        writer = BatchWriter(db)
+        written = 0
+        for line_number, share in self.shares:
+            item_ids = self.subject_ids if share.itemType == "subject" else self.note_ids
+            item_id = item_ids.get(share.itemId)
+            if item_id is None:
+                self.error(line_number, f"Unknown shared {share.itemType} {share.itemId}")
+                continue
+            if item_id not in self.committed_ids:
+                self.error(line_number, f"Shared {share.itemType} {share.itemId} was not imported")
+                continue
+
+            share_data = share.dict()
+            share_data["itemId"] = item_id
+            share_data["sharedBy"] = self.user["uid"]
+            share_data["sharedAt"] = create_server_timestamp()
+            share_data["updatedAt"] = create_server_timestamp()
+            writer.set(db.collection("shares").document(), share_data)
+            add_share_changed(writer, share.itemType, item_id, self.user["uid"])
+            written += 1
+        try:
+            writer.commit()
+        except Exception as e:
+            # The subjects and notes are already in; report the shares instead of failing the import
+            self.error(None, f"Writing shares failed: {str(e)}", skipped=written)
+            return
+        self.summary["shares"] += written
+        worker_pool.wake()
+
+    async def finish(self):
+        await self.flush()
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+
+        # Counters and shares refer to documents that must exist by now
+        await run_in_threadpool(self.write_subject_stats)
+        if self.shares:
+            await run_in_threadpool(self.write_shares)
+        return self.summary
+
+
+async def request_chunks(request):
+    async for chunk in request.stream():
+        yield chunk
+
+
+async def zip_entry_chunks(request):
+    """
+    Spool an uploaded ZIP to disk, since its index is at the end, then stream its NDJSON entry
+    """
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+        async for chunk in request.stream():
+            await run_in_threadpool(spool.write, chunk)
+        spool.seek(0)
+
+        with zipfile.ZipFile(spool) as archive:
+            with archive.open(EXPORT_ENTRY_NAME) as entry:
+                while True:
+                    chunk = await run_in_threadpool(entry.read, IMPORT_READ_BYTES)
+                    if not chunk:
+                        break
+                    yield chunk
+
+
+async def iter_lines(chunks):
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+@router.post("/import")
+@route_cost(200, heavy=True)
+async def import_library(
+    request: Request,
+    include_shares: bool = Query(False, alias="includeShares"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Import a library export as NDJSON, or as a ZIP when sent with Content-Type application/zip
+
+    Records are validated against the same models as the regular endpoints and
+    written as new subjects and notes owned by the current user. Share
+    settings are only recreated when includeShares is set.
+    """
+    importer = LibraryImporter(current_user, include_shares)
+    is_zip = request.headers.get("content-type", "").startswith("application/zip")
+    chunks = zip_entry_chunks(request) if is_zip else request_chunks(request)
+
+    try:
+        line_number = 0
+        async for line in iter_lines(chunks):
+            line_number += 1
+            if not line.strip():
+                continue
+            try:
+                await importer.handle(line_number, json.loads(line))
+            except (ValueError, ValidationError) as e:
+                importer.error(line_number, str(e))
+
+        summary = await importer.finish()
+        invalidate_user_views(current_user["uid"])
+        tag_indexes.invalidate(current_user["uid"])
+        related_indexes.forget(current_user["uid"])
+        return summary
+    except HTTPException:
+        raise
+    except zipfile.BadZipFile as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid ZIP archive: {str(e)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to import library: {str(e)}"
+        )
@@ -1,29 +1,50 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Optional
 import firebase_admin
 from firebase_admin import firestore
 from firebase import db
 from middleware import get_current_user
-from models import Note, NoteCreate, User
-from utils import format_doc, create_server_timestamp
-from routers.subjects import get_subject_by_id
+from rate_limit import route_cost
+from models import Note, NoteCreate, User, BatchGetRequest, NoteBatchResult
+from utils import format_doc, create_server_timestamp, BatchWriter
+from cache import invalidate_user_views
+from tag_index import tag_indexes
+from related import related_indexes
+from public_snapshots import snapshots
+from minhash import add_bucket_writes, note_scopes
+from counters import add_note_created, add_note_updated, add_note_deleted, subject_exists
+from tombstones import add_tombstone
+from datastore import get_document, read_document, commit, forget_document
+from acl import can_view_note, fetch_documents, viewable_note_ids
+from grants import GRANTS_COLLECTION, grant_id
+from revisions import add_revision
+from outbox import worker_pool
+from outbox_handlers import add_note_cleanup
+from content_store import add_content_writes, add_content_deletes, content_fields, load_content, list_item, full_item, select_for_view, shape_for_view
+from routers.subjects import get_subject_by_id, unique_batch_ids, forget_subject_notes
 
 router = APIRouter()
 
 
 @router.get("/", response_model=List[Note])
-async def get_recent_notes(limit: int = 10, current_user: User = Depends(get_current_user)):
+@route_cost(5)
+async def get_recent_notes(limit: int = 10, view: str = Query("preview", regex="^(preview|summary)$"), current_user: User = Depends(get_current_user)):
     """
     Get recent notes across all subjects for the current user
+
+    The summary view skips the content preview and returns only the derived fields.
     """
     try:
         notes_ref = db.collection("notes")
         query = notes_ref.where("createdBy", "==", current_user["uid"]).order_by("updatedAt", direction=firestore.Query.DESCENDING).limit(limit)
-        notes_docs = query.get()
+        notes_docs = select_for_view(query, view).get()
         
         # Format and return the results
-        notes = [format_doc(doc) for doc in notes_docs]
+        notes = [shape_for_view(format_doc(doc), view) for doc in notes_docs]
         return notes
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -31,14 +52,12 @@ async def get_recent_notes(limit: int = 10, current_user: User = Depends(get_cur
         )
 
 
-@router.get("/{note_id}", response_model=Note)
-async def get_note_by_id(note_id: str, current_user: User = Depends(get_current_user)):
+async def check_note_access(note_id: str, current_user: User):
     """
-    Get a specific note by ID
+    Get a note's document, without its content, if the user may view it
     """
     try:
-        note_ref = db.collection("notes").document(note_id)
-        note_doc = note_ref.get()
+        note_doc = await get_document("notes", note_id)
         
         if not note_doc.exists:
             raise HTTPException(
@@ -49,8 +68,8 @@ async def get_note_by_id(note_id: str, current_user: User = Depends(get_current_
         note = format_doc(note_doc)
         
         # Check if user has access to this note
-        # First, check if they're the owner
-        if note["createdBy"] == current_user["uid"]:
+        # First, check if they're the owner or the note's sharing fields name them
+        if can_view_note(note, None, current_user):
             return note
         
         # Next, check if they have access to the parent subject
@@ -60,19 +79,9 @@ async def get_note_by_id(note_id: str, current_user: User = Depends(get_current_
         except HTTPException:
             pass
         
-        # Lastly, check if the note is specifically shared with the user
-        shares_ref = db.collection("shares")
-        query = shares_ref.where("itemId", "==", note_id).where("itemType", "==", "note")
-        
-        # Check for public shares
-        public_query = query.where("shareType", "==", "public")
-        public_shares = public_query.get()
-        
-        # Check for specific shares
-        specific_query = query.where("shareType", "==", "specific").where("sharedWith", "array_contains", current_user["email"])
-        specific_shares = specific_query.get()
-        
-        if len(list(public_shares)) == 0 and len(list(specific_shares)) == 0:
+        # Lastly, check for a grant on the note itself, a direct document read
+        grant_doc = await get_document(GRANTS_COLLECTION, grant_id("note", note_id, current_user["uid"]))
+        if not grant_doc.exists:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="You don't have access to this note"
@@ -88,6 +97,115 @@ async def get_note_by_id(note_id: str, current_user: User = Depends(get_current_
         )
 
 
+@router.get("/{note_id}", response_model=Note)
+async def get_note_by_id(note_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Get a specific note by ID, including its full content
+    """
+    note = await check_note_access(note_id, current_user)
+    try:
+        content = await run_in_threadpool(load_content, note_id, note)
+        return full_item(note, content)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch note content: {str(e)}"
+        )
+
+
+@router.get("/{note_id}/content")
+async def get_note_content(
+    note_id: str,
+    offset: int = Query(0, ge=0),
+    length: Optional[int] = Query(None, ge=1),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Get a character range of a note's content, reading only the chunks it spans
+    """
+    note = await check_note_access(note_id, current_user)
+    try:
+        content = await run_in_threadpool(load_content, note_id, note, offset, length)
+        total = note["contentInfo"]["length"] if note.get("contentInfo") else len(note.get("content") or "")
+        return {"content": content, "offset": offset, "length": len(content), "totalLength": total}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch note content: {str(e)}"
+        )
+
+
+@router.post("/batch", response_model=NoteBatchResult)
+@route_cost(5)
+async def get_notes_batch(batch: BatchGetRequest, current_user: User = Depends(get_current_user)):
+    """
+    Get several notes at once, reporting which were found, forbidden or missing
+    """
+    try:
+        ids = unique_batch_ids(batch)
+        
+        docs = await run_in_threadpool(fetch_documents, "notes", ids)
+        notes = [format_doc(docs[note_id]) for note_id in ids if note_id in docs]
+        
+        # Only notes owned by someone else need their subject for the access check
+        subject_ids = {note.get("subjectId") for note in notes if note.get("createdBy") != current_user["uid"]}
+        subject_docs = await run_in_threadpool(fetch_documents, "subjects", [subject_id for subject_id in subject_ids if subject_id])
+        subjects_by_id = {subject_id: format_doc(doc) for subject_id, doc in subject_docs.items()}
+        allowed = await run_in_threadpool(viewable_note_ids, notes, subjects_by_id, current_user)
+        
+        return {
+            "found": [list_item(note) for note in notes if note["id"] in allowed],
+            "forbidden": [note["id"] for note in notes if note["id"] not in allowed],
+            "missing": [note_id for note_id in ids if note_id not in docs],
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch notes: {str(e)}"
+        )
+
+
+def write_content(note_id, content):
+    """
+    Write a note body's chunks ahead of the note document that points at them
+    """
+    writer = BatchWriter(db)
+    info = add_content_writes(writer, note_id, content)
+    writer.commit()
+    return info
+
+
+def write_new_note(note_ref, note_data, content, uid):
+    """
+    Write a new note with its content, buckets and subject counters, note document last
+    """
+    batch = BatchWriter(db)
+    info = add_content_writes(batch, note_ref.id, content)
+    note_data.update(content_fields(content, info))
+    add_bucket_writes(batch, [uid], note_ref.id, new_keys=note_data["lshBuckets"])
+    batch.set(note_ref, note_data)
+    add_note_created(batch, note_data)
+    batch.commit()
+
+
+def write_note_update(batch, note_ref, note, update_data, old_subject_exists):
+    """
+    Switch a note over to its new body with its buckets and counters, old chunks last
+    """
+    batch.update(note_ref, update_data)
+    add_bucket_writes(batch, note_scopes(note), note_ref.id, note.get("lshBuckets"), update_data["lshBuckets"])
+    add_note_updated(batch, note, update_data, old_subject_exists)
+    # Nothing points at the old chunks any more, so a commit cut short only leaves them behind
+    add_content_deletes(batch, note_ref.id, note.get("contentInfo"))
+    batch.commit()
+
+
 @router.post("/", response_model=Note)
 async def create_note(note: NoteCreate, current_user: User = Depends(get_current_user)):
     """
@@ -97,20 +215,25 @@ async def create_note(note: NoteCreate, current_user: User = Depends(get_current
         # First check if user has access to the subject
         await get_subject_by_id(note.subjectId, current_user)
         
-        # Prepare note data
+        # Prepare note data; the body is stored in chunks outside the note document
         note_data = note.dict()
+        content = note_data.pop("content")
         note_data["createdBy"] = current_user["uid"]
         note_data["createdAt"] = create_server_timestamp()
         note_data["updatedAt"] = create_server_timestamp()
         note_data["isShared"] = False
         
-        # Add to Firestore
+        # Add to Firestore together with the subject counters, note document last
         note_ref = db.collection("notes").document()
-        note_ref.set(note_data)
+        await run_in_threadpool(write_new_note, note_ref, note_data, content, current_user["uid"])
+        forget_subject_notes(note.subjectId)
+        invalidate_user_views(current_user["uid"])
+        tag_indexes.note_changed(current_user["uid"], None, note_data.get("tags"))
+        related_indexes.note_changed(current_user["uid"], note_ref.id, note_data["title"], content, note_data.get("tags"))
         
         # Get the newly created note
-        created_note = note_ref.get()
-        return format_doc(created_note)
+        created_note = await run_in_threadpool(read_document, note_ref)
+        return full_item(format_doc(created_note), content)
     except HTTPException:
         raise
     except Exception as e:
@@ -121,6 +244,7 @@ async def create_note(note: NoteCreate, current_user: User = Depends(get_current
 
 
 @router.put("/{note_id}", response_model=Note)
+@route_cost(5)
 async def update_note(note_id: str, note_data: NoteCreate, current_user: User = Depends(get_current_user)):
     """
     Update a note
@@ -128,7 +252,7 @@ async def update_note(note_id: str, note_data: NoteCreate, current_user: User =
     try:
         # Check if note exists and user owns it
         note_ref = db.collection("notes").document(note_id)
-        note_doc = note_ref.get()
+        note_doc = await get_document("notes", note_id)
         
         if not note_doc.exists:
             raise HTTPException(
@@ -146,15 +270,36 @@ async def update_note(note_id: str, note_data: NoteCreate, current_user: User =
         # Check if the subject exists and user has access
         await get_subject_by_id(note_data.subjectId, current_user)
         
-        # Update the note
+        # Write the new body first, then switch the note over to it in one batch
         update_data = note_data.dict()
+        content = update_data.pop("content")
+        info = await run_in_threadpool(write_content, note_id, content)
+        
+        update_data.update(await run_in_threadpool(content_fields, content, info))
+        update_data["content"] = firestore.DELETE_FIELD
         update_data["updatedAt"] = create_server_timestamp()
         
-        note_ref.update(update_data)
+        # A long note has many old chunks to delete, so the writes may span several batches
+        batch = BatchWriter(db)
+        
+        # Keep the replaced content in the note's revision history
+        old_content = await run_in_threadpool(load_content, note_id, note)
+        if old_content != content:
+            update_data["revisionInfo"] = await run_in_threadpool(add_revision, batch, note_id, note, old_content, content, current_user["uid"])
+        
+        old_subject_exists = note.get("subjectId") == note_data.subjectId or await run_in_threadpool(subject_exists, note.get("subjectId"))
+        await run_in_threadpool(write_note_update, batch, note_ref, note, update_data, old_subject_exists)
+        forget_document("notes", note_id)
+        forget_subject_notes(note.get("subjectId"))
+        forget_subject_notes(note_data.subjectId)
+        snapshots.forget(note_id)
+        invalidate_user_views(current_user["uid"])
+        tag_indexes.note_changed(current_user["uid"], note.get("tags"), update_data.get("tags"))
+        related_indexes.note_changed(current_user["uid"], note_id, update_data["title"], content, update_data.get("tags"))
         
         # Get updated note
-        updated_note = note_ref.get()
-        return format_doc(updated_note)
+        updated_note = await run_in_threadpool(read_document, note_ref)
+        return full_item(format_doc(updated_note), content)
     except HTTPException:
         raise
     except Exception as e:
@@ -165,6 +310,7 @@ async def update_note(note_id: str, note_data: NoteCreate, current_user: User =
 
 
 @router.delete("/{note_id}")
+@route_cost(5)
 async def delete_note(note_id: str, current_user: User = Depends(get_current_user)):
     """
     Delete a note
@@ -172,7 +318,7 @@ async def delete_note(note_id: str, current_user: User = Depends(get_current_use
     try:
         # Check if note exists and user owns it
         note_ref = db.collection("notes").document(note_id)
-        note_doc = note_ref.get()
+        note_doc = await get_document("notes", note_id)
         
         if not note_doc.exists:
             raise HTTPException(
@@ -187,18 +333,22 @@ async def delete_note(note_id: str, current_user: User = Depends(get_current_use
                 detail="You don't have permission to delete this note"
             )
         
-        # Delete any shares for this note
-        shares_ref = db.collection("shares")
-        shares_query = shares_ref.where("itemId", "==", note_id).where("itemType", "==", "note")
-        shares_docs = shares_query.get()
-        
+        # Delete the note and take it off the subject counters; its shares,
+        # content chunks and revisions are cleaned up from the outbox
         batch = db.batch()
-        for share_doc in shares_docs:
-            batch.delete(share_doc.reference)
-        
-        # Delete the note
         batch.delete(note_ref)
-        batch.commit()
+        add_tombstone(batch, note["createdBy"], "note", note_id)
+        if await run_in_threadpool(subject_exists, note.get("subjectId")):
+            add_note_deleted(batch, note)
+        add_note_cleanup(batch, note_id, note)
+        await run_in_threadpool(commit, batch)
+        worker_pool.wake()
+        forget_document("notes", note_id)
+        forget_subject_notes(note.get("subjectId"))
+        snapshots.forget(note_id)
+        invalidate_user_views(current_user["uid"])
+        tag_indexes.note_changed(current_user["uid"], note.get("tags"), None)
+        related_indexes.note_removed(current_user["uid"], note_id)
         
         return {"message": f"Note with ID {note_id} has been deleted"}
     except HTTPException:
@@ -0,0 +1,50 @@
+from fastapi import APIRouter, Depends, Response
+from typing import Optional
+from middleware import require_admin
+from models import ProfilerSettings, User
+from profiler import profiler
+
+router = APIRouter()
+
+
+@router.get("")
+async def get_profiler_status(current_user: User = Depends(require_admin)):
+    """
+    Get whether the profiler is on, the routes it caught slow requests for and the event loop lag
+    """
+    return profiler.status()
+
+
+@router.put("")
+async def set_profiler(settings: ProfilerSettings, current_user: User = Depends(require_admin)):
+    """
+    Switch the profiler on or off, optionally changing its sample interval and slow threshold
+    """
+    if settings.enabled:
+        profiler.start(settings.intervalMs, settings.slowMs)
+    else:
+        profiler.stop()
+    return profiler.status()
+
+
+@router.delete("")
+async def clear_profiler(current_user: User = Depends(require_admin)):
+    """
+    Drop everything captured so far
+    """
+    profiler.clear()
+    return profiler.status()
+
+
+@router.get("/stacks")
+async def download_stacks(route: Optional[str] = None, current_user: User = Depends(require_admin)):
+    """
+    Download the captured stacks in collapsed format, for flamegraph.pl or speedscope
+
+    Pass a route from the status to get just its stacks.
+    """
+    return Response(
+        content=profiler.collapsed(route),
+        media_type="text/plain",
+        headers={"Content-Disposition": 'attachment; filename="stacks.folded"'},
+    )
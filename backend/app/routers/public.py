@@ -0,0 +1,85 @@
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from public_snapshots import snapshots
+
+router = APIRouter()
+
+# The latest-version URL may change at any time, so shared caches only hold it briefly
+LATEST_MAX_AGE = 60
+# A versioned URL always returns the same bytes
+VERSION_MAX_AGE = 365 * 24 * 3600
+
+
+def snapshot_headers(note_id, version, cache_control):
+    return {
+        "ETag": f'"{note_id}.{version}"',
+        "Cache-Control": cache_control,
+        "Content-Location": f"/api/public/notes/{note_id}/versions/{version}",
+    }
+
+
+async def snapshot_response(request, note_id, version, cache_control, latest=False):
+    headers = snapshot_headers(note_id, version, cache_control)
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    body = await snapshots.get(note_id, version)
+    if body is None and latest:
+        # The note changed after its version was looked up; the render picked up the new one
+        version = await snapshots.current_version(note_id)
+        if version is not None:
+            headers = snapshot_headers(note_id, version, cache_control)
+            body = await snapshots.get(note_id, version)
+    if body is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No public snapshot for note {note_id}"
+        )
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@router.get("/notes/{note_id}")
+async def get_public_note(note_id: str, request: Request):
+    """
+    Get the latest published snapshot of a publicly shared note, without signing in
+    """
+    try:
+        version = await snapshots.current_version(note_id)
+        if version is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Note with ID {note_id} is not shared publicly"
+            )
+        return await snapshot_response(
+            request, note_id, version, f"public, max-age={LATEST_MAX_AGE}, stale-while-revalidate={LATEST_MAX_AGE}", latest=True
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch public note: {str(e)}"
+        )
+
+
+@router.get("/notes/{note_id}/versions/{version}")
+async def get_public_note_version(note_id: str, version: str, request: Request):
+    """
+    Get one immutable version of a publicly shared note's snapshot
+
+    Versions other than the current one are only served while still cached; they are never rendered again.
+    """
+    try:
+        # Old versions stop being served as soon as the note is no longer public
+        if await snapshots.current_version(note_id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Note with ID {note_id} is not shared publicly"
+            )
+        return await snapshot_response(request, note_id, version, f"public, max-age={VERSION_MAX_AGE}, immutable")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch public note: {str(e)}"
+        )
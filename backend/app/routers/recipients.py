@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from middleware import get_current_user
+from models import RecipientClaim, User
+from grants import claim_recipient, verified_email
+from cache import invalidate_user_views
+
+router = APIRouter()
+
+
+@router.post("/claim", response_model=RecipientClaim)
+async def claim_email(current_user: User = Depends(get_current_user)):
+    """
+    Register the current user as the recipient for their email and accept the shares waiting for it
+
+    Only verified emails are registered, so nobody can pick up invites by
+    signing up with someone else's address.
+    """
+    email = verified_email(current_user)
+    if not email:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Verify your email address before accepting shared items"
+        )
+
+    try:
+        resolved = await run_in_threadpool(claim_recipient, current_user["uid"], email)
+        if resolved:
+            invalidate_user_views(current_user["uid"])
+        return {"email": email, "resolved": resolved}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to claim shared items: {str(e)}"
+        )
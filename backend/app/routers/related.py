@@ -0,0 +1,52 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from typing import List
+from middleware import get_current_user
+from rate_limit import route_cost
+from models import RelatedNote, User
+from utils import format_doc
+from acl import fetch_documents
+from content_store import load_content, list_item
+from related import related_indexes, note_terms
+from routers.notes import check_note_access
+
+router = APIRouter()
+
+
+@router.get("/{note_id}/related", response_model=List[RelatedNote])
+@route_cost(5)
+async def get_related_notes(
+    note_id: str,
+    limit: int = Query(10, ge=1, le=50),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Get the current user's notes most similar to a note, across all subjects
+
+    Similarity is the cosine of TF-IDF vectors over the title, content and tags.
+    """
+    note = await check_note_access(note_id, current_user)
+    try:
+        index = await related_indexes.get(current_user["uid"])
+        matches = index.related(note_id, limit)
+        if matches is None:
+            # A note shared with the user isn't in their own matrix; compare its terms instead
+            content = await run_in_threadpool(load_content, note_id, note)
+            terms = note_terms(note.get("title"), content, note.get("tags"))
+            matches = index.related_to_terms(terms, limit, exclude=note_id)
+
+        docs = await run_in_threadpool(fetch_documents, "notes", [match_id for match_id, _ in matches])
+        related = []
+        for match_id, score in matches:
+            if match_id in docs:
+                item = list_item(format_doc(docs[match_id]))
+                item["score"] = round(score, 4)
+                related.append(item)
+        return related
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch related notes: {str(e)}"
+        )
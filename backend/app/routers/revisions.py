@@ -0,0 +1,57 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from typing import List
+from middleware import get_current_user
+from models import Revision, RevisionContent, User
+from utils import timestamp_to_iso
+from content_store import load_content
+from revisions import list_revisions, load_revision
+from routers.notes import check_note_access
+
+router = APIRouter()
+
+
+@router.get("/{note_id}/revisions", response_model=List[Revision])
+async def get_note_revisions(note_id: str, current_user: User = Depends(get_current_user)):
+    """
+    List the saved revisions of a note, oldest first
+    """
+    await check_note_access(note_id, current_user)
+    try:
+        revisions = await run_in_threadpool(list_revisions, note_id)
+        return timestamp_to_iso(revisions)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch revisions: {str(e)}"
+        )
+
+
+@router.get("/{note_id}/revisions/{number}", response_model=RevisionContent)
+async def get_note_revision(note_id: str, number: int, current_user: User = Depends(get_current_user)):
+    """
+    Get the content of a note as it was at a given revision
+    """
+    note = await check_note_access(note_id, current_user)
+    try:
+        current_content = await run_in_threadpool(load_content, note_id, note)
+        result = await run_in_threadpool(load_revision, note_id, number, current_content)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch revision: {str(e)}"
+        )
+
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Revision {number} of note {note_id} not found"
+        )
+
+    revision, content = result
+    revision["content"] = content
+    return timestamp_to_iso(revision)
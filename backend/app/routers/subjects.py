@@ -1,16 +1,85 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
 from typing import List
 import firebase_admin
 from firebase_admin import firestore
 from firebase import db
 from middleware import get_current_user
-from models import Subject, SubjectCreate, User, Note
-from utils import format_doc, create_server_timestamp
+from rate_limit import route_cost
+from models import Subject, SubjectCreate, SubjectMove, SubjectTree, User, Note, BatchGetRequest, SubjectBatchResult
+from utils import format_doc, create_server_timestamp, BatchWriter
+from cache import invalidate_user_views
+from counters import recount_subject
+from tombstones import add_tombstone
+from datastore import get_document, run_query, iter_query, forget_document, forget_subject_notes
+from acl import can_view_subject, fetch_documents, viewable_subject_ids
+from subject_tree import MAX_SUBJECT_DEPTH, path_fields, subtree_query, branch_height, add_branch_move
+from content_store import select_for_view, shape_for_view
+from outbox import worker_pool
+from outbox_handlers import add_subject_cleanup
 
 router = APIRouter()
 
+# Most ids accepted by a single batch request
+MAX_BATCH_IDS = 100
+
+
+def unique_batch_ids(batch):
+    """
+    De-duplicate the ids of a batch request and enforce the size limit
+    """
+    ids = list(dict.fromkeys(batch.ids))
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cannot fetch more than {MAX_BATCH_IDS} items at once"
+        )
+    return ids
+
+
+def owned_subject(subject_doc, subject_id, current_user, action):
+    """
+    Format a subject document, making sure it exists and belongs to the user
+    """
+    if not subject_doc.exists:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Subject with ID {subject_id} not found"
+        )
+
+    subject = format_doc(subject_doc)
+    if subject["createdBy"] != current_user["uid"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"You don't have permission to {action} this subject"
+        )
+    return subject
+
+
+async def parent_subject(parent_id, current_user):
+    """
+    Load the subject a new or moved subject goes under, or None for the top level
+    """
+    if not parent_id:
+        return None
+    parent_doc = await get_document("subjects", parent_id)
+    return owned_subject(parent_doc, parent_id, current_user, "add subjects to")
+
+
+def check_depth(depth):
+    if depth > MAX_SUBJECT_DEPTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Subjects cannot be nested more than {MAX_SUBJECT_DEPTH + 1} levels deep"
+        )
+
+
+def load_descendants(subject_id):
+    return [format_doc(doc) for doc in iter_query(subtree_query(subject_id))]
+
 
 @router.get("/", response_model=List[Subject])
+@route_cost(10)
 async def get_all_subjects(current_user: User = Depends(get_current_user)):
     """
     Get all subjects for the current user
@@ -19,11 +88,20 @@ async def get_all_subjects(current_user: User = Depends(get_current_user)):
         # Query subjects created by the user
         subjects_ref = db.collection("subjects")
         query = subjects_ref.where("createdBy", "==", current_user["uid"]).order_by("createdAt", direction=firestore.Query.DESCENDING)
-        subjects_docs = query.get()
+        subjects_docs = await run_in_threadpool(query.get)
         
         # Format and return the results
         subjects = [format_doc(doc) for doc in subjects_docs]
+        
+        # Backfill counters on subjects created before they were maintained; this streams
+        # every note of the subject, so it stays off the event loop
+        for subject in subjects:
+            if subject.get("noteCount") is None:
+                subject.update(await run_in_threadpool(recount_subject, subject["id"]))
+        
         return subjects
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -37,8 +115,7 @@ async def get_subject_by_id(subject_id: str, current_user: User = Depends(get_cu
     Get a specific subject by ID
     """
     try:
-        subject_ref = db.collection("subjects").document(subject_id)
-        subject_doc = subject_ref.get()
+        subject_doc = await get_document("subjects", subject_id)
         
         if not subject_doc.exists:
             raise HTTPException(
@@ -48,21 +125,10 @@ async def get_subject_by_id(subject_id: str, current_user: User = Depends(get_cu
         
         subject = format_doc(subject_doc)
         
-        # Check if user has access to this subject
-        if subject["createdBy"] != current_user["uid"]:
-            # Check if it's shared with the user
-            shares_ref = db.collection("shares")
-            query = shares_ref.where("itemId", "==", subject_id).where("itemType", "==", "subject")
-            
-            # Check for public shares
-            public_query = query.where("shareType", "==", "public")
-            public_shares = public_query.get()
-            
-            # Check for specific shares
-            specific_query = query.where("shareType", "==", "specific").where("sharedWith", "array_contains", current_user["email"])
-            specific_shares = specific_query.get()
-            
-            if len(list(public_shares)) == 0 and len(list(specific_shares)) == 0:
+        # Check if user has access to this subject: its sharing fields first, then
+        # the user's grants on it and on the subjects it is nested in, read by key
+        if not can_view_subject(subject, current_user):
+            if subject_id not in await run_in_threadpool(viewable_subject_ids, [subject], current_user):
                 raise HTTPException(
                     status_code=status.HTTP_403_FORBIDDEN,
                     detail="You don't have access to this subject"
@@ -78,6 +144,34 @@ async def get_subject_by_id(subject_id: str, current_user: User = Depends(get_cu
         )
 
 
+@router.post("/batch", response_model=SubjectBatchResult)
+@route_cost(5)
+async def get_subjects_batch(batch: BatchGetRequest, current_user: User = Depends(get_current_user)):
+    """
+    Get several subjects at once, reporting which were found, forbidden or missing
+    """
+    try:
+        ids = unique_batch_ids(batch)
+        
+        # One multi-document read, then one access evaluation for the whole set
+        docs = await run_in_threadpool(fetch_documents, "subjects", ids)
+        subjects = [format_doc(docs[subject_id]) for subject_id in ids if subject_id in docs]
+        allowed = await run_in_threadpool(viewable_subject_ids, subjects, current_user)
+        
+        return {
+            "found": [subject for subject in subjects if subject["id"] in allowed],
+            "forbidden": [subject["id"] for subject in subjects if subject["id"] not in allowed],
+            "missing": [subject_id for subject_id in ids if subject_id not in docs],
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch subjects: {str(e)}"
+        )
+
+
 @router.post("/", response_model=Subject)
 async def create_subject(subject: SubjectCreate, current_user: User = Depends(get_current_user)):
     """
@@ -86,6 +180,9 @@ async def create_subject(subject: SubjectCreate, current_user: User = Depends(ge
     try:
         # Prepare subject data
         subject_data = subject.dict()
+        parent = await parent_subject(subject.parentId, current_user)
+        subject_data.update(path_fields(parent))
+        check_depth(subject_data["depth"])
         subject_data["createdBy"] = current_user["uid"]
         subject_data["createdAt"] = create_server_timestamp()
         subject_data["updatedAt"] = create_server_timestamp()
@@ -93,10 +190,13 @@ async def create_subject(subject: SubjectCreate, current_user: User = Depends(ge
         # Add to Firestore
         subject_ref = db.collection("subjects").document()
         subject_ref.set(subject_data)
+        invalidate_user_views(current_user["uid"])
         
         # Get the newly created subject
         created_subject = subject_ref.get()
         return format_doc(created_subject)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -127,11 +227,13 @@ async def update_subject(subject_id: str, subject_data: SubjectCreate, current_u
                 detail="You don't have permission to update this subject"
             )
         
-        # Update the subject
-        update_data = subject_data.dict()
+        # Update the subject; moving it to another parent goes through the move endpoint
+        update_data = subject_data.dict(exclude={"parentId"})
         update_data["updatedAt"] = create_server_timestamp()
         
         subject_ref.update(update_data)
+        forget_document("subjects", subject_id)
+        invalidate_user_views(current_user["uid"])
         
         # Get updated subject
         updated_subject = subject_ref.get()
@@ -146,63 +248,124 @@ async def update_subject(subject_id: str, subject_data: SubjectCreate, current_u
 
 
 @router.delete("/{subject_id}")
+@route_cost(30, heavy=True)
 async def delete_subject(subject_id: str, current_user: User = Depends(get_current_user)):
     """
-    Delete a subject and all its notes
+    Delete a subject with every subject nested below it and all their notes
     """
     try:
         # Check if subject exists and user owns it
         subject_ref = db.collection("subjects").document(subject_id)
-        subject_doc = subject_ref.get()
+        subject = owned_subject(subject_ref.get(), subject_id, current_user, "delete")
+        descendants = await run_in_threadpool(load_descendants, subject_id)
         
-        if not subject_doc.exists:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Subject with ID {subject_id} not found"
-            )
+        # Delete the subjects, deepest first and this one last, so a failed delete
+        # can be repeated; their notes and shares are removed from the outbox
+        writer = BatchWriter(db)
+        branch = sorted(descendants, key=lambda descendant: -(descendant.get("depth") or 0)) + [subject]
+        for item in branch:
+            writer.delete(db.collection("subjects").document(item["id"]))
+            add_tombstone(writer, item["createdBy"], "subject", item["id"])
+            add_subject_cleanup(writer, item["id"], item["createdBy"])
+        await run_in_threadpool(writer.commit)
+        worker_pool.wake()
+        for item in branch:
+            forget_document("subjects", item["id"])
+            forget_subject_notes(item["id"])
+        invalidate_user_views(current_user["uid"])
         
-        subject = format_doc(subject_doc)
-        if subject["createdBy"] != current_user["uid"]:
+        return {"message": f"Subject with ID {subject_id}, {len(descendants)} nested subjects and all their notes have been deleted"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to delete subject: {str(e)}"
+        )
+
+
+@router.post("/{subject_id}/move", response_model=Subject)
+@route_cost(30, heavy=True)
+async def move_subject(subject_id: str, move: SubjectMove, current_user: User = Depends(get_current_user)):
+    """
+    Move a subject, together with everything nested below it, under another subject or to the top level
+    """
+    try:
+        subject_ref = db.collection("subjects").document(subject_id)
+        subject = owned_subject(subject_ref.get(), subject_id, current_user, "move")
+        if move.parentId == subject.get("parentId"):
+            return subject
+
+        parent = await parent_subject(move.parentId, current_user)
+        if parent is not None and (parent["id"] == subject_id or subject_id in (parent.get("ancestors") or [])):
             raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="You don't have permission to delete this subject"
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="A subject cannot be moved below itself"
             )
-        
-        # Delete all notes in this subject
-        notes_ref = db.collection("notes")
-        notes_query = notes_ref.where("subjectId", "==", subject_id)
-        notes_docs = notes_query.get()
-        
-        batch = db.batch()
-        for note_doc in notes_docs:
-            batch.delete(note_doc.reference)
-        
-        # Delete any shares for this subject
-        shares_ref = db.collection("shares")
-        shares_query = shares_ref.where("itemId", "==", subject_id).where("itemType", "==", "subject")
-        shares_docs = shares_query.get()
-        
-        for share_doc in shares_docs:
-            batch.delete(share_doc.reference)
-        
-        # Delete the subject
-        batch.delete(subject_ref)
-        batch.commit()
-        
-        return {"message": f"Subject with ID {subject_id} and all its notes have been deleted"}
+
+        descendants = await run_in_threadpool(load_descendants, subject_id)
+        check_depth(path_fields(parent)["depth"] + branch_height(subject, descendants))
+
+        # One rewrite per subject in the branch, committed in bounded batches
+        writer = BatchWriter(db)
+        add_branch_move(writer, subject, descendants, parent)
+        await run_in_threadpool(writer.commit)
+        forget_document("subjects", subject_id)
+        for descendant in descendants:
+            forget_document("subjects", descendant["id"])
+        invalidate_user_views(current_user["uid"])
+
+        moved_subject = await run_in_threadpool(subject_ref.get)
+        return format_doc(moved_subject)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to delete subject: {str(e)}"
+            detail=f"Failed to move subject: {str(e)}"
+        )
+
+
+@router.get("/{subject_id}/tree", response_model=SubjectTree)
+@route_cost(10)
+async def get_subject_tree(subject_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Get a subject with every subject nested below it and the note totals of the whole branch
+    """
+    try:
+        subject = await get_subject_by_id(subject_id, current_user)
+
+        # A single query on the ancestor array finds the whole branch, however deep
+        descendant_docs = await run_query(("subjects", "ancestors", subject_id), subtree_query(subject_id))
+        descendants = [format_doc(doc) for doc in descendant_docs]
+        descendants.sort(key=lambda descendant: (descendant.get("depth") or 0, descendant.get("title") or ""))
+
+        for item in [subject] + descendants:
+            if item.get("noteCount") is None:
+                item.update(await run_in_threadpool(recount_subject, item["id"]))
+
+        return {
+            "subject": subject,
+            "descendants": descendants,
+            "noteCount": sum(item.get("noteCount") or 0 for item in [subject] + descendants),
+            "contentSize": sum(item.get("contentSize") or 0 for item in [subject] + descendants),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch subject tree: {str(e)}"
         )
 
 
 @router.get("/{subject_id}/notes", response_model=List[Note])
-async def get_notes_for_subject(subject_id: str, current_user: User = Depends(get_current_user)):
+@route_cost(10)
+async def get_notes_for_subject(subject_id: str, view: str = Query("preview", regex="^(preview|summary)$"), current_user: User = Depends(get_current_user)):
     """
     Get all notes for a subject
+
+    The summary view skips the content preview and returns only the derived fields.
     """
     try:
         # First verify access to the subject
@@ -211,10 +374,10 @@ async def get_notes_for_subject(subject_id: str, current_user: User = Depends(ge
         # Get all notes for this subject
         notes_ref = db.collection("notes")
         query = notes_ref.where("subjectId", "==", subject_id).order_by("updatedAt", direction=firestore.Query.DESCENDING)
-        notes_docs = query.get()
+        notes_docs = await run_query(("notes", "subjectId", subject_id, view), select_for_view(query, view))
         
         # Format and return the results
-        notes = [format_doc(doc) for doc in notes_docs]
+        notes = [shape_for_view(format_doc(doc), view) for doc in notes_docs]
         return notes
     except HTTPException:
         raise
@@ -0,0 +1,124 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from typing import Optional
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from firebase import db
+from middleware import get_current_user
+from rate_limit import route_cost
+from models import SyncPage, User
+from utils import format_doc
+from tombstones import TOMBSTONE_RETENTION_DAYS
+from content_store import list_item
+
+router = APIRouter()
+
+# Collections included in a sync, keyed by their short name in the token
+SYNC_SOURCES = {
+    "s": ("subjects", "createdBy"),
+    "n": ("notes", "createdBy"),
+    "t": ("tombstones", "ownerId"),
+}
+
+# Writes still committing may carry a server timestamp slightly in the past, so
+# only hand out documents that are old enough that nothing can land before them
+SETTLE_SECONDS = 2
+
+
+def encode_token(cursors, issued_at):
+    payload = {"v": 1, "i": issued_at.isoformat(), "c": cursors}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_token(token):
+    """
+    Decode a sync token into its per-collection cursors and issue time
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return payload["c"], datetime.fromisoformat(payload["i"])
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid sync token"
+        )
+
+
+def fetch_changes(uid, key, cursor, horizon, limit):
+    """
+    Fetch one page of documents changed after a cursor, oldest change first
+    """
+    collection, owner_field = SYNC_SOURCES[key]
+    collection_ref = db.collection(collection)
+    query = (
+        collection_ref
+        .where(owner_field, "==", uid)
+        .where("updatedAt", "<", horizon)
+        .order_by("updatedAt")
+        .order_by(firestore.FieldPath.document_id())
+    )
+
+    if cursor:
+        updated_at, doc_id = cursor
+        query = query.start_after({
+            "updatedAt": DatetimeWithNanoseconds.from_rfc3339(updated_at),
+            firestore.FieldPath.document_id(): collection_ref.document(doc_id),
+        })
+
+    docs = list(query.limit(limit).stream())
+    if docs:
+        last = docs[-1]
+        cursor = [last.get("updatedAt").rfc3339(), last.id]
+
+    return [format_doc(doc) for doc in docs], cursor, len(docs) == limit
+
+
+@router.get("/", response_model=SyncPage)
+@route_cost(20)
+async def sync_changes(
+    since: Optional[str] = None,
+    limit: int = Query(200, ge=1, le=500),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Get the subjects and notes created, updated or deleted since a sync token
+
+    Without a token this returns the whole library page by page. Keep calling
+    with nextToken until hasMore is false; the last token is the one to store.
+    """
+    try:
+        now = datetime.now(timezone.utc)
+        cursors = {}
+
+        if since:
+            cursors, issued_at = decode_token(since)
+            # Tombstones older than the retention window are gone, so deletions may be missed
+            if now - issued_at > timedelta(days=TOMBSTONE_RETENTION_DAYS):
+                return {"resetRequired": True}
+
+        horizon = now - timedelta(seconds=SETTLE_SECONDS)
+        page = {"subjects": [], "notes": [], "deleted": [], "hasMore": False}
+        results = {}
+
+        for key in SYNC_SOURCES:
+            docs, cursor, more = fetch_changes(current_user["uid"], key, cursors.get(key), horizon, limit)
+            results[key] = docs
+            if cursor:
+                cursors[key] = cursor
+            page["hasMore"] = page["hasMore"] or more
+
+        page["subjects"] = results["s"]
+        # Notes carry a preview; clients fetch the full body of truncated ones
+        page["notes"] = [list_item(note) for note in results["n"]]
+        page["deleted"] = results["t"]
+        page["nextToken"] = encode_token(cursors, now)
+        return page
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to sync changes: {str(e)}"
+        )
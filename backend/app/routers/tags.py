@@ -1,17 +1,51 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from typing import List, Set
+import asyncio
+import json
+import time
 import firebase_admin
 from firebase_admin import firestore
 from firebase import db
 from middleware import get_current_user
-from models import Note, User
-from utils import format_doc
-from routers.notes import get_note_by_id
+from rate_limit import route_cost
+from models import Note, User, TagRename, TagMerge, TagOperationResult, TagSuggestion
+from utils import format_doc, create_server_timestamp
+from cache import invalidate_user_views
+from counters import add_subject_stats, tag_deltas
+from datastore import iter_query_pages, forget_subject_notes, get_all, commit
+from metrics import metrics
+from tag_index import tag_indexes
+from related import related_indexes
+from routers.notes import check_note_access
+from content_store import load_content, select_for_view, shape_for_view
 
 router = APIRouter()
 
+# Firestore accepts at most this many values in an array_contains_any filter
+MAX_SOURCE_TAGS = 10
+# Each note takes two writes plus at most one subject counter update
+NOTES_PER_BATCH = 150
+PARALLEL_BATCHES = 4
+
+
+def extract_tags(notes):
+    """
+    Collect the sorted unique tags used across a set of notes
+    """
+    all_tags: Set[str] = set()
+    for note in notes:
+        if "tags" in note and note["tags"]:
+            for tag in note["tags"]:
+                all_tags.add(tag)
+    
+    # Return sorted list of unique tags
+    return sorted(list(all_tags))
+
 
 @router.get("/", response_model=List[str])
+@route_cost(20, heavy=True)
 async def get_all_tags(current_user: User = Depends(get_current_user)):
     """
     Get all unique tags used by the current user
@@ -23,15 +57,9 @@ async def get_all_tags(current_user: User = Depends(get_current_user)):
         notes_docs = query.get()
         
         # Extract all tags from user's notes
-        all_tags: Set[str] = set()
-        for note_doc in notes_docs:
-            note = format_doc(note_doc)
-            if "tags" in note and note["tags"]:
-                for tag in note["tags"]:
-                    all_tags.add(tag)
-        
-        # Return sorted list of unique tags
-        return sorted(list(all_tags))
+        return extract_tags(format_doc(note_doc) for note_doc in notes_docs)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -39,8 +67,35 @@ async def get_all_tags(current_user: User = Depends(get_current_user)):
         )
 
 
+@router.get("/suggest", response_model=List[TagSuggestion])
+async def suggest_tags(
+    prefix: str = "",
+    tags: List[str] = Query([]),
+    limit: int = Query(10, ge=1, le=50),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Suggest tags starting with a prefix, ranked by how often and how recently
+    they were used and how often they appear together with the given tags
+    """
+    try:
+        index = await tag_indexes.get(current_user["uid"])
+        started = time.perf_counter()
+        suggestions = index.suggest(prefix.strip(), tags, limit)
+        metrics.observe("tags.suggest", time.perf_counter() - started)
+        return suggestions
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to suggest tags: {str(e)}"
+        )
+
+
 @router.get("/{tag}/notes", response_model=List[Note])
-async def get_notes_by_tag(tag: str, current_user: User = Depends(get_current_user)):
+@route_cost(10)
+async def get_notes_by_tag(tag: str, view: str = Query("preview", regex="^(preview|summary)$"), current_user: User = Depends(get_current_user)):
     """
     Get all notes with a specific tag
     """
@@ -48,11 +103,13 @@ async def get_notes_by_tag(tag: str, current_user: User = Depends(get_current_us
         # Query notes created by the user
         notes_ref = db.collection("notes")
         query = notes_ref.where("createdBy", "==", current_user["uid"]).where("tags", "array_contains", tag)
-        notes_docs = query.get()
+        notes_docs = select_for_view(query, view).get()
         
         # Format and return the results
-        notes = [format_doc(doc) for doc in notes_docs]
+        notes = [shape_for_view(format_doc(doc), view) for doc in notes_docs]
         return notes
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -67,7 +124,7 @@ async def add_tag_to_note(note_id: str, tag: str, current_user: User = Depends(g
     """
     try:
         # Verify user has access to the note
-        note = await get_note_by_id(note_id, current_user)
+        note = await check_note_access(note_id, current_user)
         
         # Check if user owns the note
         if note["createdBy"] != current_user["uid"]:
@@ -82,9 +139,18 @@ async def add_tag_to_note(note_id: str, tag: str, current_user: User = Depends(g
         # Add the tag if it doesn't already exist
         if tag not in current_tags:
             note_ref = db.collection("notes").document(note_id)
-            note_ref.update({
-                "tags": firestore.ArrayUnion([tag])
+            batch = db.batch()
+            batch.update(note_ref, {
+                "tags": firestore.ArrayUnion([tag]),
+                "updatedAt": create_server_timestamp()
             })
+            add_subject_stats(batch, note["subjectId"], tags={tag: 1})
+            await run_in_threadpool(commit, batch)
+            invalidate_user_views(current_user["uid"])
+            tag_indexes.note_changed(current_user["uid"], current_tags, current_tags + [tag])
+            # Tags are terms of the related-notes matrix too
+            content = await run_in_threadpool(load_content, note_id, note)
+            related_indexes.note_changed(current_user["uid"], note_id, note.get("title"), content, current_tags + [tag])
             
             return {"message": f"Tag '{tag}' added to note"}
         else:
@@ -105,7 +171,7 @@ async def remove_tag_from_note(note_id: str, tag: str, current_user: User = Depe
     """
     try:
         # Verify user has access to the note
-        note = await get_note_by_id(note_id, current_user)
+        note = await check_note_access(note_id, current_user)
         
         # Check if user owns the note
         if note["createdBy"] != current_user["uid"]:
@@ -120,9 +186,19 @@ async def remove_tag_from_note(note_id: str, tag: str, current_user: User = Depe
         # Remove the tag if it exists
         if tag in current_tags:
             note_ref = db.collection("notes").document(note_id)
-            note_ref.update({
-                "tags": firestore.ArrayRemove([tag])
+            batch = db.batch()
+            batch.update(note_ref, {
+                "tags": firestore.ArrayRemove([tag]),
+                "updatedAt": create_server_timestamp()
             })
+            add_subject_stats(batch, note["subjectId"], tags={tag: -1})
+            await run_in_threadpool(commit, batch)
+            invalidate_user_views(current_user["uid"])
+            remaining_tags = [t for t in current_tags if t != tag]
+            tag_indexes.note_changed(current_user["uid"], current_tags, remaining_tags)
+            # Tags are terms of the related-notes matrix too
+            content = await run_in_threadpool(load_content, note_id, note)
+            related_indexes.note_changed(current_user["uid"], note_id, note.get("title"), content, remaining_tags)
             
             return {"message": f"Tag '{tag}' removed from note"}
         else:
@@ -133,4 +209,194 @@ async def remove_tag_from_note(note_id: str, tag: str, current_user: User = Depe
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to remove tag: {str(e)}"
-        ) 
\ No newline at end of file
+        ) 
+
+def rewrite_tags(tags, sources, target):
+    rewritten = [tag for tag in tags if tag not in sources]
+    if target is not None and target not in rewritten:
+        rewritten.append(target)
+    return rewritten
+
+
+def write_tag_batch(note_docs, sources, target):
+    """
+    Rewrite the tags of up to NOTES_PER_BATCH notes together with their subject counters
+
+    The tags field is changed with array transforms rather than overwritten, so
+    tags added to a note in the meantime are kept.
+    """
+    batch = db.batch()
+    deltas = {}
+    updated = 0
+
+    for note_doc in note_docs:
+        note = note_doc.to_dict()
+        tags = note.get("tags") or []
+        rewritten = rewrite_tags(tags, sources, target)
+        if rewritten == tags:
+            continue
+
+        if target is not None:
+            batch.update(note_doc.reference, {"tags": firestore.ArrayUnion([target])})
+        batch.update(note_doc.reference, {
+            "tags": firestore.ArrayRemove(sources),
+            "updatedAt": create_server_timestamp()
+        })
+        subject_deltas = deltas.setdefault(note.get("subjectId"), {})
+        for tag, delta in tag_deltas(tags, rewritten).items():
+            subject_deltas[tag] = subject_deltas.get(tag, 0) + delta
+        updated += 1
+
+    # Counters only exist on subjects that haven't been deleted
+    subject_refs = [db.collection("subjects").document(subject_id) for subject_id in deltas if subject_id]
+    for subject_doc in get_all(subject_refs, field_paths=["createdBy"]):
+        if subject_doc.exists and deltas[subject_doc.id]:
+            add_subject_stats(batch, subject_doc.id, tags=deltas[subject_doc.id])
+
+    if updated:
+        commit(batch)
+    return updated, set(deltas)
+
+
+async def retag_notes(uid, sources, target):
+    """
+    Replace the source tags with the target tag, or drop them when there is no target,
+    on every note of a user; yields progress after each committed batch
+
+    Notes are found with an array_contains_any query read page by page, and each
+    page is written as several batches committed in parallel.
+    """
+    query = db.collection("notes").where("createdBy", "==", uid).where("tags", "array_contains_any", sources)
+    pages = iter_query_pages(query.select(["subjectId", "tags"]))
+    slots = asyncio.Semaphore(PARALLEL_BATCHES)
+    progress = {"matched": 0, "updated": 0, "batches": 0, "done": False}
+    subject_ids = set()
+
+    async def write_batch(note_docs):
+        async with slots:
+            return await run_in_threadpool(write_tag_batch, note_docs, sources, target)
+
+    try:
+        while True:
+            page = await run_in_threadpool(next, pages, None)
+            if page is None:
+                break
+            progress["matched"] += len(page)
+
+            batches = [page[start:start + NOTES_PER_BATCH] for start in range(0, len(page), NOTES_PER_BATCH)]
+            for finished in asyncio.as_completed([write_batch(note_docs) for note_docs in batches]):
+                updated, batch_subject_ids = await finished
+                progress["updated"] += updated
+                progress["batches"] += 1
+                subject_ids |= batch_subject_ids
+                yield dict(progress)
+    finally:
+        for subject_id in subject_ids:
+            forget_subject_notes(subject_id)
+        invalidate_user_views(uid)
+        tag_indexes.invalidate(uid)
+        related_indexes.forget(uid)
+
+    progress["done"] = True
+    yield dict(progress)
+
+
+def clean_tag(tag):
+    tag = tag.strip()
+    if not tag:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Tags must not be empty"
+        )
+    return tag
+
+
+async def progress_lines(updates):
+    try:
+        async for progress in updates:
+            yield json.dumps(progress) + "\n"
+    except Exception as e:
+        yield json.dumps({"error": f"Failed to update tags: {str(e)}"}) + "\n"
+
+
+async def run_tag_operation(current_user, sources, target, progress):
+    """
+    Run a tag operation, streaming its progress as NDJSON when asked to
+    """
+    if len(sources) > MAX_SOURCE_TAGS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_SOURCE_TAGS} tags can be changed at once"
+        )
+
+    updates = retag_notes(current_user["uid"], sources, target)
+    if progress:
+        return StreamingResponse(progress_lines(updates), media_type="application/x-ndjson")
+
+    try:
+        result = None
+        async for result in updates:
+            pass
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to update tags: {str(e)}"
+        )
+
+
+@router.post("/rename", response_model=TagOperationResult)
+@route_cost(100, heavy=True)
+async def rename_tag(
+    rename: TagRename,
+    progress: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Rename a tag on all of the current user's notes
+
+    With progress=true the response is a stream of NDJSON progress objects,
+    the last of which has done set.
+    """
+    tag, new_tag = clean_tag(rename.tag), clean_tag(rename.newTag)
+    if tag == new_tag:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The new tag name must be different"
+        )
+    return await run_tag_operation(current_user, [tag], new_tag, progress)
+
+
+@router.post("/merge", response_model=TagOperationResult)
+@route_cost(100, heavy=True)
+async def merge_tags(
+    merge: TagMerge,
+    progress: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Replace several tags with one tag on all of the current user's notes
+    """
+    into = clean_tag(merge.into)
+    sources = sorted({clean_tag(tag) for tag in merge.tags} - {into})
+    if not sources:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Provide at least one tag to merge"
+        )
+    return await run_tag_operation(current_user, sources, into, progress)
+
+
+@router.delete("/{tag}", response_model=TagOperationResult)
+@route_cost(100, heavy=True)
+async def delete_tag(
+    tag: str,
+    progress: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Remove a tag from all of the current user's notes
+    """
+    return await run_tag_operation(current_user, [clean_tag(tag)], None, progress)
@@ -0,0 +1,56 @@
+from firebase import db
+from utils import create_server_timestamp
+
+# Deepest level a subject may sit at; top-level subjects are at depth 0.
+# Bounding it keeps every ancestor list small enough for one multi-document read.
+MAX_SUBJECT_DEPTH = 7
+
+
+def path_fields(parent):
+    """
+    Hierarchy fields of a subject placed under a parent subject dict, or at the top level for None
+    """
+    if parent is None:
+        return {"parentId": None, "ancestors": [], "depth": 0}
+    ancestors = (parent.get("ancestors") or []) + [parent["id"]]
+    return {"parentId": parent["id"], "ancestors": ancestors, "depth": len(ancestors)}
+
+
+def subtree_query(subject_id):
+    """
+    Every subject below a subject, at any depth, found through the ancestor array index
+    """
+    return db.collection("subjects").where("ancestors", "array_contains", subject_id)
+
+
+def branch_height(subject, descendants):
+    """
+    Number of levels a branch spans below its root subject
+    """
+    depth = subject.get("depth") or 0
+    return max([(descendant.get("depth") or 0) - depth for descendant in descendants] + [0])
+
+
+def add_branch_move(writer, subject, descendants, new_parent):
+    """
+    Add the writes that move a subject and everything below it under a new parent
+
+    Each descendant keeps the part of its ancestor list from the moved subject
+    down and gets the new parent's path in front of it, and a new updatedAt so
+    that delta syncs pick up its path. The moved subject is written last, so a
+    move cut off part way can be repeated and finishes the job.
+    """
+    fields = path_fields(new_parent)
+    prefix = fields["ancestors"]
+    for descendant in descendants:
+        ancestors = descendant.get("ancestors") or []
+        tail = ancestors[ancestors.index(subject["id"]):]
+        writer.update(db.collection("subjects").document(descendant["id"]), {
+            "ancestors": prefix + tail,
+            "depth": len(prefix) + len(tail),
+            "updatedAt": create_server_timestamp(),
+        })
+
+    fields["updatedAt"] = create_server_timestamp()
+    writer.update(db.collection("subjects").document(subject["id"]), fields)
+    return fields
@@ -0,0 +1,197 @@
+import bisect
+import heapq
+import math
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from firebase import db
+from datastore import SingleFlight
+
+# Users whose index is kept in memory; the least recently used are dropped first
+MAX_INDEXED_USERS = 1000
+# Indexes are rebuilt after this long to pick up writes made on other instances
+INDEX_TTL_SECONDS = 600
+
+RECENCY_HALF_LIFE_DAYS = 30
+# The frequency and recency part of each score is cached for this long
+SCORE_REFRESH_SECONDS = 60
+RECENCY_WEIGHT = 1.0
+CO_OCCURRENCE_WEIGHT = 2.0
+# Prefixes matching more than this many times the limit are answered from the global ranking
+BROAD_PREFIX_FACTOR = 20
+
+
+def prefix_end(prefix):
+    """
+    Smallest string greater than every string starting with the prefix
+    """
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class TagIndex:
+    """
+    One user's tags in a sorted array for prefix lookups, with usage counts,
+    last use times and co-occurrence counts for ranking
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.last_used = {}
+        self.pairs = defaultdict(Counter)
+        # (lowercased tag, tag) pairs, kept sorted
+        self.keys = []
+        self.built_at = time.monotonic()
+        self.base_scores = {}
+        # Every tag ordered by its base score, best first
+        self.ranked = []
+        self.scored_at = None
+
+    def add_note(self, tags, used_at, sign=1):
+        tags = set(tags or [])
+        for tag in tags:
+            self.counts[tag] += sign
+            if sign > 0:
+                self.last_used[tag] = max(self.last_used.get(tag, 0), used_at)
+            for other in tags:
+                if other != tag:
+                    self.pairs[tag][other] += sign
+
+    def sort_keys(self):
+        self.keys = sorted((tag.lower(), tag) for tag, count in self.counts.items() if count > 0)
+
+    def note_changed(self, old_tags, new_tags):
+        """
+        Apply a note's tag change in place, keeping the key array sorted
+        """
+        self.scored_at = None
+        before = {tag for tag in set(old_tags or []) | set(new_tags or []) if self.counts[tag] > 0}
+        self.add_note(old_tags, 0, sign=-1)
+        self.add_note(new_tags, time.time())
+
+        for tag in set(old_tags or []) | set(new_tags or []):
+            key = (tag.lower(), tag)
+            if tag in before and self.counts[tag] <= 0:
+                index = bisect.bisect_left(self.keys, key)
+                if index < len(self.keys) and self.keys[index] == key:
+                    del self.keys[index]
+                del self.counts[tag]
+                self.pairs.pop(tag, None)
+            elif tag not in before and self.counts[tag] > 0:
+                bisect.insort(self.keys, key)
+
+    def suggest(self, prefix, context=(), limit=10):
+        """
+        Best-ranked tags starting with the prefix, leaving out the context tags
+        """
+        prefix = prefix.lower()
+        low = bisect.bisect_left(self.keys, (prefix,))
+        end = prefix_end(prefix)
+        high = bisect.bisect_left(self.keys, (end,)) if end is not None else len(self.keys)
+
+        context = {tag for tag in context if self.counts.get(tag, 0) > 0}
+        base_scores = self.scores()
+        bonus = Counter()
+        for other in context:
+            # How often each tag shows up on notes that carry the context tag
+            for tag, together in self.pairs[other].items():
+                bonus[tag] += CO_OCCURRENCE_WEIGHT * together / self.counts[other]
+
+        if high - low <= limit * BROAD_PREFIX_FACTOR:
+            candidates = [tag for _, tag in self.keys[low:high] if tag not in context]
+        else:
+            # For short prefixes walk the tags best first instead of scoring every match;
+            # only tags with a co-occurrence bonus can overtake them
+            candidates = set()
+            for tag in self.ranked:
+                if len(candidates) == limit:
+                    break
+                if tag not in context and tag.lower().startswith(prefix):
+                    candidates.add(tag)
+            candidates.update(tag for tag in bonus if tag not in context and tag.lower().startswith(prefix))
+
+        ranked = heapq.nlargest(limit, candidates, key=lambda tag: base_scores[tag] + bonus[tag])
+        return [{"tag": tag, "count": self.counts[tag]} for tag in ranked]
+
+    def scores(self):
+        """
+        Frequency plus recency score of every tag, recomputed at most every SCORE_REFRESH_SECONDS
+        """
+        if self.scored_at is None or time.monotonic() - self.scored_at > SCORE_REFRESH_SECONDS:
+            now = time.time()
+            decay = math.log(2) / (RECENCY_HALF_LIFE_DAYS * 86400)
+            self.base_scores = {
+                tag: math.log1p(count) + RECENCY_WEIGHT * math.exp(-decay * max(0, now - self.last_used.get(tag, 0)))
+                for tag, count in self.counts.items() if count > 0
+            }
+            self.ranked = sorted(self.base_scores, key=self.base_scores.get, reverse=True)
+            self.scored_at = time.monotonic()
+        return self.base_scores
+
+
+def build_index(uid):
+    index = TagIndex()
+    query = db.collection("notes").where("createdBy", "==", uid).select(["tags", "updatedAt", "createdAt"])
+    for note_doc in query.stream():
+        note = note_doc.to_dict()
+        tags = note.get("tags")
+        if tags:
+            used_at = note.get("updatedAt") or note.get("createdAt")
+            index.add_note(tags, used_at.timestamp() if used_at else 0)
+    index.sort_keys()
+    return index
+
+
+class TagIndexCache:
+    """
+    Per-user tag indexes kept warm in memory with LRU eviction
+    """
+
+    def __init__(self, maxsize=MAX_INDEXED_USERS, ttl=INDEX_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self._builds = SingleFlight("tags.index")
+
+    def _cached(self, uid):
+        with self._lock:
+            index = self._indexes.get(uid)
+            if index is None:
+                return None
+            if time.monotonic() - index.built_at > self.ttl:
+                del self._indexes[uid]
+                return None
+            self._indexes.move_to_end(uid)
+            return index
+
+    async def get(self, uid):
+        index = self._cached(uid)
+        if index is not None:
+            return index
+
+        # Concurrent keystrokes from a cold user share one build
+        index = await self._builds.do(uid, build_index, uid)
+        with self._lock:
+            self._indexes[uid] = index
+            self._indexes.move_to_end(uid)
+            while len(self._indexes) > self.maxsize:
+                self._indexes.popitem(last=False)
+        return index
+
+    def note_changed(self, uid, old_tags=None, new_tags=None):
+        """
+        Update a user's index, if it is loaded, after one note's tags changed
+        """
+        with self._lock:
+            index = self._indexes.get(uid)
+            if index is not None:
+                index.note_changed(old_tags, new_tags)
+
+    def invalidate(self, uid):
+        with self._lock:
+            self._indexes.pop(uid, None)
+
+
+tag_indexes = TagIndexCache()
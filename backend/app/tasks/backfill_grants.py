@@ -0,0 +1,52 @@
+"""
+Build the recipient index and per-user grants for shares made before they existed.
+
+Run from backend/app:
+
+    python -m tasks.backfill_grants
+
+Every verified account is registered under its lower-cased email first, so the
+shares synced afterwards resolve to grants instead of invites.
+"""
+from firebase_admin import auth
+from firebase import db
+from utils import create_server_timestamp, BatchWriter
+from datastore import iter_query
+from grants import RECIPIENTS_COLLECTION, normalize_email
+from outbox_handlers import apply_share_changed
+
+
+def backfill_recipients():
+    writer = BatchWriter(db)
+    registered = 0
+    for user in auth.list_users().iterate_all():
+        email = normalize_email(user.email)
+        if email and user.email_verified:
+            writer.set(db.collection(RECIPIENTS_COLLECTION).document(email), {
+                "uid": user.uid,
+                "email": email,
+                "updatedAt": create_server_timestamp(),
+            })
+            registered += 1
+    writer.commit()
+    return registered
+
+
+def backfill_grants():
+    synced = set()
+    for share_doc in iter_query(db.collection("shares")):
+        share = share_doc.to_dict()
+        item = (share.get("itemType"), share.get("itemId"))
+        if item in synced:
+            continue
+        # The same handler that runs when a share changes; it only writes what differs
+        apply_share_changed({"itemType": item[0], "itemId": item[1], "ownerId": share.get("sharedBy")})
+        synced.add(item)
+        if len(synced) % 100 == 0:
+            print(f"Synced {len(synced)} shared items")
+    return len(synced)
+
+
+if __name__ == "__main__":
+    print(f"Registered {backfill_recipients()} recipients")
+    print(f"Done, {backfill_grants()} shared items synced")
@@ -0,0 +1,45 @@
+"""
+Compute MinHash signatures and LSH bucket entries for notes written before
+near-duplicate detection existed.
+
+Run from backend/app:
+
+    python -m tasks.backfill_minhash [--force]
+
+Notes that already have bucket keys are skipped unless --force is given.
+"""
+import argparse
+from firebase import db
+from utils import format_doc, BatchWriter
+from datastore import iter_query_pages
+from content_store import load_contents
+from minhash import minhash_fields, add_bucket_writes, note_scopes
+
+
+def backfill(force=False):
+    writer = BatchWriter(db)
+    updated = 0
+    for page in iter_query_pages(db.collection("notes")):
+        notes = [format_doc(note_doc) for note_doc in page]
+        notes = [note for note in notes if force or "lshBuckets" not in note]
+        if not notes:
+            continue
+
+        contents = load_contents(notes)
+        for note in notes:
+            fields = minhash_fields(contents[note["id"]])
+            note_ref = db.collection("notes").document(note["id"])
+            add_bucket_writes(writer, note_scopes(note), note["id"], note.get("lshBuckets"), fields["lshBuckets"])
+            # The note is marked last, so an interrupted run picks it up again
+            writer.update(note_ref, fields)
+            updated += 1
+        print(f"Indexed {updated} notes")
+    writer.commit()
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill near-duplicate signatures for existing notes")
+    parser.add_argument("--force", action="store_true", help="Recompute notes that are already indexed")
+    args = parser.parse_args()
+    print(f"Done, {backfill(args.force)} notes indexed")
@@ -0,0 +1,21 @@
+from datetime import datetime, timedelta, timezone
+from firebase import db
+from utils import create_server_timestamp
+
+# How long deletions stay visible to delta sync; older sync tokens must do a full resync
+TOMBSTONE_RETENTION_DAYS = 30
+
+
+def add_tombstone(batch, owner_id, item_type, item_id):
+    """
+    Record a deletion in the same batch as the delete so sync clients can see it
+    """
+    tombstone_ref = db.collection("tombstones").document(f"{item_type}_{item_id}")
+    batch.set(tombstone_ref, {
+        "ownerId": owner_id,
+        "itemType": item_type,
+        "itemId": item_id,
+        "updatedAt": create_server_timestamp(),
+        # Firestore TTL policy on this field prunes old tombstones
+        "expiresAt": datetime.now(timezone.utc) + timedelta(days=TOMBSTONE_RETENTION_DAYS),
+    })
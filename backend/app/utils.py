@@ -2,6 +2,7 @@ from firebase_admin import firestore
 from datetime import datetime
 from google.cloud.firestore_v1 import _helpers
 from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from datastore import commit
 
 
 def firestore_to_dict(doc):
@@ -43,4 +44,76 @@ def format_doc(doc):
     Format a document from Firestore with proper id and timestamps
     """
     data = firestore_to_dict(doc)
-    return timestamp_to_iso(data) 
\ No newline at end of file
+    return timestamp_to_iso(data) 
+
+# Firestore rejects commits over 10 MiB; batches are cut well before that
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+
+def estimate_size(value):
+    """
+    Rough stored size of a value written to Firestore, in bytes
+    """
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(item) for item in value)
+    # Numbers, timestamps, references and transforms such as SERVER_TIMESTAMP
+    return 8
+
+
+class BatchWriter:
+    """
+    Write batch that commits automatically before reaching Firestore's per-batch limits
+
+    A batch is committed once it holds max_ops writes, or before a write would
+    take its payload past max_bytes, which large content chunks reach first.
+    """
+
+    def __init__(self, client, max_ops=400, max_bytes=MAX_BATCH_BYTES):
+        self.client = client
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        self.batch = client.batch()
+        self.ops = 0
+        self.bytes = 0
+        self.committed = 0
+
+    def _make_room(self, ref, data=None):
+        size = estimate_size(ref.path) + estimate_size(data or {})
+        if self.ops and self.bytes + size > self.max_bytes:
+            self.commit()
+        self.bytes += size
+
+    def _added(self):
+        self.ops += 1
+        if self.ops >= self.max_ops:
+            self.commit()
+
+    def set(self, ref, data, merge=False):
+        self._make_room(ref, data)
+        self.batch.set(ref, data, merge=merge)
+        self._added()
+
+    def update(self, ref, data):
+        self._make_room(ref, data)
+        self.batch.update(ref, data)
+        self._added()
+
+    def delete(self, ref):
+        self._make_room(ref)
+        self.batch.delete(ref)
+        self._added()
+
+    def commit(self):
+        if self.ops:
+            # Batches may hold increments, so they are only retried when surely not applied
+            commit(self.batch)
+            self.committed += self.ops
+        self.batch = self.client.batch()
+        self.ops = 0
+        self.bytes = 0
@@ -0,0 +1,84 @@
+import json
+import random
+import time
+import zlib
+import pytest
+
+try:
+    import firebase  # noqa: F401
+except Exception as e:
+    pytest.skip(f"Firebase is not configured: {e}", allow_module_level=True)
+
+from revisions import MAX_DIFF_LINES, decode_revision, encode_revision, make_delta, tokenize
+
+WORDS = ["cell", "membrane", "protein", "energy", "the", "of", "and", "transport", "gradient", "enzyme"]
+
+
+def paragraph(rng, words):
+    return "<p>" + " ".join(rng.choice(WORDS) for _ in range(words)) + "</p>"
+
+
+def long_note(rng, paragraphs=1000):
+    return "".join(paragraph(rng, 12) for _ in range(paragraphs))
+
+
+def edit(rng, text, changes=20):
+    lines = text.split("</p>")[:-1]
+    for _ in range(changes):
+        lines[rng.randrange(len(lines))] = paragraph(rng, 12)[:-4]
+    return "".join(line + "</p>" for line in lines)
+
+
+def test_long_note_delta_is_fast_and_round_trips():
+    rng = random.Random(34)
+    older = long_note(rng)
+    newer = edit(rng, older)
+    assert len(older.split()) >= 9000
+
+    started = time.perf_counter()
+    revision = encode_revision(1, newer, older)
+    elapsed = time.perf_counter() - started
+
+    assert elapsed < 0.5
+    assert revision["kind"] == "delta"
+    assert decode_revision(revision, newer) == older
+
+
+def test_repetitive_note_delta_is_fast():
+    # Each empty paragraph splits at its <br> and its </p>
+    older = "<p><br></p>" * (MAX_DIFF_LINES // 2 - 10) + "<p>end</p>" * 10
+    newer = "<p>start</p>" + older
+
+    started = time.perf_counter()
+    ops = make_delta(newer, older)
+    assert time.perf_counter() - started < 0.5
+    assert ops is not None
+
+
+def test_note_over_the_cap_is_stored_whole():
+    rng = random.Random(35)
+    older = long_note(rng, MAX_DIFF_LINES + 1)
+    newer = edit(rng, older)
+
+    revision = encode_revision(1, newer, older)
+    assert revision["kind"] == "snapshot"
+    assert decode_revision(revision, newer) == older
+
+
+def test_single_line_html_splits_into_paragraphs():
+    older = "<p>one</p><p>two</p><p>three</p>"
+    newer = "<p>one</p><p>TWO</p><p>three</p>"
+
+    ops = make_delta(newer, older)
+    assert ops == [[0, 1], "<p>two</p>", [2, 3]]
+
+
+def test_deltas_stored_by_token_still_decode():
+    newer = "<p>a new sentence</p>"
+    older = "<p>an old sentence</p>"
+    # [start, end] token ranges of the newer text, as deltas were stored before line diffing
+    tokens = tokenize(newer)
+    ops = [[0, 1], "an old", [4, len(tokens)]]
+    revision = {"kind": "delta", "data": zlib.compress(json.dumps(ops).encode("utf-8"))}
+
+    assert decode_revision(revision, newer) == older
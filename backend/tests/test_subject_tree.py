@@ -0,0 +1,63 @@
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+import pytest
+
+if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+    pytest.skip("Needs the Firestore emulator (FIRESTORE_EMULATOR_HOST)", allow_module_level=True)
+
+try:
+    from firebase import db
+except Exception as e:
+    pytest.skip(f"Firebase is not configured: {e}", allow_module_level=True)
+
+from utils import BatchWriter, create_server_timestamp
+from subject_tree import add_branch_move, path_fields
+from routers.sync import fetch_changes
+
+
+@pytest.fixture
+def owner():
+    uid = f"test-{uuid.uuid4().hex}"
+    yield uid
+    for subject_doc in db.collection("subjects").where("createdBy", "==", uid).stream():
+        subject_doc.reference.delete()
+
+
+def add_subject(uid, title, parent=None):
+    subject_ref = db.collection("subjects").document()
+    subject = dict(path_fields(parent), title=title, createdBy=uid)
+    subject_ref.set(dict(subject, createdAt=create_server_timestamp(), updatedAt=create_server_timestamp()))
+    return dict(subject, id=subject_ref.id)
+
+
+def sync_all(uid, cursor, horizon):
+    docs = []
+    more = True
+    while more:
+        page, cursor, more = fetch_changes(uid, "s", cursor, horizon, 2)
+        docs.extend(page)
+    return docs, cursor
+
+
+def test_moved_descendants_show_up_in_the_next_sync_page(owner):
+    root = add_subject(owner, "Biology")
+    child = add_subject(owner, "Cells", root)
+    grandchild = add_subject(owner, "Membranes", child)
+    target = add_subject(owner, "Science")
+
+    horizon = datetime.now(timezone.utc) + timedelta(hours=1)
+    synced, cursor = sync_all(owner, None, horizon)
+    assert len(synced) == 4
+
+    writer = BatchWriter(db)
+    add_branch_move(writer, root, [child, grandchild], target)
+    writer.commit()
+
+    changed, _ = sync_all(owner, cursor, horizon)
+    ancestors = {subject["id"]: subject["ancestors"] for subject in changed}
+    assert ancestors == {
+        root["id"]: [target["id"]],
+        child["id"]: [target["id"], root["id"]],
+        grandchild["id"]: [target["id"], root["id"], child["id"]],
+    }
@@ -66,9 +66,16 @@ import Sidebar from './Sidebar';
 // Sidebar width (matching Dashboard)
 const drawerWidth = 240;
 
+// Titles of the subjects a subject is nested in, outermost first
+const ancestorTitles = (subject, subjectsById) =>
+  (subject.ancestors || [])
+    .map((ancestorId) => subjectsById[ancestorId]?.title)
+    .filter(Boolean);
+
 // Subject Card Component
 const SubjectCard = ({
   subject,
+  path = [],
   onViewNotes,
   onEdit,
   onDelete,
@@ -126,6 +133,15 @@ const SubjectCard = ({
       }}
     >
       <CardContent sx={{ pb: 1, flexGrow: 1 }}>
+        {path.length > 0 && (
+          <Typography
+            variant="caption"
+            color="text.secondary"
+            sx={{ display: 'block', wordBreak: 'break-word' }}
+          >
+            {path.join(' / ')}
+          </Typography>
+        )}
         <Typography
           variant="h6"
           component="div"
@@ -342,6 +358,10 @@ export default function AllSubjects() {
     }
   };
 
+  const subjectsById = Object.fromEntries(
+    subjects.map((subject) => [subject.id, subject])
+  );
+
   // Apply search and filters to subjects
   const applyFilters = () => {
     let result = [...subjects];
@@ -369,9 +389,13 @@ export default function AllSubjects() {
 
     // Apply sort
     switch (filterOptions.sortBy) {
-      case 'alphabetical':
-        result.sort((a, b) => a.title.localeCompare(b.title));
+      case 'alphabetical': {
+        // Sorting by the full path keeps nested subjects right after their parent
+        const pathKey = (subject) =>
+          [...ancestorTitles(subject, subjectsById), subject.title].join('\u0000');
+        result.sort((a, b) => pathKey(a).localeCompare(pathKey(b)));
         break;
+      }
       case 'newest':
         result.sort(
           (a, b) =>
@@ -519,8 +543,13 @@ export default function AllSubjects() {
 
     try {
       await deleteSubject(subjectToDelete);
+      // Subjects nested below the deleted one are deleted with it
       setSubjects((prevSubjects) =>
-        prevSubjects.filter((s) => s.id !== subjectToDelete)
+        prevSubjects.filter(
+          (s) =>
+            s.id !== subjectToDelete &&
+            !(s.ancestors || []).includes(subjectToDelete)
+        )
       );
       await loadSubjects();
       setDeleteConfirmOpen(false);
@@ -1105,6 +1134,7 @@ export default function AllSubjects() {
                   <Grid key={subject.id} item xs={12} sm={6} md={4} lg={4}>
                     <SubjectCard
                       subject={subject}
+                      path={ancestorTitles(subject, subjectsById)}
                       onViewNotes={handleViewNotes}
                       onEdit={handleEditSubject}
                       onDelete={handleDeleteSubject}
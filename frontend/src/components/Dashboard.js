@@ -66,13 +66,14 @@ import {
 } from '@mui/icons-material';
 import { useNavigate, useLocation } from 'react-router-dom';
 import {
-  getAllSubjects,
+  getDashboard,
   getUserSubjects,
   createSubject,
   getSubjectById,
   updateSubject,
   deleteSubject,
   getNoteById,
+  getNotesBatch,
   getSubjectTitleById,
   searchContent,
   shareSubject,
@@ -83,11 +84,12 @@ import {
   getItemsSharedByMe,
   getItemShares,
 } from '../services/sharingService';
-import { getAllTags, getNotesByTag } from '../services/tagService';
+import { getNotesByTag } from '../services/tagService';
 import Sidebar from './Sidebar';
 import ShareDialog from './ShareDialog';
 import AccessLevelDialog from './AccessLevelDialog';
 import { getUserByUid } from '../services/userService';
+import { subscribeToChanges } from '../services/changeFeedService';
 
 // Sidebar width
 const drawerWidth = 240;
@@ -693,6 +695,9 @@ export default function Dashboard({ initialView }) {
   const [accessLevelDialogOpen, setAccessLevelDialogOpen] = useState(false);
   const [currentAccessItem, setCurrentAccessItem] = useState(null);
 
+  // Bumped when the change feed reports something the current view shows
+  const [refreshKey, setRefreshKey] = useState(0);
+
   useEffect(() => {
     // Check if we have a view change in location state
     if (location.state?.view) {
@@ -932,34 +937,16 @@ export default function Dashboard({ initialView }) {
           setSharedNotes(validNotes);
           setSharedContentLoading(false);
         } else if (activeView !== 'tags') {
-          // Dashboard view - fetch all types of content
-          const [allSubjects, sharedWithMeData, sharedByMeData, userTags] =
-            await Promise.all([
-              getAllSubjects(),
-              getSharedWithUser(),
-              getItemsSharedByMe(),
-              getAllTags(),
-            ]);
-
-          setSubjects(allSubjects);
-          setTags(userTags);
-
-          // Process shared by me items for count purposes
-          setSharedByMeItems(sharedByMeData);
-
-          // Create set of IDs shared by user for filtering
-          const sharedByMeItemIds = new Set(
-            sharedByMeData.map((item) => `${item.itemType}-${item.itemId}`)
-          );
+          // Dashboard view - subjects, tags and shared items come in one request
+          const dashboard = await getDashboard();
+
+          setSubjects(dashboard.subjects);
+          setTags(dashboard.tags);
 
           // Filter out items shared by the current user
-          const sharedWithMeItems = sharedWithMeData.filter((item) => {
-            const itemKey = `${item.itemType}-${item.itemId}`;
-            return (
-              !sharedByMeItemIds.has(itemKey) &&
-              item.sharedBy !== currentUser.uid
-            );
-          });
+          const sharedWithMeItems = dashboard.sharedWithMe.filter(
+            (item) => item.sharedBy !== currentUser.uid
+          );
 
           // Just count them, don't resolve details for dashboard overview
           const sharedWithMeSubjects = sharedWithMeItems.filter(
@@ -971,6 +958,15 @@ export default function Dashboard({ initialView }) {
 
           setSharedSubjects(sharedWithMeSubjects);
           setSharedNotes(sharedWithMeNotes);
+          setLoading(false);
+
+          // Items shared by the user only feed a count, so they load after the first paint
+          getItemsSharedByMe()
+            .then(setSharedByMeItems)
+            .catch((err) =>
+              console.error('Failed to fetch items shared by me:', err)
+            );
+          return;
         }
         setLoading(false);
       } catch (err) {
@@ -981,6 +977,21 @@ export default function Dashboard({ initialView }) {
     };
 
     fetchData();
+  }, [activeView, currentUser?.uid, refreshKey]);
+
+  // Refetch the overview and shared views when the user's subjects or shares change
+  useEffect(() => {
+    if (!currentUser || activeView === 'tags') return undefined;
+
+    return subscribeToChanges([], (event) => {
+      if (
+        event === 'resync' ||
+        event.startsWith('share.') ||
+        (activeView !== 'shared' && event.startsWith('subject.'))
+      ) {
+        setRefreshKey((key) => key + 1);
+      }
+    });
   }, [activeView, currentUser?.uid]);
 
   useEffect(() => {
@@ -1113,37 +1124,25 @@ export default function Dashboard({ initialView }) {
         ...new Set([...sharedWithMeNoteIds, ...sharedByMeNoteIds]),
       ];
 
-      // Create promises for all notes
-      const noteContentPromises = allNoteIds.map(async (noteId) => {
+      // Fetch the notes in batches; the server already stores a plain-text excerpt
+      const batchSize = 100;
+      const excerpts = {};
+      for (let start = 0; start < allNoteIds.length; start += batchSize) {
         try {
-          const noteData = await getNoteById(noteId);
-          if (noteData && noteData.content) {
-            // Process HTML content for preview - strip tags and limit length
-            const plainText = noteData.content.replace(/<[^>]*>/g, ' ');
-            return {
-              id: noteId,
-              content:
-                plainText.length > 300
-                  ? plainText.substring(0, 300) + '...'
-                  : plainText,
-            };
-          }
-          return { id: noteId, content: null };
+          const result = await getNotesBatch(
+            allNoteIds.slice(start, start + batchSize)
+          );
+          result.found.forEach((note) => {
+            excerpts[note.id] = note.excerpt;
+          });
         } catch (err) {
-          console.error(`Error fetching note content for ${noteId}:`, err);
-          return { id: noteId, content: null };
+          console.error('Error fetching note previews:', err);
         }
-      });
+      }
 
-      const contentResults = await Promise.all(noteContentPromises);
       const contentMap = {};
-
-      contentResults.forEach((result) => {
-        if (result.content) {
-          contentMap[result.id] = result.content;
-        } else {
-          contentMap[result.id] = 'No preview available';
-        }
+      allNoteIds.forEach((noteId) => {
+        contentMap[noteId] = excerpts[noteId] || 'No preview available';
       });
 
       setSharedNoteContents(contentMap);
@@ -34,8 +34,9 @@ import {
   Menu as MenuIcon,
 } from '@mui/icons-material';
 import { useAuth } from '../contexts/AuthContext';
-import { getNoteById } from '../services/subjectService';
+import { getNoteById, getPublicNote } from '../services/subjectService';
 import { getItemShares } from '../services/sharingService';
+import { subscribeToChanges } from '../services/changeFeedService';
 import Sidebar from './Sidebar';
 
 // Sidebar width - consistent with other components
@@ -51,6 +52,7 @@ export default function SharedNoteView() {
   const [error, setError] = useState('');
   const [shareDetails, setShareDetails] = useState(null);
   const [mobileOpen, setMobileOpen] = useState(false);
+  const [reloadKey, setReloadKey] = useState(0); // Bumped when the change feed reports an update
   const theme = useTheme();
   const isMobile = useMediaQuery(theme.breakpoints.down('sm'));
 
@@ -58,8 +60,9 @@ export default function SharedNoteView() {
     const fetchNoteDetails = async () => {
       setLoading(true);
       try {
-        // Fetch the shared note
-        const noteData = await getNoteById(noteId);
+        // Public notes come from their cached snapshot; other shares need the access check
+        const publicNote = await getPublicNote(noteId).catch(() => null);
+        const noteData = publicNote || (await getNoteById(noteId));
         if (!noteData) {
           throw new Error('Note not found or you do not have access');
         }
@@ -106,6 +109,22 @@ export default function SharedNoteView() {
     if (noteId) {
       fetchNoteDetails();
     }
+  }, [noteId, currentUser?.uid, reloadKey]);
+
+  // Refetch the note when it changes or its sharing does, rather than on a timer
+  useEffect(() => {
+    if (!noteId || !currentUser) return undefined;
+
+    return subscribeToChanges([], (event, { data }) => {
+      if (event === 'resync') {
+        setReloadKey((key) => key + 1);
+      } else if (event === 'share.note.removed' && data.id === noteId) {
+        setError('This note is no longer shared with you');
+      } else if (event.startsWith('share.note.') && data.id === noteId) {
+        // Events carry a preview, so the full note is fetched again
+        setReloadKey((key) => key + 1);
+      }
+    });
   }, [noteId, currentUser?.uid]);
 
   const handleDrawerToggle = () => {
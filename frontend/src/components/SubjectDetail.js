@@ -57,12 +57,19 @@ import {
   getNoteById,
 } from '../services/subjectService';
 import { shareItem, getItemShares } from '../services/sharingService';
-import { uploadFile, deleteFile } from '../services/storageService';
 import {
-  getAllTags,
+  uploadFile,
+  deleteFile,
+  uploadAttachment,
+  deleteAttachment,
+  getAttachmentUrl,
+} from '../services/storageService';
+import {
+  suggestTags,
   addTagToNote,
   removeTagFromNote,
 } from '../services/tagService';
+import { subscribeToChanges } from '../services/changeFeedService';
 import Sidebar from './Sidebar';
 import ShareDialog from './ShareDialog';
 
@@ -136,6 +143,7 @@ export default function SubjectDetail({
 
   // Permission-related state
   const [sharePermissions, setSharePermissions] = useState({}); // Tracks permissions for shared items
+  const [reloadKey, setReloadKey] = useState(0); // Bumped when the change feed asks for a full refetch
 
   // Create a reference for the TinyMCE editor
   const editorRef = useRef(null);
@@ -377,7 +385,54 @@ export default function SubjectDetail({
     if (subjectId) {
       fetchSubjectDetails();
     }
-  }, [subjectId, currentUser.uid, isShared, isSharedNote, noteIdFromUrl]);
+  }, [
+    subjectId,
+    currentUser.uid,
+    isShared,
+    isSharedNote,
+    noteIdFromUrl,
+    reloadKey,
+  ]);
+
+  // Apply changes to the subject and its notes as they happen instead of refetching
+  useEffect(() => {
+    // A note shared on its own doesn't give access to its subject's channel
+    if (!subjectId || isSharedNote) return undefined;
+
+    return subscribeToChanges([subjectId], (event, { data }) => {
+      switch (event) {
+        case 'note.added':
+          setNotes((prev) =>
+            prev.some((note) => note.id === data.id) ? prev : [data, ...prev]
+          );
+          break;
+        case 'note.modified':
+          setNotes((prev) =>
+            prev.map((note) =>
+              note.id === data.id ? { ...note, ...data } : note
+            )
+          );
+          break;
+        case 'note.removed':
+          setNotes((prev) => prev.filter((note) => note.id !== data.id));
+          break;
+        case 'subject.modified':
+          setSubject((prev) => (prev ? { ...prev, ...data } : data));
+          break;
+        case 'subject.removed':
+          setError('This subject has been deleted');
+          break;
+        case 'access.revoked':
+          setError('You no longer have access to this subject');
+          break;
+        case 'resync':
+          setReloadKey((key) => key + 1);
+          break;
+        default:
+          break;
+      }
+    });
+  }, [subjectId, isSharedNote, currentUser.uid]);
 
   useEffect(() => {
     // Check if we have a note to open from navigation state
@@ -409,19 +464,27 @@ export default function SubjectDetail({
     }
   }, [location.state]);
 
+  const noteTags = isEditing ? editingNote?.tags : newNote.tags;
+
   useEffect(() => {
-    // Fetch all tags for autocomplete
-    const fetchTags = async () => {
+    // Ask the server for ranked tag suggestions as the user types
+    let cancelled = false;
+    const fetchSuggestions = async () => {
       try {
-        const tags = await getAllTags();
-        setAvailableTags(tags);
+        const tags = await suggestTags(newTag.trim(), noteTags || []);
+        if (!cancelled) {
+          setAvailableTags(tags);
+        }
       } catch (error) {
-        console.error('Error fetching tags:', error);
+        console.error('Error fetching tag suggestions:', error);
       }
     };
 
-    fetchTags();
-  }, []);
+    fetchSuggestions();
+    return () => {
+      cancelled = true;
+    };
+  }, [newTag, noteTags]);
 
   const handleDrawerToggle = () => {
     setMobileOpen(!mobileOpen);
@@ -455,14 +518,28 @@ export default function SubjectDetail({
     setOpenDialog(true);
   };
 
-  const handleEditNote = (noteId) => {
+  // Note lists only carry a preview of long content; load the full note when needed
+  const loadFullNote = async (note) => {
+    if (!note || !note.contentTruncated) {
+      return note;
+    }
+    try {
+      return await getNoteById(note.id);
+    } catch (err) {
+      console.error('Failed to load full note:', err);
+      setError(err.message || 'Failed to load note');
+      return null;
+    }
+  };
+
+  const handleEditNote = async (noteId) => {
     // If not owner, check edit permission
     if (!hasPermission(noteId, 'edit')) {
       alert("You don't have permission to edit this note.");
       return;
     }
 
-    const noteToEdit = notes.find((note) => note.id === noteId);
+    const noteToEdit = await loadFullNote(notes.find((note) => note.id === noteId));
     if (noteToEdit) {
       // If we were already editing another note, we need to reset
       if (isEditing && editingNote && editingNote.id !== noteId) {
@@ -487,11 +564,18 @@ export default function SubjectDetail({
     // Clean up temporary uploads if the user cancels
     if (temporaryUploads.length > 0) {
       console.log(`Cleaning up ${temporaryUploads.length} unsaved uploads`);
-      temporaryUploads.forEach(async (url) => {
+      temporaryUploads.forEach(async (upload) => {
         try {
-          await deleteFile(url);
+          if (upload.attachmentId) {
+            await deleteAttachment(upload.attachmentId);
+          } else {
+            await deleteFile(upload);
+          }
         } catch (err) {
-          console.error(`Failed to delete temporary file ${url}:`, err);
+          console.error(
+            `Failed to delete temporary file ${upload.attachmentId || upload}:`,
+            err
+          );
         }
       });
       setTemporaryUploads([]);
@@ -609,7 +693,11 @@ export default function SubjectDetail({
             media.type === MEDIA_TYPES.FILE
           ) {
             try {
-              await deleteFile(media.url);
+              if (media.attachmentId) {
+                await deleteAttachment(media.attachmentId);
+              } else {
+                await deleteFile(media.url);
+              }
             } catch (err) {
               console.error(`Failed to delete file ${media.url}:`, err);
             }
@@ -628,8 +716,8 @@ export default function SubjectDetail({
     }
   };
 
-  const handleViewNote = (noteId) => {
-    const note = notes.find((n) => n.id === noteId);
+  const handleViewNote = async (noteId) => {
+    const note = await loadFullNote(notes.find((n) => n.id === noteId));
     if (note) {
       setSelectedNote(note);
       setViewNoteDialogOpen(true);
@@ -667,23 +755,27 @@ export default function SubjectDetail({
 
     try {
       setUploadLoading(true);
-      const fileName = `${Date.now()}_${file.name}`;
-      const path = `notes/${currentUser.uid}/${subjectId}/${fileName}`;
 
-      const uploadedUrl = await uploadFile(file, path, (progress) => {
+      // Stored once by content, so the same file attached to several notes isn't stored again
+      const attachment = await uploadAttachment(file, (progress) => {
         console.log(`File upload progress: ${progress}%`);
       });
 
-      // Track this URL as a temporary upload
-      setTemporaryUploads((prev) => [...prev, uploadedUrl]);
+      // Track this attachment as a temporary upload
+      setTemporaryUploads((prev) => [
+        ...prev,
+        { attachmentId: attachment.id },
+      ]);
 
       // Add the new media item
       const newMediaItem = {
         type: file.type.startsWith('image/')
           ? MEDIA_TYPES.IMAGE
           : MEDIA_TYPES.FILE,
-        url: uploadedUrl,
+        url: getAttachmentUrl(attachment),
         title: file.name,
+        attachmentId: attachment.id,
+        sha256: attachment.sha256,
         createdAt: new Date().toISOString(),
       };
 
@@ -1954,6 +2046,7 @@ export default function SubjectDetail({
                 <Autocomplete
                   freeSolo
                   options={availableTags}
+                  filterOptions={(options) => options}
                   value={newTag}
                   onChange={(event, newValue) => setNewTag(newValue || '')}
                   onInputChange={(event, newInputValue) =>
@@ -8,6 +8,7 @@ import {
   updateProfile,
 } from 'firebase/auth';
 import { auth } from '../firebase/config';
+import { claimSharedItems } from '../services/sharingService';
 
 const AuthContext = createContext();
 
@@ -84,6 +85,12 @@ export function AuthProvider({ children }) {
         setCurrentUser(null);
       } else {
         setCurrentUser(user);
+        if (user) {
+          // Shares sent to this email before the account existed become the user's
+          claimSharedItems().catch((error) =>
+            console.warn('Unable to claim shared items:', error)
+          );
+        }
       }
       setLoading(false);
     });
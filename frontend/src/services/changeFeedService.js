@@ -0,0 +1,89 @@
+import { auth } from '../firebase/config';
+
+const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000/api';
+
+// Helper function to get the authentication token
+const getAuthToken = async () => {
+  const currentUser = auth.currentUser;
+  if (!currentUser) {
+    throw new Error('User not authenticated');
+  }
+
+  return await currentUser.getIdToken();
+};
+
+// Parse one Server-Sent Events block into { id, event, data }
+const parseEvent = (block) => {
+  const message = { id: null, event: 'message', data: '' };
+  block.split('\n').forEach((line) => {
+    if (!line || line.startsWith(':')) return;
+    const index = line.indexOf(':');
+    const field = index === -1 ? line : line.slice(0, index);
+    const value = index === -1 ? '' : line.slice(index + 1).trimStart();
+    if (field === 'id') message.id = value;
+    if (field === 'event') message.event = value;
+    if (field === 'data') message.data += value;
+  });
+  return message;
+};
+
+// Subscribe to changes for the current user and the given subjects.
+// EventSource can't send an Authorization header, so the stream is read with fetch.
+// Returns a function that closes the subscription.
+export const subscribeToChanges = (subjectIds, onEvent, { retryMs = 5000 } = {}) => {
+  let lastEventId = null;
+  let controller = null;
+  let closed = false;
+
+  const connect = async () => {
+    controller = new AbortController();
+    try {
+      const token = await getAuthToken();
+      const params = subjectIds.length
+        ? `?subjects=${encodeURIComponent(subjectIds.join(','))}`
+        : '';
+      const headers = { Authorization: `Bearer ${token}` };
+      if (lastEventId) headers['Last-Event-ID'] = lastEventId;
+
+      const response = await fetch(`${API_URL}/events${params}`, {
+        headers,
+        signal: controller.signal,
+      });
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+
+      while (!closed) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary = buffer.indexOf('\n\n');
+        while (boundary !== -1) {
+          const message = parseEvent(buffer.slice(0, boundary));
+          buffer = buffer.slice(boundary + 2);
+          boundary = buffer.indexOf('\n\n');
+
+          if (message.id) lastEventId = message.id;
+          if (message.data) {
+            onEvent(message.event, JSON.parse(message.data));
+          }
+        }
+      }
+    } catch (error) {
+      if (closed) return;
+      console.error('Change feed disconnected:', error);
+    }
+
+    if (!closed) {
+      setTimeout(connect, retryMs);
+    }
+  };
+
+  connect();
+
+  return () => {
+    closed = true;
+    if (controller) controller.abort();
+  };
+};
@@ -77,3 +77,10 @@ export const removeSharing = async (shareId) => {
 export const getItemsSharedByMe = async () => {
   return await apiRequest('/shares/by-me');
 };
+
+// Register the signed-in user's email as theirs and accept shares sent to it before they joined
+export const claimSharedItems = async () => {
+  return await apiRequest('/recipients/claim', {
+    method: 'POST',
+  });
+};
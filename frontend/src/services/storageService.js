@@ -142,3 +142,115 @@ export const getFileUrl = async (path) => {
     throw new Error(`Failed to get file URL: ${error.message}`);
   }
 };
+
+const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000/api';
+// Bytes sent per request of an attachment upload
+const ATTACHMENT_CHUNK_SIZE = 4 * 1024 * 1024;
+const MAX_CHUNK_RETRIES = 5;
+
+const attachmentRequest = async (endpoint, options = {}) => {
+  if (!auth.currentUser) {
+    throw new Error('User not authenticated. Please log in again.');
+  }
+  const token = await auth.currentUser.getIdToken();
+  const response = await fetch(`${API_URL}/attachments${endpoint}`, {
+    ...options,
+    headers: { Authorization: `Bearer ${token}`, ...options.headers },
+  });
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({}));
+    const failure = new Error(
+      error.detail || `Attachment request failed: ${response.status}`
+    );
+    failure.status = response.status;
+    throw failure;
+  }
+  return await response.json();
+};
+
+const sha256Hex = async (file) => {
+  const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest))
+    .map((byte) => byte.toString(16).padStart(2, '0'))
+    .join('');
+};
+
+/**
+ * Full URL of an attachment's content, usable in img tags and links
+ * @param {Object} attachment - The attachment returned by uploadAttachment
+ * @returns {string} The download URL
+ */
+export const getAttachmentUrl = (attachment) =>
+  `${API_URL}${attachment.downloadPath}`;
+
+/**
+ * Upload a file as a deduplicated attachment, in resumable chunks
+ *
+ * Files the user has already uploaded finish without being sent again; others are
+ * sent in full and deduplicated by the server.
+ * @param {File} file - The file to upload
+ * @param {Function} onProgress - Optional callback for progress updates
+ * @returns {Promise<Object>} The attachment, with its id, sha256 and downloadPath
+ */
+export const uploadAttachment = async (file, onProgress) => {
+  try {
+    const sha256 = await sha256Hex(file);
+    let upload = await attachmentRequest('/uploads', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        name: file.name,
+        contentType: file.type || 'application/octet-stream',
+        size: file.size,
+        sha256,
+      }),
+    });
+
+    let retries = 0;
+    while (!upload.attachment) {
+      const end = Math.min(upload.received + ATTACHMENT_CHUNK_SIZE, file.size);
+      try {
+        upload = await attachmentRequest(
+          `/uploads/${upload.id}?offset=${upload.received}`,
+          {
+            method: 'PUT',
+            headers: { 'Content-Type': 'application/octet-stream' },
+            body: file.slice(upload.received, end),
+          }
+        );
+        retries = 0;
+      } catch (error) {
+        if (error.status && error.status !== 409 && error.status < 500) {
+          throw error;
+        }
+        if (++retries > MAX_CHUNK_RETRIES) {
+          throw error;
+        }
+        // Resume from wherever the server got to
+        await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** retries));
+        upload = await attachmentRequest(`/uploads/${upload.id}`);
+      }
+      if (onProgress && file.size) {
+        onProgress((upload.received / file.size) * 100);
+      }
+    }
+    return upload.attachment;
+  } catch (error) {
+    console.error('Error uploading attachment:', error);
+    throw new Error(`Failed to upload file: ${error.message}`);
+  }
+};
+
+/**
+ * Delete an attachment; its content stays stored while other attachments use it
+ * @param {string} attachmentId - The attachment to delete
+ * @returns {Promise<void>}
+ */
+export const deleteAttachment = async (attachmentId) => {
+  try {
+    await attachmentRequest(`/${attachmentId}`, { method: 'DELETE' });
+  } catch (error) {
+    console.error('Error deleting attachment:', error);
+    throw new Error(`Failed to delete attachment: ${error.message}`);
+  }
+};
@@ -73,6 +73,32 @@ export const deleteSubject = async (subjectId) => {
   });
 };
 
+// Get a subject with every subject nested below it and the branch's note totals
+export const getSubjectTree = async (subjectId) => {
+  return await apiRequest(`/subjects/${subjectId}/tree`);
+};
+
+// Move a subject and everything below it under another subject, or to the top level with null
+export const moveSubject = async (subjectId, parentId) => {
+  return await apiRequest(`/subjects/${subjectId}/move`, {
+    method: 'POST',
+    body: JSON.stringify({ parentId }),
+  });
+};
+
+// Get the published snapshot of a publicly shared note; needs no sign-in and
+// resolves to null when the note is not shared publicly
+export const getPublicNote = async (noteId) => {
+  const response = await fetch(`${API_URL}/public/notes/${noteId}`);
+  if (response.status === 404) {
+    return null;
+  }
+  if (!response.ok) {
+    throw new Error(`API request failed: ${response.status}`);
+  }
+  return await response.json();
+};
+
 // Get notes for a subject
 export const getNotes = async (subjectId) => {
   return await apiRequest(`/subjects/${subjectId}/notes`);
@@ -83,6 +109,21 @@ export const getNoteById = async (noteId) => {
   return await apiRequest(`/notes/${noteId}`);
 };
 
+// Get the user's notes most similar to a note, each with a similarity score
+export const getRelatedNotes = async (noteId, limit = 10) => {
+  return await apiRequest(`/notes/${noteId}/related?limit=${limit}`);
+};
+
+// Get near-duplicates of a note among the user's own notes or among public notes
+export const getNoteDuplicates = async (noteId, scope = 'own') => {
+  return await apiRequest(`/notes/${noteId}/duplicates?scope=${scope}`);
+};
+
+// Get groups of the user's notes that are near-duplicates of each other
+export const getDuplicateClusters = async () => {
+  return await apiRequest('/duplicates');
+};
+
 // Create a new note
 export const createNote = async (noteData) => {
   return await apiRequest('/notes', {
@@ -110,3 +151,24 @@ export const deleteNote = async (noteId) => {
 export const getRecentNotes = async (limit = 10) => {
   return await apiRequest(`/notes?limit=${limit}`);
 };
+
+// Get subjects, recent notes, tags and shared items in one request
+export const getDashboard = async () => {
+  return await apiRequest('/dashboard');
+};
+
+// Get several notes at once; returns { found, forbidden, missing }
+export const getNotesBatch = async (noteIds) => {
+  return await apiRequest('/notes/batch', {
+    method: 'POST',
+    body: JSON.stringify({ ids: noteIds }),
+  });
+};
+
+// Get several subjects at once; returns { found, forbidden, missing }
+export const getSubjectsBatch = async (subjectIds) => {
+  return await apiRequest('/subjects/batch', {
+    method: 'POST',
+    body: JSON.stringify({ ids: subjectIds }),
+  });
+};
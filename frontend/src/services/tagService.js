@@ -89,3 +89,85 @@ export const removeTagFromNote = async (noteId, tag) => {
     throw error;
   }
 };
+
+/**
+ * Rename a tag on all of the user's notes
+ */
+export const renameTag = async (tag, newTag) => {
+  try {
+    const token = await getAuthToken();
+    const response = await axios.post(
+      `${API_URL}/tags/rename`,
+      { tag, newTag },
+      {
+        headers: {
+          Authorization: `Bearer ${token}`,
+        },
+      }
+    );
+    return response.data;
+  } catch (error) {
+    console.error(`Error renaming tag ${tag}:`, error);
+    throw error;
+  }
+};
+
+/**
+ * Merge several tags into one on all of the user's notes
+ */
+export const mergeTags = async (tags, into) => {
+  try {
+    const token = await getAuthToken();
+    const response = await axios.post(
+      `${API_URL}/tags/merge`,
+      { tags, into },
+      {
+        headers: {
+          Authorization: `Bearer ${token}`,
+        },
+      }
+    );
+    return response.data;
+  } catch (error) {
+    console.error('Error merging tags:', error);
+    throw error;
+  }
+};
+
+/**
+ * Remove a tag from all of the user's notes
+ */
+export const deleteTag = async (tag) => {
+  try {
+    const token = await getAuthToken();
+    const response = await axios.delete(`${API_URL}/tags/${encodeURIComponent(tag)}`, {
+      headers: {
+        Authorization: `Bearer ${token}`,
+      },
+    });
+    return response.data;
+  } catch (error) {
+    console.error(`Error deleting tag ${tag}:`, error);
+    throw error;
+  }
+};
+
+/**
+ * Suggest tags for autocomplete, ranked with the tags already on the note in mind
+ */
+export const suggestTags = async (prefix, tags = [], limit = 10) => {
+  try {
+    const token = await getAuthToken();
+    const params = new URLSearchParams({ prefix, limit });
+    tags.forEach((tag) => params.append('tags', tag));
+    const response = await axios.get(`${API_URL}/tags/suggest?${params}`, {
+      headers: {
+        Authorization: `Bearer ${token}`,
+      },
+    });
+    return response.data.map((suggestion) => suggestion.tag);
+  } catch (error) {
+    console.error('Error suggesting tags:', error);
+    throw error;
+  }
+};